@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor wijzigingsdetectie
+Vergelijkt per pagina compacte product vingerafdrukken in plaats van volledige productlijsten
+"""
+
+import hashlib
+import html
+import json
+import re
+import struct
+import time
+
+CHANGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS product_fingerprints (
+  url TEXT PRIMARY KEY,
+  store TEXT NOT NULL,
+  page_hash BLOB NOT NULL,
+  products BLOB NOT NULL,
+  updated_at REAL NOT NULL,
+  product_ids TEXT
+);
+"""
+
+# (table, column, statement) for databases created before the column existed
+CHANGE_MIGRATIONS = (
+    ('product_fingerprints', 'product_ids', "ALTER TABLE product_fingerprints ADD COLUMN product_ids TEXT"),
+)
+
+# Per product: key, fingerprint, price in cents, stock (1/0, -1 unknown).
+# Kept sorted by key, 24 bytes per product.
+RECORD = struct.Struct('<qQii')
+UNKNOWN = -1
+
+LD_JSON = re.compile(r'<script[^>]+application/ld\+json[^>]*>(.*?)</script>', re.S | re.I)
+PRODUCT_LINK = re.compile(r'<a\b[^>]*?href="(?P<url>[^"]*/product/[^"]*?/(?P<id>\d+)\.html[^"]*)"'
+                          r'[^>]*>', re.I)
+TITLE_ATTR = re.compile(r'\btitle="([^"]*)"', re.I)
+PRICE = re.compile(r'(?:US\s*\$|data-price=")\s*([\d,]+(?:\.\d+)?)', re.I)
+OUT_OF_STOCK = re.compile(r'out of stock|sold out', re.I)
+WHITESPACE = re.compile(r'\s+')
+
+
+def page_hash(body):
+    """16-byte BLAKE2b of a page; equal hashes skip parsing altogether"""
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+def product_key(product_id):
+    """int64 key: DHgate item codes as themselves, anything else hashed"""
+    if product_id.isdigit() and len(product_id) < 19:
+        return int(product_id)
+    # Negative keys can never collide with item codes
+    digest = hashlib.blake2b(product_id.encode('utf-8'), digest_size=8).digest()
+    return -(int.from_bytes(digest, 'little') >> 1) - 1
+
+
+def normalize_title(title):
+    return WHITESPACE.sub(' ', html.unescape(title or '')).strip()
+
+
+def price_cents(value):
+    """Price in cents from 12.99, "US $1,299.00" or a "1.23 - 4.56" range (low end)"""
+    if value is None:
+        return UNKNOWN
+    if isinstance(value, (int, float)):
+        return int(round(value * 100))
+    match = re.search(r'[\d,]+(?:\.\d+)?', str(value))
+    if not match:
+        return UNKNOWN
+    return int(round(float(match.group(0).replace(',', '')) * 100))
+
+
+def fingerprint(title, cents, stock):
+    """8-byte BLAKE2b over the normalized title, price and stock"""
+    data = f"{title.casefold()}\x1f{cents}\x1f{stock}".encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def _ld_products(node, found):
+    if isinstance(node, list):
+        for item in node:
+            _ld_products(item, found)
+        return
+    if not isinstance(node, dict):
+        return
+    if node.get('@type') == 'Product':
+        offers = node.get('offers') or {}
+        if isinstance(offers, list):
+            offers = offers[0] if offers else {}
+        url = node.get('url') or offers.get('url') or ''
+        match = re.search(r'/(\d+)\.html', url)
+        product_id = str(node.get('sku') or node.get('productID') or (match and match.group(1)) or '')
+        if product_id:
+            availability = str(offers.get('availability') or '')
+            found.append({
+                'product_id': product_id, 'title': node.get('name'), 'url': url,
+                'price': offers.get('price', offers.get('lowPrice')),
+                'stock': 0 if 'OutOfStock' in availability else 1 if availability else UNKNOWN})
+        return
+    for key in ('itemListElement', 'item', '@graph', 'mainEntity'):
+        if key in node:
+            _ld_products(node[key], found)
+
+
+def extract_products(body):
+    """[{'product_id', 'title', 'url', 'price', 'stock'}] from a store page.
+
+    Structured data (JSON-LD Product / ItemList) is used when the page has
+    it; otherwise product cards are found by their /product/.../<itemcode>.html
+    links, with the first price between one link and the next.
+    """
+    text = body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+    found = []
+    for block in LD_JSON.findall(text):
+        try:
+            _ld_products(json.loads(block), found)
+        except ValueError:
+            continue
+    if found:
+        return found
+    links = list(PRODUCT_LINK.finditer(text))
+    seen = {}
+    for index, link in enumerate(links):
+        end = links[index + 1].start() if index + 1 < len(links) else min(len(text), link.end() + 4000)
+        card = text[link.start():end]
+        product = seen.get(link.group('id'))
+        if product is None:
+            product = seen[link.group('id')] = {
+                'product_id': link.group('id'), 'url': html.unescape(link.group('url')),
+                'title': None, 'price': None, 'stock': UNKNOWN}
+            found.append(product)
+        if product['title'] is None:
+            title = TITLE_ATTR.search(link.group(0))
+            if title:
+                product['title'] = title.group(1)
+        if product['price'] is None:
+            price = PRICE.search(card)
+            if price:
+                product['price'] = price.group(1)
+        if OUT_OF_STOCK.search(card):
+            product['stock'] = 0
+    return found
+
+
+def records_for(products):
+    """(sorted packed records, {key: product}) for extracted products"""
+    records = {}
+    by_key = {}
+    for product in products:
+        key = product_key(product['product_id'])
+        if key in records:
+            continue
+        title = normalize_title(product.get('title'))
+        cents = price_cents(product.get('price'))
+        stock = product.get('stock', UNKNOWN)
+        records[key] = (fingerprint(title, cents, stock), cents, stock)
+        by_key[key] = dict(product, title=title, cents=cents)
+    packed = b''.join(RECORD.pack(key, *records[key]) for key in sorted(records))
+    return packed, by_key
+
+
+def product_ids(products):
+    """JSON {key: product id} for the hashed keys of records_for() products,
+    so removals can be reported under the id they were added with"""
+    ids = {str(key): product['product_id'] for key, product in products.items() if key < 0}
+    return json.dumps(ids, separators=(',', ':')) if ids else None
+
+
+def _removed_id(key, ids):
+    if key >= 0:
+        return str(key)
+    return ids.get(str(key)) or f"{key & (2**64 - 1):016x}"
+
+
+def unpack(blob):
+    """{key: (fingerprint, cents, stock)} from a packed record blob"""
+    return {key: (fp, cents, stock) for key, fp, cents, stock in RECORD.iter_unpack(blob)}
+
+
+def diff(old_blob, new_blob, products, partial=False, old_ids=None):
+    """Added, removed and changed products between two record blobs.
+
+    Both sides are unpacked in one pass each and compared by key, so the
+    cost is linear in the number of products; product details are only
+    looked at for keys whose fingerprint differs. A `partial` page (one
+    showing a selection of the store, like its home page) only reports
+    changes: products coming and going there say nothing about the store.
+    Removed products are reported by their item code, or by their original
+    id from `old_ids` (the JSON stored by product_ids()) for hashed keys.
+    """
+    old = unpack(old_blob)
+    changes = {'added': [], 'removed': [], 'changed': []}
+    for key, fp, cents, stock in RECORD.iter_unpack(new_blob):
+        previous = old.pop(key, None)
+        if previous is None:
+            if not partial:
+                changes['added'].append(products[key])
+        elif previous[0] != fp:
+            fields = []
+            if previous[1] != cents:
+                fields.append('price')
+            if previous[2] != stock:
+                fields.append('stock')
+            if not fields:
+                fields.append('title')
+            changes['changed'].append(dict(products[key], fields=fields,
+                                           old_cents=previous[1], old_stock=previous[2]))
+    if not partial:
+        ids = json.loads(old_ids) if old_ids else {}
+        changes['removed'] = [{'product_id': _removed_id(key, ids), 'cents': cents, 'stock': stock}
+                              for key, (_, cents, stock) in old.items()]
+    return changes
+
+
+def _price(cents):
+    return cents / 100 if cents != UNKNOWN else None
+
+
+def digest_events(store, changes):
+    """Digest engine events for a diff.
+
+    New products and back-in-stock become 'new', removals and sell-outs
+    'removed', price moves 'price'; title-only edits are not worth a mail.
+    """
+    events = []
+    for product in changes['added']:
+        events.append({'store': store, 'product_id': product['product_id'], 'kind': 'new',
+                       'title': product['title'], 'url': product['url'],
+                       'price': _price(product['cents'])})
+    for product in changes['removed']:
+        events.append({'store': store, 'product_id': product['product_id'], 'kind': 'removed',
+                       'price': _price(product['cents'])})
+    for product in changes['changed']:
+        event = {'store': store, 'product_id': product['product_id'], 'title': product['title'],
+                 'url': product['url'], 'price': _price(product['cents'])}
+        if 'stock' in product['fields'] and product['stock'] == 0:
+            events.append(dict(event, kind='removed'))
+        elif 'stock' in product['fields'] and product['old_stock'] == 0:
+            events.append(dict(event, kind='new'))
+        elif 'price' in product['fields']:
+            events.append(dict(event, kind='price', old_price=_price(product['old_cents'])))
+    return events
+
+
+def history_points(old_blob, new_blob, now, partial=False):
+    """PriceHistory observations for a page: new and re-priced or restocked
+    products, plus removed ones as out of stock at their last price. A
+    product leaving a `partial` page may still be sold, so only the
+    listing page records removals."""
+    old = unpack(old_blob) if old_blob is not None else {}
+    points = []
+    for key, _, cents, stock in RECORD.iter_unpack(new_blob):
+        previous = old.pop(key, None)
+        if previous is None or previous[1:] != (cents, stock):
+            if cents != UNKNOWN:
+                points.append((key, now, cents, stock))
+    if old_blob is not None and not partial:
+        points.extend((key, now, cents, 0) for key, (_, cents, _) in old.items() if cents != UNKNOWN)
+    return points
+
+
+def _save_fingerprints(conn, url, store, digest, products, now, ids):
+    conn.execute(
+        "INSERT INTO product_fingerprints (url, store, page_hash, products, updated_at, product_ids) "
+        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO UPDATE SET store = excluded.store, "
+        "page_hash = excluded.page_hash, products = excluded.products, "
+        "updated_at = excluded.updated_at, product_ids = excluded.product_ids",
+        (url, store, digest, products, now, ids))
+
+
+class ChangeDetector:
+    """Turns fetched store pages into product changes.
+
+    Per page only a 16-byte page hash and the packed fingerprint records
+    are kept, plus the original ids of products that are not identified by
+    a DHgate item code. A page whose hash is unchanged is dropped before any
+    parsing; otherwise the new records are diffed against the stored ones.
+    The first crawl of a page only records a baseline. Changes go to
+    `on_changes(store, changes)`, e.g. DigestEngine.record via
+    digest_events(). `process` fits CrawlScheduler's on_page hook; pages
+    the crawler marks partial never report products as added or removed,
+    only the store's listing page does. With a PriceHistory as `history`,
+    every parsed page also appends its price and stock movements (the
+    full page on the first crawl).
+    """
+
+    def __init__(self, store, on_changes=None, parse=extract_products, history=None):
+        self.store = store
+        self.on_changes = on_changes
+        self.parse = parse
+        self.history = history
+        self.counts = {'unchanged': 0, 'parsed': 0, 'baseline': 0, 'changed': 0}
+
+    def initialize(self):
+        conn = self.store.connect()
+        try:
+            conn.executescript(CHANGE_SCHEMA)
+            for table, column, statement in CHANGE_MIGRATIONS:
+                columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def process(self, job, body):
+        return self.detect(job.url, job.store, body, job.partial)
+
+    def detect(self, url, store, body, partial=False):
+        """Changes for one fetched page, or None when there is nothing to report"""
+        now = time.time()
+        digest = page_hash(body)
+        row = self.store.reader().execute(
+            "SELECT page_hash, products, product_ids FROM product_fingerprints WHERE url = ?", (url,)).fetchone()
+        if row is not None and row[0] == digest:
+            self.counts['unchanged'] += 1
+            return None
+        packed, products = records_for(self.parse(body))
+        self.counts['parsed'] += 1
+        self.store.submit(_save_fingerprints, url, store, digest, packed, now,
+                          product_ids(products))
+        if self.history is not None:
+            self.history.append(history_points(row[1] if row else None, packed, int(now),
+                                               partial))
+        if row is None:
+            self.counts['baseline'] += 1
+            return None
+        changes = diff(row[1], packed, products, partial, row[2])
+        if not any(changes.values()):
+            return None
+        self.counts['changed'] += 1
+        if self.on_changes is not None:
+            self.on_changes(store, changes)
+        return changes
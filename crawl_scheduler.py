@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor winkel crawler
+Asyncio planner die gevolgde winkels uit de shops tabel periodiek ophaalt
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import gzip
+import heapq
+import http.client
+import itertools
+import json
+import os
+import random
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from email.utils import parsedate_to_datetime
+
+import change_detection
+import digest_engine
+import event_stream
+import price_history
+import signup_store
+
+DHGATE_BASE = "https://www.dhgate.com"
+USER_AGENT = "DHgateMonitorBot/1.0 (+https://dhgate-monitor.com)"
+MAX_PAGE_BYTES = 5 * 1024 * 1024
+MAX_REDIRECTS = 3
+
+# Store pages by name; lower priority numbers are crawled first when due together
+PAGE_PATHS = {
+    'products': (0, "/store/products/{store}.html"),
+    'home': (1, "/store/{store}"),
+    'top-selling': (2, "/store/top-selling/{store}.html"),
+}
+
+# Pages that show only a rotating selection of the store's products; a
+# product missing from them is not gone from the store
+PARTIAL_PAGES = frozenset({'home', 'top-selling'})
+
+# Pages each /add_shop monitoring type needs; a store followed with several
+# types is crawled once with the union of their pages
+MONITORING_PAGES = {
+    'full': ('products', 'home', 'top-selling'),
+    'products': ('products',),
+    'prices': ('products',),
+}
+
+CRAWL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_state (
+  url TEXT PRIMARY KEY,
+  store TEXT NOT NULL,
+  etag TEXT,
+  last_modified TEXT,
+  last_status INTEGER,
+  last_crawled REAL,
+  next_due REAL NOT NULL DEFAULT 0,
+  failures INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# One row per monitored store: its monitoring types and a URL to fall back on
+MONITORED_STORES = """
+SELECT sh.store, json_group_array(DISTINCT coalesce(sh.monitoring_type, 'full')), min(sh.shop_url)
+FROM shops sh JOIN subscriptions s ON s.id = sh.subscription_id
+WHERE s.subscribed = 1
+GROUP BY sh.store
+"""
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def store_pages(store, shop_url, monitoring_types, base=DHGATE_BASE):
+    """[(page, priority, url)] to crawl for one store.
+
+    Numeric DHgate store ids get their listing pages built from `base`;
+    anything else can only be crawled at the URL the user gave.
+    """
+    if not store.isdigit():
+        return [('shop', 0, shop_url)]
+    names = []
+    for monitoring_type in monitoring_types:
+        for name in MONITORING_PAGES.get(monitoring_type, MONITORING_PAGES['full']):
+            if name not in names:
+                names.append(name)
+    return [(name, PAGE_PATHS[name][0], base.rstrip('/') + PAGE_PATHS[name][1].format(store=store))
+            for name in names]
+
+
+def retry_after(headers):
+    """Seconds from a Retry-After header (delta or HTTP date), or None"""
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Async token bucket; acquire() sleeps until a token is free"""
+
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Take a token and return how long the caller has to wait for it"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def acquire(self):
+        wait = self.delay()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    """Per-host breaker: opens after `threshold` consecutive failures.
+
+    While open, the host gets no requests until the cooldown ends; then a
+    single trial request is let through (half-open). Success closes the
+    breaker, failure reopens it with twice the cooldown, up to `max_cooldown`.
+    """
+
+    def __init__(self, threshold=5, cooldown=60.0, max_cooldown=3600.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+
+    def wait(self, host, now):
+        """Seconds until `host` may be tried again; 0 lets the request through"""
+        state = self.hosts.get(host)
+        if state is None or state['open_until'] is None:
+            return 0.0
+        if state['trial']:
+            return state['cooldown']
+        if now < state['open_until']:
+            return state['open_until'] - now
+        state['trial'] = True
+        return 0.0
+
+    def success(self, host):
+        self.hosts.pop(host, None)
+
+    def failure(self, host, now):
+        state = self.hosts.setdefault(host, {'failures': 0, 'open_until': None,
+                                             'cooldown': self.cooldown, 'trial': False})
+        state['failures'] += 1
+        if state['trial']:
+            state['cooldown'] = min(self.max_cooldown, state['cooldown'] * 2)
+        if state['trial'] or state['failures'] >= self.threshold:
+            state['open_until'] = now + state['cooldown']
+            state['trial'] = False
+
+    def open_hosts(self, now):
+        return sorted(host for host, state in self.hosts.items()
+                      if state['open_until'] is not None and now < state['open_until'])
+
+
+class CrawlJob:
+    """One page of one store, with its validators and schedule"""
+
+    __slots__ = ('store', 'page', 'priority', 'url', 'host', 'partial', 'etag',
+                 'last_modified', 'next_due', 'failures', 'active')
+
+    def __init__(self, store, page, priority, url):
+        self.store = store
+        self.page = page
+        self.priority = priority
+        self.url = url
+        self.host = urllib.parse.urlsplit(url).netloc.lower()
+        self.partial = page in PARTIAL_PAGES
+        self.etag = None
+        self.last_modified = None
+        self.next_due = 0.0
+        self.failures = 0
+        self.active = True
+
+
+def _save_crawl_state(conn, rows):
+    conn.executemany(
+        "INSERT INTO crawl_state (url, store, etag, last_modified, last_status, last_crawled, "
+        "next_due, failures) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO UPDATE SET "
+        "store = excluded.store, etag = excluded.etag, last_modified = excluded.last_modified, "
+        "last_status = excluded.last_status, last_crawled = excluded.last_crawled, "
+        "next_due = excluded.next_due, failures = excluded.failures", rows)
+    return len(rows)
+
+
+class CrawlScheduler:
+    """Crawls every monitored store page when it is due.
+
+    Due pages come off a heap ordered by (due time, page priority). At most
+    `concurrency` fetches run at once and at most `per_host` per host;
+    on top of that a global and a per-host token bucket pace the request
+    rate. Fetches are conditional (If-None-Match / If-Modified-Since), so
+    an unchanged page costs a 304 and no parsing. Failures back off
+    exponentially with jitter (honouring Retry-After) and trip a per-host
+    circuit breaker. Fetching uses blocking http.client in worker threads
+    that keep one connection per host alive; the event loop only
+    schedules.
+
+    `on_page(job, body)` is called for every 200 response, in a worker
+    thread if it is a plain function. Validators and schedules persist in
+    the crawl_state table, so a restart resumes where it left off.
+    """
+
+    def __init__(self, store, on_page=None, interval=900.0, concurrency=16, per_host=4,
+                 rate=20.0, host_rate=5.0, timeout=20.0, backoff=30.0, max_backoff=3600.0,
+                 breaker=None, base_url=DHGATE_BASE, refresh_every=60.0):
+        self.store = store
+        self.on_page = on_page
+        self.interval = interval
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.bucket = TokenBucket(rate, burst=rate)
+        self.host_rate = host_rate
+        self.host_buckets = {}
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.base_url = base_url
+        self.refresh_every = refresh_every
+        self.jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._in_flight = {}
+        self._waiting = {}
+        self._stop = None
+        self._dirty = {}
+        self._local = threading.local()
+        self.counts = {'fetched': 0, 'not_modified': 0, 'missing': 0, 'errors': 0, 'bytes': 0}
+
+    def initialize(self):
+        conn = self.store.connect()
+        try:
+            conn.executescript(CRAWL_SCHEMA)
+        finally:
+            conn.close()
+
+    # Job bookkeeping
+
+    def load(self):
+        """Sync jobs with the shops table; returns the number of new pages"""
+        return self._sync(*self._read_pages())
+
+    def _read_pages(self):
+        """(wanted pages, saved crawl state); only reads, so run() can call
+        it from a thread while the jobs and heap stay on the event loop"""
+        conn = self.store.reader()
+        wanted = {}
+        for store, types, shop_url in conn.execute(MONITORED_STORES):
+            for page, priority, url in store_pages(store, shop_url, json.loads(types), self.base_url):
+                wanted[url] = (store, page, priority)
+        saved = {row[0]: row[1:] for row in conn.execute(
+            "SELECT url, etag, last_modified, next_due, failures FROM crawl_state")}
+        return wanted, saved
+
+    def _sync(self, wanted, saved):
+        added = 0
+        for url, job in list(self.jobs.items()):
+            if url not in wanted:
+                job.active = False
+                del self.jobs[url]
+        for url, (store, page, priority) in wanted.items():
+            if url in self.jobs:
+                continue
+            job = self.jobs[url] = CrawlJob(store, page, priority, url)
+            if url in saved:
+                job.etag, job.last_modified, job.next_due, job.failures = saved[url]
+            self._push(job)
+            added += 1
+        return added
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_due, job.priority, next(self._sequence), job))
+
+    def _reschedule(self, job, now, status, delay=None):
+        if delay is None:
+            # Spread revisits so stores added together do not stay in lockstep
+            delay = self.interval * random.uniform(0.9, 1.1)
+        job.next_due = now + delay
+        self._dirty[job.url] = (job.url, job.store, job.etag, job.last_modified, status, now,
+                                job.next_due, job.failures)
+
+    def _backoff_delay(self, job, headers=None):
+        delay = min(self.max_backoff, self.backoff * 2 ** (job.failures - 1))
+        delay *= random.uniform(0.5, 1.5)
+        hinted = retry_after(headers)
+        return max(delay, hinted) if hinted is not None else delay
+
+    # Scheduling loop
+
+    def stop(self):
+        """Ask run() to finish the fetches in flight and return"""
+        if self._stop is not None:
+            self._stop.set()
+            self._wake.set()
+
+    async def run(self, once=False):
+        """Crawl until stop() is called; with once=True every page is fetched one time"""
+        stop = self._stop = asyncio.Event()
+        self._wake = asyncio.Event()
+        # One fetch thread per concurrency slot, each keeping its own connections
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.concurrency,
+                                                               thread_name_prefix="dhgate-crawl")
+        tasks = set()
+        self._sync(*await asyncio.to_thread(self._read_pages))
+        refreshed = time.monotonic()
+        try:
+            while not stop.is_set():
+                # Cleared before any await, so a fetch finishing meanwhile still wakes the loop
+                self._wake.clear()
+                if once and not self._heap and not tasks and not self._waiting:
+                    break
+                if not once and time.monotonic() - refreshed >= self.refresh_every:
+                    self._sync(*await asyncio.to_thread(self._read_pages))
+                    refreshed = time.monotonic()
+                for job in self._ready(time.time(), tasks, once):
+                    task = asyncio.create_task(self._crawl(job, once))
+                    tasks.add(task)
+                    task.add_done_callback(self._finished(tasks))
+                if self._dirty:
+                    await self._flush()
+                wait = self.refresh_every
+                if self._heap and len(tasks) < self.concurrency:
+                    wait = min(wait, max(0.0, self._heap[0][0] - time.time()))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=max(wait, 0.005))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await self._flush()
+            self._executor.shutdown(wait=False)
+
+    def _finished(self, tasks):
+        def done(task):
+            tasks.discard(task)
+            self._wake.set()
+        return done
+
+    def _ready(self, now, tasks, once):
+        """Pop due jobs that fit under the concurrency, per-host and breaker limits.
+
+        A due job whose host is at its `per_host` limit waits off the heap
+        until a fetch for that host finishes, so a busy host never makes the
+        loop spin on its jobs.
+        """
+        ready = []
+        while self._heap and self._heap[0][0] <= now and len(tasks) + len(ready) < self.concurrency:
+            job = heapq.heappop(self._heap)[3]
+            if not job.active:
+                continue
+            if self._in_flight.get(job.host, 0) >= self.per_host:
+                self._waiting.setdefault(job.host, []).append(job)
+                continue
+            wait = self.breaker.wait(job.host, now)
+            if wait:
+                job.next_due = now + wait
+                self._push(job)
+                continue
+            self._in_flight[job.host] = self._in_flight.get(job.host, 0) + 1
+            ready.append(job)
+        return ready
+
+    async def _crawl(self, job, once):
+        try:
+            await self.bucket.acquire()
+            bucket = self.host_buckets.get(job.host)
+            if bucket is None:
+                bucket = self.host_buckets[job.host] = TokenBucket(self.host_rate)
+            await bucket.acquire()
+            try:
+                status, headers, body = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._fetch, job)
+            except Exception as e:
+                # Whatever went wrong, the job is rescheduled with backoff below
+                status, headers, body = None, None, None
+                print(f"⚠️ {job.url}: {e}", file=sys.stderr)
+            await self._handle(job, status, headers, body)
+        finally:
+            self._in_flight[job.host] -= 1
+            for waiting in self._waiting.pop(job.host, ()):
+                self._push(waiting)
+        if job.active and not once:
+            self._push(job)
+
+    async def _handle(self, job, status, headers, body):
+        now = time.time()
+        if status == 200:
+            self.breaker.success(job.host)
+            job.failures = 0
+            job.etag = headers.get('ETag')
+            job.last_modified = headers.get('Last-Modified')
+            self.counts['fetched'] += 1
+            self.counts['bytes'] += len(body)
+            self._reschedule(job, now, status)
+            if self.on_page is not None:
+                try:
+                    if asyncio.iscoroutinefunction(self.on_page):
+                        await self.on_page(job, body)
+                    else:
+                        await asyncio.to_thread(self.on_page, job, body)
+                except Exception as e:
+                    print(f"❌ Verwerken van {job.url} mislukt: {e!r}", file=sys.stderr)
+        elif status == 304:
+            self.breaker.success(job.host)
+            job.failures = 0
+            self.counts['not_modified'] += 1
+            self._reschedule(job, now, status)
+        elif status is not None and 400 <= status < 500 and status not in (408, 429):
+            # The page is gone or refused; the host itself is fine
+            self.breaker.success(job.host)
+            self.counts['missing'] += 1
+            self._reschedule(job, now, status)
+        else:
+            job.failures += 1
+            self.breaker.failure(job.host, now)
+            self.counts['errors'] += 1
+            self._reschedule(job, now, status, self._backoff_delay(job, headers))
+
+    async def _flush(self):
+        rows, self._dirty = list(self._dirty.values()), {}
+        if rows:
+            await asyncio.to_thread(self.store.submit, _save_crawl_state, rows)
+
+    # Fetching (worker threads)
+
+    def _connection(self, scheme, netloc):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get((scheme, netloc))
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout,
+                                                   context=ssl.create_default_context())
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def _fetch(self, job):
+        """(status, headers, body) for a conditional GET of the job's URL"""
+        url = job.url
+        headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip',
+                   'Accept': 'text/html,application/xhtml+xml'}
+        if job.etag:
+            headers['If-None-Match'] = job.etag
+        if job.last_modified:
+            headers['If-Modified-Since'] = job.last_modified
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f"unsupported URL scheme {parts.scheme!r}")
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response, body = self._request(parts.scheme, parts.netloc, path, headers)
+            if response.will_close:
+                self._drop_connection(parts.scheme, parts.netloc)
+            if len(body) > MAX_PAGE_BYTES:
+                self._drop_connection(parts.scheme, parts.netloc)
+                raise ValueError("page larger than MAX_PAGE_BYTES")
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+            if response.getheader('Content-Encoding') == 'gzip' and body:
+                try:
+                    body = gzip.decompress(body)
+                except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+                    raise ValueError(f"truncated or corrupt gzip body: {e}") from e
+            return response.status, response.headers, body
+        raise ValueError("too many redirects")
+
+    def _request(self, scheme, netloc, path, headers):
+        """(response, body) of one GET on the thread's kept-alive connection.
+
+        The server may have closed an idle connection long before the next
+        crawl round; a reused connection that turns out to be dead is
+        replaced once before the error counts as a failure.
+        """
+        for attempt in range(2):
+            conn = self._connection(scheme, netloc)
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                return response, response.read(MAX_PAGE_BYTES + 1)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self._drop_connection(scheme, netloc)
+                if not reused or attempt:
+                    raise
+            except (OSError, http.client.HTTPException):
+                self._drop_connection(scheme, netloc)
+                raise
+
+    def stats(self):
+        now = time.time()
+        return dict(self.counts, pages=len(self.jobs),
+                    due=sum(1 for job in self.jobs.values() if job.next_due <= now),
+                    open_hosts=self.breaker.open_hosts(now))
+
+
+def parse_args(argv=None):
+    """Parse CLI flags; every flag can also be set through an environment variable"""
+    parser = argparse.ArgumentParser(description="Crawl the stores monitored through /add_shop")
+    parser.add_argument("--db", default=os.environ.get("DHGATE_DB", signup_store.DEFAULT_DB_PATH),
+                        help="SQLite database (env DHGATE_DB)")
+    parser.add_argument("--once", action="store_true",
+                        help="fetch every page one time and exit")
+    parser.add_argument("--interval", type=float, default=_env_float("DHGATE_CRAWL_INTERVAL", 900.0),
+                        help="seconds between visits of a page (env DHGATE_CRAWL_INTERVAL)")
+    parser.add_argument("--concurrency", type=int, default=_env_int("DHGATE_CRAWL_CONCURRENCY", 16),
+                        help="fetches in flight (env DHGATE_CRAWL_CONCURRENCY)")
+    parser.add_argument("--per-host", type=int, default=_env_int("DHGATE_CRAWL_PER_HOST", 4),
+                        help="fetches in flight per host (env DHGATE_CRAWL_PER_HOST)")
+    parser.add_argument("--rate", type=float, default=_env_float("DHGATE_CRAWL_RATE", 20.0),
+                        help="requests per second overall (env DHGATE_CRAWL_RATE)")
+    parser.add_argument("--host-rate", type=float, default=_env_float("DHGATE_CRAWL_HOST_RATE", 5.0),
+                        help="requests per second per host (env DHGATE_CRAWL_HOST_RATE)")
+    parser.add_argument("--base-url", default=os.environ.get("DHGATE_CRAWL_BASE", DHGATE_BASE),
+                        help="DHgate site to crawl (env DHGATE_CRAWL_BASE)")
+    parser.add_argument("--history-dir",
+                        default=os.environ.get("DHGATE_HISTORY_DIR", price_history.DEFAULT_HISTORY_DIR),
+                        help="price history segments, empty to disable (env DHGATE_HISTORY_DIR)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = signup_store.SignupStore(args.db)
+    store.initialize()
+    digests = digest_engine.DigestEngine(store)
+    digests.initialize()
+    event_stream.initialize(store)
+    history = price_history.PriceHistory(args.history_dir) if args.history_dir else None
+
+    def on_changes(shop, changes):
+        digests.record(change_detection.digest_events(shop, changes))
+        # Live dashboards of the store's followers reload on this
+        event_stream.publish(store, event_stream.store_channel(shop), 'products',
+                             {'store': shop, **{kind: len(items) for kind, items in changes.items()}})
+
+    detector = change_detection.ChangeDetector(store, on_changes, history=history)
+    detector.initialize()
+    scheduler = CrawlScheduler(store, on_page=detector.process, interval=args.interval,
+                               concurrency=args.concurrency, per_host=args.per_host,
+                               rate=args.rate, host_rate=args.host_rate, base_url=args.base_url)
+    scheduler.initialize()
+    started = time.monotonic()
+    try:
+        asyncio.run(scheduler.run(once=args.once))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+        if history is not None:
+            history.rollup()
+            history.close()
+    stats = scheduler.stats()
+    print(f"🕷️ {stats['fetched']} pagina's opgehaald, {stats['not_modified']} ongewijzigd, "
+          f"{stats['missing']} niet gevonden, {stats['errors']} fouten "
+          f"in {time.monotonic() - started:.1f}s")
+    print(f"🔍 {detector.counts['parsed']} geparsed, {detector.counts['unchanged']} zonder wijziging "
+          f"overgeslagen, {detector.counts['changed']} met productwijzigingen")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor digest verzending
+Bundelt winkel wijzigingen per abonnee tot één e-mail per tijdvenster
+"""
+
+import argparse
+import html
+import json
+import sys
+import time
+
+import notification_dispatch
+import signup_store
+
+EVENT_KINDS = ('new', 'price', 'removed')
+# /add_shop monitoring types that want each kind of event
+EVENT_MONITORING_TYPES = {
+    'new': '["full", "products"]',
+    'removed': '["full", "products"]',
+    'price': '["full", "prices"]',
+}
+# Price drops of at least this fraction count as important, like new products
+IMPORTANT_PRICE_DROP = 0.10
+MAX_ATTEMPTS = 10
+
+DIGEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_pending (
+  subscription_id INTEGER NOT NULL,
+  store TEXT NOT NULL,
+  product_id TEXT NOT NULL,
+  kind TEXT,
+  title TEXT,
+  url TEXT,
+  price REAL,
+  first_price REAL,
+  important INTEGER NOT NULL DEFAULT 0,
+  events INTEGER NOT NULL DEFAULT 1,
+  PRIMARY KEY (subscription_id, store, product_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_digest_pending_product ON digest_pending(store, product_id);
+
+CREATE TABLE IF NOT EXISTS digest_windows (
+  subscription_id INTEGER PRIMARY KEY,
+  opened_at REAL NOT NULL,
+  last_event_at REAL NOT NULL,
+  events INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE INDEX IF NOT EXISTS idx_digest_windows_opened ON digest_windows(opened_at);
+CREATE INDEX IF NOT EXISTS idx_digest_windows_last_event ON digest_windows(last_event_at);
+
+CREATE TABLE IF NOT EXISTS digest_outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  subscription_id INTEGER NOT NULL,
+  items TEXT NOT NULL,
+  created_at REAL NOT NULL,
+  sending_until REAL NOT NULL DEFAULT 0,
+  attempts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_digest_outbox_sending ON digest_outbox(sending_until);
+"""
+
+# Followers of one store whose notification setting wants this event. A
+# subscriber who already has the product pending is included regardless,
+# so a later minor change still updates (or cancels) that entry. Stores
+# added through /add_shop also have to be monitored in a mode that wants
+# this kind of event (widget signups have no shops row and get everything).
+FOLLOWERS = """
+SELECT ss.subscription_id FROM subscription_stores ss
+JOIN subscriptions s ON s.id = ss.subscription_id
+WHERE ss.store = :store
+  AND (coalesce(s.notifications, 'all') IN (SELECT value FROM json_each(:levels))
+       OR EXISTS (SELECT 1 FROM digest_pending p WHERE p.subscription_id = ss.subscription_id
+                  AND p.store = :store AND p.product_id = :product_id))
+  AND NOT EXISTS (SELECT 1 FROM shops sh WHERE sh.subscription_id = ss.subscription_id
+                  AND sh.store = :store
+                  AND coalesce(sh.monitoring_type, 'full') NOT IN (SELECT value FROM json_each(:types)))
+"""
+
+# Net effect of two changes to one product inside a window: added then
+# removed cancels out, removed then re-added is at most a price change,
+# and anything on a new product keeps it new
+MERGE_EVENT = f"""
+INSERT INTO digest_pending (subscription_id, store, product_id, kind, title, url, price,
+                            first_price, important)
+SELECT subscription_id, :store, :product_id, :kind, :title, :url, :price, :old_price, :important
+FROM ({FOLLOWERS})
+WHERE true
+ON CONFLICT (subscription_id, store, product_id) DO UPDATE SET
+  kind = CASE
+    WHEN digest_pending.kind = 'new' AND excluded.kind = 'removed' THEN NULL
+    WHEN digest_pending.kind = 'new' THEN 'new'
+    WHEN excluded.kind = 'new' THEN 'price'
+    ELSE excluded.kind END,
+  title = coalesce(excluded.title, digest_pending.title),
+  url = coalesce(excluded.url, digest_pending.url),
+  price = coalesce(excluded.price, digest_pending.price),
+  important = max(digest_pending.important, excluded.important),
+  events = digest_pending.events + 1
+"""
+
+OPEN_WINDOWS = f"""
+INSERT INTO digest_windows (subscription_id, opened_at, last_event_at)
+SELECT subscription_id, :now, :now FROM ({FOLLOWERS})
+WHERE true
+ON CONFLICT (subscription_id) DO UPDATE SET
+  last_event_at = excluded.last_event_at,
+  events = digest_windows.events + 1
+"""
+
+# Entries that netted out: added and removed again, or a price that flipped back
+DROP_CANCELLED = """
+DELETE FROM digest_pending WHERE store = :store AND product_id = :product_id
+  AND (kind IS NULL OR (kind = 'price' AND price IS first_price))
+"""
+
+DIGEST_TEXTS = {
+    'en': dict(notification_dispatch.TEXTS['en'],
+               subject="DHgate Monitor - Your store updates",
+               title="Store Updates - DHgate Monitor",
+               heading="Your store updates",
+               intro="Here is what changed in the stores you are monitoring.",
+               new="New", price="Price changed", removed="No longer available",
+               more="And {count} more changes in your dashboard."),
+    'nl': dict(notification_dispatch.TEXTS['nl'],
+               subject="DHgate Monitor - Je winkel updates",
+               title="Winkel Updates - DHgate Monitor",
+               heading="Je winkel updates",
+               intro="Dit is er veranderd in de winkels die je volgt.",
+               new="Nieuw", price="Prijs gewijzigd", removed="Niet meer beschikbaar",
+               more="En nog {count} wijzigingen in je dashboard."),
+}
+
+
+def format_price(value):
+    return f"US ${value:.2f}" if value is not None else ''
+
+
+def normalize_event(event):
+    """Validated event parameters for MERGE_EVENT"""
+    kind = event.get('kind')
+    if kind not in EVENT_KINDS:
+        raise signup_store.ValidationError(f"Unknown event kind: {kind!r}")
+    store = str(event.get('store') or '').strip()
+    product_id = str(event.get('product_id') or '').strip()
+    if not store or not product_id:
+        raise signup_store.ValidationError("Events need a store and a product_id")
+    price = event.get('price')
+    old_price = event.get('old_price') if kind != 'new' else None
+    price = float(price) if price is not None else None
+    old_price = float(old_price) if old_price is not None else None
+    if kind == 'removed' and old_price is None:
+        old_price = price
+    important = event.get('important')
+    if important is None:
+        important = kind == 'new' or (
+            kind == 'price' and price is not None and old_price
+            and (old_price - price) / old_price >= IMPORTANT_PRICE_DROP)
+    return {'store': store, 'product_id': product_id, 'kind': kind,
+            'title': event.get('title'), 'url': event.get('url'), 'price': price,
+            'old_price': old_price, 'important': int(bool(important)),
+            'levels': '["all", "important"]' if important else '["all"]',
+            'types': EVENT_MONITORING_TYPES[kind]}
+
+
+def _record_events(conn, events, now):
+    reached = 0
+    for params in events:
+        params['now'] = now
+        reached += conn.execute(MERGE_EVENT, params).rowcount
+        conn.execute(OPEN_WINDOWS, params)
+        conn.execute(DROP_CANCELLED, params)
+    return reached
+
+
+def _close_windows(conn, quiet_before, opened_before, max_events, limit, now):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS digest_due (subscription_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM digest_due")
+    conn.execute("INSERT INTO digest_due SELECT subscription_id FROM digest_windows "
+                 "WHERE last_event_at <= ? OR opened_at <= ? OR events >= ? LIMIT ?",
+                 (quiet_before, opened_before, max_events, limit))
+    closed = conn.execute(
+        "INSERT INTO digest_outbox (subscription_id, items, created_at) "
+        "SELECT subscription_id, json_group_array(json_object("
+        "'store', store, 'product_id', product_id, 'kind', kind, 'title', title, 'url', url, "
+        "'price', price, 'old_price', first_price, 'important', important)), ? "
+        "FROM (SELECT * FROM digest_pending "
+        "      WHERE subscription_id IN (SELECT subscription_id FROM digest_due) "
+        "      ORDER BY subscription_id, important DESC, store, product_id) "
+        "GROUP BY subscription_id", (now,)).rowcount
+    conn.execute("DELETE FROM digest_pending "
+                 "WHERE subscription_id IN (SELECT subscription_id FROM digest_due)")
+    due = conn.execute("DELETE FROM digest_windows "
+                       "WHERE subscription_id IN (SELECT subscription_id FROM digest_due)").rowcount
+    return closed, due
+
+
+def _claim_outbox(conn, now, lease, limit):
+    rows = conn.execute(
+        "UPDATE digest_outbox SET sending_until = ?, attempts = attempts + 1 "
+        "WHERE id IN (SELECT id FROM digest_outbox WHERE sending_until <= ? "
+        "             ORDER BY sending_until, id LIMIT ?) RETURNING id",
+        (now + lease, now, limit)).fetchall()
+    return [row[0] for row in rows]
+
+
+def _complete_outbox(conn, ids):
+    conn.execute("DELETE FROM digest_outbox WHERE id IN (SELECT value FROM json_each(?))",
+                 (json.dumps(ids),))
+    return conn.execute("DELETE FROM digest_outbox WHERE attempts >= ?", (MAX_ATTEMPTS,)).rowcount
+
+
+def render_item(item, lang):
+    """One digest product card"""
+    texts = DIGEST_TEXTS[lang]
+    price = format_price(item['price'])
+    if item['kind'] == 'price' and item['old_price'] is not None:
+        price = f"{format_price(item['old_price'])} → {price}"
+    elif item['kind'] == 'removed':
+        price = texts['removed']
+    title = item['title'] or item['product_id']
+    if item['kind'] in ('new', 'price'):
+        title = f"{texts[item['kind']]}: {title}"
+    return notification_dispatch.render_product(title, price, item['url'], texts['view'])
+
+
+def render_items(items, lang, max_items, cache=None):
+    """Digest product cards for one subscriber.
+
+    Followers of a store share most of their items, so cards are looked
+    up in `cache` (per flush) before being rendered.
+    """
+    cards = []
+    for item in items[:max_items]:
+        if cache is None:
+            cards.append(render_item(item, lang))
+            continue
+        key = (lang, item['store'], item['product_id'], item['kind'], item['title'], item['url'],
+               item['price'], item['old_price'])
+        card = cache.get(key)
+        if card is None:
+            card = cache[key] = render_item(item, lang)
+        cards.append(card)
+    if len(items) > max_items:
+        more = DIGEST_TEXTS[lang]['more'].format(count=len(items) - max_items)
+        cards.append(f"<p>{html.escape(more)}</p>\n")
+    return ''.join(cards)
+
+
+class DigestEngine:
+    """Coalesces store change events into one digest mail per subscriber.
+
+    Events fan out to the followers of their store into `digest_pending`,
+    one row per subscriber and product; repeated changes to a product are
+    merged in place, and entries that net out (a price that flips back, a
+    product added and removed again) are dropped. Subscribers whose
+    notification setting does not want an event are filtered out by the
+    same statement, so skipped events cost no rows.
+
+    A subscriber's window closes after `window` seconds without new
+    events, `max_age` seconds after it opened, or once `max_events` events
+    arrived. Closing moves the entries to `digest_outbox` in one
+    transaction; outbox rows are leased while being sent and only deleted
+    once the mail was accepted (or permanently refused), so a crash at
+    any point loses nothing and at worst repeats a digest.
+
+    All writes go through the SignupStore writer thread, so they share its
+    group commits.
+    """
+
+    def __init__(self, store, window=900.0, max_age=3600.0, max_events=100, max_items=25,
+                 lease=600.0, batch_size=500):
+        self.store = store
+        self.window = window
+        self.max_age = max_age
+        self.max_events = max_events
+        self.max_items = max_items
+        self.lease = lease
+        self.batch_size = batch_size
+
+    def initialize(self):
+        conn = self.store.connect()
+        try:
+            conn.executescript(DIGEST_SCHEMA)
+        finally:
+            conn.close()
+
+    def record(self, events, now=None):
+        """Buffer change events; returns how many pending entries they touched"""
+        events = [normalize_event(event) for event in events]
+        if not events:
+            return 0
+        return self.store.submit(_record_events, events, now or time.time())
+
+    def close_windows(self, now=None):
+        """Move every due window to the outbox; returns the number of digests created"""
+        now = now or time.time()
+        created = 0
+        while True:
+            closed, due = self.store.submit(_close_windows, now - self.window, now - self.max_age,
+                                            self.max_events, self.batch_size, now)
+            created += closed
+            if due < self.batch_size:
+                return created
+
+    def flush(self, dispatcher, now=None):
+        """Close due windows and send the outbox through `dispatcher` in batches"""
+        now = now or time.time()
+        stats = {'digests': self.close_windows(now), 'sent': 0, 'failed': 0, 'deferred': 0}
+        templates = notification_dispatch.render_templates(DIGEST_TEXTS, dispatcher.sender)
+        cards = {}
+        while True:
+            claimed = self.store.submit(_claim_outbox, now, self.lease, self.batch_size)
+            if not claimed:
+                return stats
+            deferred = set()
+
+            def on_result(message, outcome):
+                if outcome == 'deferred':
+                    deferred.add(message[2])
+
+            messages = self._messages(dispatcher, templates, claimed, cards)
+            result = dispatcher.send(messages, on_result)
+            stats['sent'] += result['sent']
+            stats['failed'] += result['failed']
+            stats['deferred'] += len(deferred)
+            # Sent, refused and no-longer-wanted digests are done; deferred ones
+            # keep their lease and are retried by a later flush
+            self.store.submit(_complete_outbox, [i for i in claimed if i not in deferred])
+
+    def _messages(self, dispatcher, templates, claimed, cards):
+        rows = self.store.reader().execute(
+            "SELECT o.id, s.id, s.email, s.lang, s.unsubscribe_token, s.dashboard_token, o.items "
+            "FROM digest_outbox o JOIN subscriptions s ON s.id = o.subscription_id "
+            "WHERE o.id IN (SELECT value FROM json_each(?)) AND s.subscribed = 1 "
+            "AND s.unsubscribe_token IS NOT NULL AND coalesce(s.notifications, 'all') != 'none'",
+            (json.dumps(claimed),)).fetchall()
+        for outbox_id, *subscriber, items in rows:
+            lang = subscriber[2] if subscriber[2] in templates else 'en'
+            products = render_items(json.loads(items), lang, self.max_items, cards)
+            email, data = dispatcher.message(templates, subscriber, products=products)
+            yield email, data, outbox_id
+
+    def stats(self):
+        conn = self.store.reader()
+        return {table: conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+                for table in ('digest_pending', 'digest_windows', 'digest_outbox')}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Buffer store changes and send DHgate Monitor digests")
+    parser.add_argument("--events", help="JSON file with change events to buffer first")
+    parser.add_argument("--window", type=float, default=900.0,
+                        help="seconds without new events before a digest closes")
+    parser.add_argument("--max-age", type=float, default=3600.0,
+                        help="seconds after its first event a digest closes regardless")
+    parser.add_argument("--max-events", type=int, default=100,
+                        help="events after which a digest closes early")
+    parser.add_argument("--loop", type=float, default=0,
+                        help="keep flushing every this many seconds")
+    notification_dispatch.add_smtp_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    store = signup_store.SignupStore(args.db)
+    store.initialize()
+    engine = DigestEngine(store, args.window, args.max_age, args.max_events)
+    engine.initialize()
+    dispatcher = notification_dispatch.build_dispatcher(args, store)
+    try:
+        if args.events:
+            with open(args.events, encoding='utf-8') as f:
+                print(f"📥 {engine.record(json.load(f))} wijzigingen gebufferd")
+        while True:
+            stats = engine.flush(dispatcher)
+            print(f"📧 {stats['digests']} digests klaar, {stats['sent']} verstuurd, "
+                  f"{stats['failed']} mislukt, {stats['deferred']} uitgesteld")
+            if not args.loop:
+                return 1 if stats['failed'] else 0
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        dispatcher.pool.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
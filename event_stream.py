@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor live events
+Server-Sent Events voor dashboard en admin meldingen in plaats van polling
+"""
+
+import collections
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+
+EVENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  channel TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  data TEXT NOT NULL,
+  created_at REAL NOT NULL
+);
+"""
+
+ADMIN_CHANNEL = 'admin'
+PUBLIC_CHANNEL = 'public'
+
+# Sent before any event: browsers wait this long before reconnecting
+RETRY_FRAME = b"retry: 3000\n\n"
+HEARTBEAT_FRAME = b": ping\n\n"
+# Tells a resuming client that events were lost and it should reload its state
+RESET_FRAME = b"event: reset\ndata: {}\n\n"
+
+
+def store_channel(store):
+    return f"store:{store}"
+
+
+def subscription_channel(subscription_id):
+    return f"subscription:{subscription_id}"
+
+
+def format_event(event_id, kind, data):
+    """One SSE frame; `data` is a JSON text and never contains newlines"""
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n".encode('utf-8')
+
+
+def _publish(conn, channel, kind, data, now):
+    return conn.execute("INSERT INTO events (channel, kind, data, created_at) VALUES (?, ?, ?, ?)",
+                        (channel, kind, data, now)).lastrowid
+
+
+def _prune_events(conn, keep):
+    conn.execute("DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?", (keep,))
+
+
+def initialize(store):
+    conn = store.connect()
+    try:
+        conn.executescript(EVENT_SCHEMA)
+    finally:
+        conn.close()
+
+
+def publish(store, channel, kind, payload):
+    """Append an event from any process; live streams pick it up on their next poll"""
+    return store.submit(_publish, channel, kind, json.dumps(payload, ensure_ascii=False), time.time())
+
+
+class EventSubscriber:
+    """One stream's channels and its bounded buffer of unsent frames.
+
+    `buffered` counts bytes pushed but not yet written to the socket, so a
+    client that stops reading fills it up and is closed as a slow consumer
+    instead of growing the buffer without limit. `wakeup` is called after
+    every push; the engine serving the stream sets it.
+    """
+
+    __slots__ = ('channels', 'after', 'max_buffer', 'frames', 'buffered', 'closed', 'slow',
+                 'wakeup', '_lock')
+
+    def __init__(self, channels, after, max_buffer):
+        self.channels = channels
+        self.after = after
+        self.max_buffer = max_buffer
+        self.frames = []
+        self.buffered = 0
+        self.closed = False
+        self.slow = False
+        self.wakeup = None
+        self._lock = threading.Lock()
+
+    def push(self, frame, force=False):
+        """Queue a frame; False once the subscriber is closed"""
+        with self._lock:
+            if self.closed:
+                return False
+            if not force and self.buffered + len(frame) > self.max_buffer:
+                self.closed = self.slow = True
+                self.frames.clear()
+            else:
+                self.frames.append(frame)
+                self.buffered += len(frame)
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+        return not self.closed
+
+    def take(self):
+        """All queued frames as one write"""
+        with self._lock:
+            data = b''.join(self.frames)
+            self.frames.clear()
+        return data
+
+    def sent(self, count):
+        with self._lock:
+            self.buffered -= count
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        wakeup = self.wakeup
+        if wakeup is not None:
+            wakeup()
+
+
+class EventBroadcaster:
+    """Fans events out to every open stream of this process.
+
+    Events live in the `events` table, so any process (the crawler, another
+    pre-fork worker) can publish them and ids are the same everywhere. One
+    poller thread per process reads new rows with a single primary-key
+    range query and pushes each pre-encoded frame to the subscribers of its
+    channel; thousands of idle streams cost one query per poll interval
+    instead of one request each. Events published in this process wake the
+    poller right after their commit.
+
+    The last `history` frames stay in a ring buffer for Last-Event-ID
+    resume; older ids are replayed from the table while it still has them
+    and answered with a reset event once they were pruned.
+    """
+
+    def __init__(self, store, history=1024, poll_interval=1.0, max_buffer=64 * 1024,
+                 max_replay=1000, retention=100000):
+        self.store = store
+        self.history = history
+        self.poll_interval = poll_interval
+        self.max_buffer = max_buffer
+        self.max_replay = max_replay
+        self.retention = retention
+        self._ring = collections.deque(maxlen=history)  # (id, channel, frame)
+        self._channels = {}  # channel -> set of subscribers
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.last_id = 0
+        self.published = 0
+        self.delivered = 0
+        self.slow_disconnects = 0
+
+    def configure(self, poll_interval=None, max_buffer=None):
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        if max_buffer is not None:
+            self.max_buffer = max_buffer
+
+    def initialize(self):
+        initialize(self.store)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # Threads and subscribers do not survive fork()
+                self._ring.clear()
+                self._channels = {}
+                self.last_id = self.store.reader().execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+                threading.Thread(target=self._run, name="dhgate-event-poller", daemon=True).start()
+                self._pid = os.getpid()
+
+    def publish(self, channel, kind, payload):
+        """Publish without waiting for the commit; subscribers get it right after"""
+        self._ensure_started()
+        future = self.store.submit_async(_publish, channel, kind,
+                                         json.dumps(payload, ensure_ascii=False), time.time())
+        future.add_done_callback(lambda _: self._wake.set())
+        return future
+
+    def subscribe(self, channels, last_event_id=None):
+        """Register a subscriber, with any frames it missed since last_event_id queued"""
+        self._ensure_started()
+        subscriber = EventSubscriber(frozenset(channels), 0, self.max_buffer)
+        subscriber.push(RETRY_FRAME, force=True)
+        with self._lock:
+            # Ids up to `after` are either replayed below or already seen by the client
+            subscriber.after = max(self.last_id, last_event_id or 0)
+            if last_event_id is not None and last_event_id < self.last_id:
+                for frame in self._replay(subscriber, last_event_id):
+                    subscriber.push(frame, force=True)
+            for channel in subscriber.channels:
+                self._channels.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def _replay(self, subscriber, last_event_id):
+        oldest = self._ring[0][0] if self._ring else self.last_id + 1
+        frames = []
+        if last_event_id + 1 < oldest:
+            # Older than the ring: read the gap from the table (rare, so under the lock)
+            rows = self.store.reader().execute(
+                "SELECT id, channel, kind, data FROM events WHERE id > ? AND id < ? "
+                "AND channel IN (SELECT value FROM json_each(?)) ORDER BY id LIMIT ?",
+                (last_event_id, oldest, json.dumps(sorted(subscriber.channels)),
+                 self.max_replay + 1)).fetchall()
+            first = self.store.reader().execute("SELECT MIN(id) FROM events").fetchone()[0]
+            if first is None or first > last_event_id + 1 or len(rows) > self.max_replay:
+                return [RESET_FRAME]
+            frames = [format_event(event_id, kind, data) for event_id, _, kind, data in rows]
+        frames += [frame for event_id, channel, frame in self._ring
+                   if event_id > last_event_id and channel in subscriber.channels]
+        if len(frames) > self.max_replay:
+            return [RESET_FRAME]
+        return frames
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            self._discard(subscriber)
+
+    def _discard(self, subscriber):
+        for channel in subscriber.channels:
+            members = self._channels.get(channel)
+            if members is not None:
+                members.discard(subscriber)
+                if not members:
+                    del self._channels[channel]
+
+    def _run(self):
+        pruned = time.monotonic()
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.poll()
+                if time.monotonic() - pruned > 60:
+                    pruned = time.monotonic()
+                    self.store.submit_async(_prune_events, self.retention)
+            except Exception as e:
+                print(f"❌ Events ophalen mislukt: {e}")
+                time.sleep(self.poll_interval)
+
+    def poll(self):
+        """Fan out every event committed since the last poll"""
+        while True:
+            rows = self.store.reader().execute(
+                "SELECT id, channel, kind, data FROM events WHERE id > ? ORDER BY id LIMIT 500",
+                (self.last_id,)).fetchall()
+            if not rows:
+                return
+            with self._lock:
+                for event_id, channel, kind, data in rows:
+                    frame = format_event(event_id, kind, data)
+                    self._ring.append((event_id, channel, frame))
+                    self.last_id = event_id
+                    self.published += 1
+                    for subscriber in list(self._channels.get(channel, ())):
+                        if event_id <= subscriber.after:
+                            continue
+                        if subscriber.push(frame):
+                            self.delivered += 1
+                        else:
+                            self.slow_disconnects += subscriber.slow
+                            self._discard(subscriber)
+
+    def heartbeat(self, subscriber):
+        if not subscriber.push(HEARTBEAT_FRAME):
+            with self._lock:
+                self.slow_disconnects += subscriber.slow
+                self._discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            subscribers = set()
+            for members in self._channels.values():
+                subscribers.update(members)
+        return {'subscribers': len(subscribers), 'published': self.published,
+                'delivered': self.delivered, 'slow_disconnects': self.slow_disconnects}
+
+
+class _Stream:
+    __slots__ = ('sock', 'subscriber', 'pending', 'last_write', 'events')
+
+    def __init__(self, sock, subscriber):
+        self.sock = sock
+        self.subscriber = subscriber
+        self.pending = b''
+        self.last_write = time.monotonic()
+        self.events = selectors.EVENT_READ
+
+
+class EventStreamLoop:
+    """Writes event streams for the threaded engines from one selector thread.
+
+    A request handler writes the response head, detaches the socket and
+    hands it over here, so an open stream holds no handler thread. Writes
+    are non-blocking: whatever a client does not accept stays pending and
+    counts against its subscriber's buffer. Reading EOF or an error closes
+    the stream; idle streams get a heartbeat comment every `heartbeat`
+    seconds, which also finds dead peers.
+    """
+
+    def __init__(self, broadcaster, heartbeat=15.0):
+        self.broadcaster = broadcaster
+        self.heartbeat = heartbeat
+        self._streams = {}  # fileno -> _Stream
+        self._incoming = collections.deque()
+        self._ready = set()
+        self._ready_lock = threading.Lock()
+        self._selector = None
+        self._waker = None
+        self._wake_pending = False
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def open_streams(self):
+        return len(self._streams)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._selector = selectors.DefaultSelector()
+                wake_reader, self._waker = socket.socketpair()
+                wake_reader.setblocking(False)
+                self._waker.setblocking(False)
+                self._selector.register(wake_reader, selectors.EVENT_READ)
+                self._streams = {}
+                threading.Thread(target=self._run, args=(wake_reader,),
+                                 name="dhgate-event-streams", daemon=True).start()
+                self._pid = os.getpid()
+
+    def attach(self, sock, subscriber):
+        """Take over a connection whose response head has been sent"""
+        self._ensure_started()
+        sock.setblocking(False)
+        stream = _Stream(sock, subscriber)
+        subscriber.wakeup = lambda: self._notify(stream)
+        self._incoming.append(stream)
+        self._notify(stream)
+
+    def _notify(self, stream):
+        with self._ready_lock:
+            self._ready.add(stream)
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            self._waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self, wake_reader):
+        next_beat = time.monotonic() + 1
+        while True:
+            for key, mask in self._selector.select(timeout=1.0):
+                if key.fileobj is wake_reader:
+                    try:
+                        while wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                stream = key.data
+                if mask & selectors.EVENT_READ and not self._read(stream):
+                    self._drop(stream)
+                elif mask & selectors.EVENT_WRITE:
+                    self._flush(stream)
+            while self._incoming:
+                stream = self._incoming.popleft()
+                self._streams[stream.sock.fileno()] = stream
+                self._selector.register(stream.sock, stream.events, stream)
+            with self._ready_lock:
+                ready, self._ready = self._ready, set()
+                self._wake_pending = False
+            for stream in ready:
+                if stream.sock.fileno() in self._streams:
+                    self._flush(stream)
+            now = time.monotonic()
+            if now >= next_beat:
+                next_beat = now + 1
+                for stream in list(self._streams.values()):
+                    if now - stream.last_write >= self.heartbeat:
+                        stream.last_write = now
+                        self.broadcaster.heartbeat(stream.subscriber)
+
+    def _read(self, stream):
+        """Discard anything the client sends; False on EOF or error"""
+        try:
+            return bool(stream.sock.recv(4096))
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _flush(self, stream):
+        subscriber = stream.subscriber
+        if subscriber.closed:
+            self._drop(stream)
+            return
+        data = stream.pending + subscriber.take()
+        sent = 0
+        if data:
+            try:
+                sent = stream.sock.send(data)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._drop(stream)
+                return
+            subscriber.sent(sent)
+            stream.last_write = time.monotonic()
+        stream.pending = data[sent:]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if stream.pending else 0)
+        if events != stream.events:
+            stream.events = events
+            self._selector.modify(stream.sock, events, stream)
+
+    def _drop(self, stream):
+        if self._streams.pop(stream.sock.fileno(), None) is None:
+            return
+        self._selector.unregister(stream.sock)
+        self.broadcaster.unsubscribe(stream.subscriber)
+        try:
+            stream.sock.close()
+        except OSError:
+            pass
@@ -17,10 +17,82 @@ CREATE TABLE IF NOT EXISTS subscriptions (
   dashboard_access BOOLEAN DEFAULT 1,
   subscribed BOOLEAN DEFAULT 1,
   email_marketing_consent BOOLEAN DEFAULT 1,
+  notifications TEXT DEFAULT 'all',
   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
   last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Opzoeken van een bestaande inschrijving bij een nieuwe signup
+CREATE INDEX IF NOT EXISTS idx_subscriptions_email ON subscriptions (email);
+
+-- Tokens uit unsubscribe- en dashboardlinks worden met een index opgezocht.
+-- Niet UNIQUE: de Worker maakt tokens uit het e-mailadres en schrijft met
+-- INSERT OR REPLACE, dus bestaande D1 data kan dubbele tokens bevatten en een
+-- unieke index zou de migratie of latere signups laten falen. Alleen de lokale
+-- SQLite store (signup_store.py) maakt tokens uniek, na het vernieuwen van dubbelen.
+-- Eerder uitgerolde unieke indexen met deze namen worden vervangen.
+DROP INDEX IF EXISTS idx_subscriptions_unsubscribe_token;
+DROP INDEX IF EXISTS idx_subscriptions_dashboard_token;
+CREATE INDEX IF NOT EXISTS idx_subscriptions_unsubscribe_token_lookup ON subscriptions (unsubscribe_token);
+CREATE INDEX IF NOT EXISTS idx_subscriptions_dashboard_token_lookup ON subscriptions (dashboard_token);
+
+-- Fan-out index voor "wie volgt winkel X": een rij per actieve inschrijving
+-- per winkel/tag, door triggers synchroon gehouden met de JSON kolommen
+CREATE TABLE IF NOT EXISTS subscription_stores (
+  subscription_id INTEGER NOT NULL,
+  store TEXT NOT NULL,
+  PRIMARY KEY (subscription_id, store)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_subscription_stores_store ON subscription_stores (store, subscription_id);
+
+CREATE TABLE IF NOT EXISTS subscription_tags (
+  subscription_id INTEGER NOT NULL,
+  tag TEXT NOT NULL,
+  PRIMARY KEY (subscription_id, tag)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_subscription_tags_tag ON subscription_tags (tag, subscription_id);
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_insert
+AFTER INSERT ON subscriptions WHEN NEW.subscribed
+BEGIN
+  INSERT OR IGNORE INTO subscription_stores (subscription_id, store)
+    SELECT NEW.id, value FROM json_each(CASE WHEN json_valid(NEW.stores) THEN NEW.stores ELSE '[]' END)
+    WHERE type = 'text';
+  INSERT OR IGNORE INTO subscription_tags (subscription_id, tag)
+    SELECT NEW.id, lower(value) FROM json_each(CASE WHEN json_valid(NEW.tags) THEN NEW.tags ELSE '[]' END)
+    WHERE type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_update
+AFTER UPDATE OF stores, tags, subscribed ON subscriptions
+BEGIN
+  DELETE FROM subscription_stores WHERE subscription_id = OLD.id;
+  DELETE FROM subscription_tags WHERE subscription_id = OLD.id;
+  INSERT OR IGNORE INTO subscription_stores (subscription_id, store)
+    SELECT NEW.id, value FROM json_each(CASE WHEN json_valid(NEW.stores) THEN NEW.stores ELSE '[]' END)
+    WHERE type = 'text' AND NEW.subscribed;
+  INSERT OR IGNORE INTO subscription_tags (subscription_id, tag)
+    SELECT NEW.id, lower(value) FROM json_each(CASE WHEN json_valid(NEW.tags) THEN NEW.tags ELSE '[]' END)
+    WHERE type = 'text' AND NEW.subscribed;
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_delete
+AFTER DELETE ON subscriptions
+BEGIN
+  DELETE FROM subscription_stores WHERE subscription_id = OLD.id;
+  DELETE FROM subscription_tags WHERE subscription_id = OLD.id;
+END;
+
+-- Bestaande inschrijvingen indexeren (idempotent)
+INSERT OR IGNORE INTO subscription_stores (subscription_id, store)
+  SELECT s.id, j.value FROM subscriptions s, json_each(s.stores) j
+  WHERE s.subscribed AND json_valid(s.stores) AND j.type = 'text';
+INSERT OR IGNORE INTO subscription_tags (subscription_id, tag)
+  SELECT s.id, lower(j.value) FROM subscriptions s, json_each(s.tags) j
+  WHERE s.subscribed AND json_valid(s.tags) AND j.type = 'text';
+
 -- Voeg een paar testgebruikers toe
 INSERT INTO users (email) VALUES ('alice@example.com');
 INSERT INTO users (email) VALUES ('bob@example.com');
@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor notificatie verzending
+Streamt abonnees uit de subscriptions tabel en verstuurt product e-mails
+over een pool van blijvende SMTP verbindingen
+"""
+
+import argparse
+import binascii
+import contextlib
+import html
+import json
+import os
+import queue
+import random
+import re
+import smtplib
+import ssl
+import string
+import sys
+import threading
+import time
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+import signup_store
+
+DEFAULT_SENDER = "noreply@dhgate-monitor.com"
+DEFAULT_SMTP_HOST = "smtp.gmail.com"
+DEFAULT_SMTP_PORT = 587
+BASE_URL = "https://dhgate-monitor.com"
+
+# Same subjects as sendProductNotificationEmail in cloudflare_app.js
+TEXTS = {
+    'en': {
+        'subject': "DHgate Monitor - New products found!",
+        'title': "New Products - DHgate Monitor",
+        'heading': "New products found!",
+        'intro': "We found new products in the stores you are monitoring.",
+        'view': "View product",
+        'cta_heading': "Manage your monitoring",
+        'cta_text': "Change your stores, tags and notification settings in your dashboard.",
+        'cta_button': "Open dashboard",
+        'footer': "You receive this email because you subscribed to DHgate Monitor.",
+        'unsubscribe': "Unsubscribe",
+    },
+    'nl': {
+        'subject': "DHgate Monitor - Nieuwe producten gevonden!",
+        'title': "Nieuwe Producten - DHgate Monitor",
+        'heading': "Nieuwe producten gevonden!",
+        'intro': "We hebben nieuwe producten gevonden in de winkels die je volgt.",
+        'view': "Bekijk product",
+        'cta_heading': "Beheer je monitoring",
+        'cta_text': "Pas je winkels, tags en notificatie-instellingen aan in je dashboard.",
+        'cta_button': "Open dashboard",
+        'footer': "Je ontvangt deze e-mail omdat je bent aangemeld bij DHgate Monitor.",
+        'unsubscribe': "Uitschrijven",
+    },
+}
+
+# Trimmed-down generateProductNotificationEmailHTML; $placeholders are
+# filled per language, $products per notification and the links per recipient
+EMAIL_LAYOUT = string.Template("""<!DOCTYPE html>
+<html lang="$lang">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>$title</title>
+<style>
+body { font-family: 'Raleway', -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif;
+       margin: 0; padding: 0; background: #f1f5f9; line-height: 1.6; }
+.email-container { max-width: 600px; margin: 40px auto; background: white;
+                   border-radius: 20px; overflow: hidden; }
+.header { background: linear-gradient(135deg, #EA580C 0%, #f97316 50%, #ea580c 100%);
+          padding: 50px 40px; text-align: center; color: white; }
+.content { padding: 40px; color: #333; }
+.product-card { background: #f8fafc; border: 1px solid #e2e8f0; border-radius: 16px;
+                padding: 24px; margin-bottom: 24px; }
+.product-title { color: #1e293b; font-size: 18px; font-weight: 600; margin: 0 0 12px 0; }
+.product-price { color: #059669; font-size: 20px; font-weight: 700; margin: 0 0 16px 0; }
+.product-link, .cta-button { display: inline-block; background: linear-gradient(135deg, #2563EB, #1e40af);
+                             color: white !important; padding: 12px 20px; text-decoration: none;
+                             border-radius: 8px; font-weight: 600; }
+.cta-section { text-align: center; background: #f8fafc; border: 1px solid #e2e8f0;
+               border-radius: 16px; padding: 32px 24px; margin: 40px 0; }
+.footer { padding: 24px 40px; text-align: center; color: #64748b; font-size: 13px; }
+.footer a { color: #64748b; }
+</style>
+</head>
+<body>
+<div class="email-container">
+<div class="header"><h1>$heading</h1></div>
+<div class="content">
+<p>$intro</p>
+$products
+<div class="cta-section">
+<h3>$cta_heading</h3>
+<p>$cta_text</p>
+<a href="$dashboard_url" class="cta-button">$cta_button</a>
+</div>
+</div>
+<div class="footer">
+<p>$footer</p>
+<p><a href="$unsubscribe_url">$unsubscribe</a></p>
+</div>
+</div>
+</body>
+</html>
+""")
+
+PRODUCT_CARD = string.Template("""<div class="product-card">
+<div class="product-title">$title</div>
+<div class="product-price">$price</div>
+<a href="$url" class="product-link">$view</a>
+</div>
+""")
+
+# Header fields are filled raw, everything after the blank line as quoted-printable
+HEADER_LAYOUT = string.Template(
+    "From: DHgate Monitor <$sender>\r\n"
+    "To: $${to}\r\n"
+    "Subject: $subject\r\n"
+    "Date: $${date}\r\n"
+    "Message-ID: $${message_id}\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/html; charset=\"utf-8\"\r\n"
+    "Content-Transfer-Encoding: quoted-printable\r\n"
+    "List-Unsubscribe: <$${unsubscribe_url}>\r\n"
+    "List-Unsubscribe-Post: List-Unsubscribe=One-Click\r\n"
+    "\r\n")
+
+MAX_TITLE_LENGTH = 300
+DOT_STUFFING = re.compile(rb'^\.', re.MULTILINE)
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _qp(text):
+    """Quoted-printable encode text as UTF-8 with CRLF line ends"""
+    return binascii.b2a_qp(text.replace('\r\n', '\n').replace('\n', '\r\n').encode('utf-8'))
+
+
+class CompiledTemplate:
+    """A message template split once into literal byte chunks and field slots.
+
+    Filling it per recipient is a single join: the literal chunks are
+    encoded and dot-stuffed up front, and only the short field values are
+    encoded per message. Body fields are quoted-printable encoded between
+    soft line breaks, so they never push an encoded line past 76 columns.
+    """
+
+    def __init__(self, header, body):
+        self.parts = []
+        self._compile(header, encode=False)
+        self._compile(body, encode=True)
+        if not self.parts[-1].endswith(b'\r\n'):
+            self.parts[-1] += b'\r\n'
+
+    def _compile(self, text, encode):
+        position = 0
+        literal = ''
+        for match in string.Template.pattern.finditer(text):
+            literal += text[position:match.start()]
+            position = match.end()
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                # $$ or a stray $ stays a literal dollar sign
+                literal += '$' + text[match.start() + 1:position].lstrip('$')
+                continue
+            self._literal(literal, encode)
+            self.parts.append((name, encode))
+            literal = ''
+        self._literal(literal + text[position:], encode)
+
+    def _literal(self, text, encode):
+        data = _qp(text) if encode else text.encode('ascii')
+        data = DOT_STUFFING.sub(b'..', data)
+        if self.parts and isinstance(self.parts[-1], bytes):
+            self.parts[-1] += data
+        else:
+            self.parts.append(data)
+
+    def fill(self, fields):
+        chunks = []
+        for part in self.parts:
+            if isinstance(part, bytes):
+                chunks.append(part)
+                continue
+            name, encode = part
+            value = fields[name]
+            if encode:
+                value = b'=\r\n' + DOT_STUFFING.sub(b'..', _qp(value)) + b'=\r\n'
+            else:
+                value = value.encode('utf-8')
+            chunks.append(value)
+        return b''.join(chunks)
+
+
+def render_product(title, price, url, view):
+    """One product card"""
+    return PRODUCT_CARD.substitute(
+        title=html.escape(str(title or '')[:MAX_TITLE_LENGTH]), price=html.escape(str(price or '')),
+        url=html.escape(str(url or BASE_URL)), view=html.escape(view))
+
+
+def render_products(products, lang):
+    """Product cards HTML for one language"""
+    view = TEXTS[lang]['view']
+    return ''.join(render_product(product.get('title'), product.get('price'), product.get('url'),
+                                  view) for product in products)
+
+
+def render_templates(texts, sender=DEFAULT_SENDER, products=None):
+    """{lang: CompiledTemplate} for the given per-language texts.
+
+    `products` maps each language to its rendered cards; without it
+    $products stays a field that is filled per recipient.
+    """
+    templates = {}
+    for lang, fields in texts.items():
+        subject = fields['subject']
+        if not subject.isascii():
+            subject = Header(subject, 'utf-8').encode()
+        header = HEADER_LAYOUT.substitute(sender=sender, subject=subject)
+        fields = dict(fields, lang=lang)
+        if products is not None:
+            # Doubled so a "US $12.99" price is not read as a field
+            fields['products'] = products[lang].replace('$', '$$')
+        templates[lang] = CompiledTemplate(header, EMAIL_LAYOUT.safe_substitute(fields))
+    return templates
+
+
+def render_notification(products, sender=DEFAULT_SENDER):
+    """{lang: CompiledTemplate} for one product notification, rendered once per language"""
+    return render_templates(TEXTS, sender, {lang: render_products(products, lang) for lang in TEXTS})
+
+
+def stream_subscribers(conn, stores=None, tags=None, important=False, page_size=500):
+    """Yield (id, email, lang, unsubscribe_token, dashboard_token) of subscribers to notify.
+
+    Walks the table in id order one page at a time, so memory stays flat
+    and no read transaction is held open while mail goes out. `stores` or
+    `tags` narrow the walk through the fan-out junction tables; rows whose
+    notification setting excludes this kind of mail are never read.
+    """
+    levels = ['all', 'important'] if important else ['all']
+    query = ("SELECT s.id, s.email, s.lang, s.unsubscribe_token, s.dashboard_token "
+             "FROM subscriptions s WHERE s.id > ? AND s.subscribed = 1 "
+             # Every mail carries a one-click unsubscribe link, so rows without a token are skipped
+             "AND s.unsubscribe_token IS NOT NULL "
+             "AND coalesce(s.notifications, 'all') IN (SELECT value FROM json_each(?))")
+    params = [json.dumps(levels)]
+    if stores is not None:
+        query += (" AND s.id IN (SELECT subscription_id FROM subscription_stores "
+                  "WHERE store IN (SELECT value FROM json_each(?)))")
+        params.append(json.dumps(list(stores)))
+    if tags is not None:
+        query += (" AND s.id IN (SELECT subscription_id FROM subscription_tags "
+                  "WHERE tag IN (SELECT value FROM json_each(?)))")
+        params.append(json.dumps([tag.lower() for tag in tags]))
+    query += " ORDER BY s.id LIMIT ?"
+    last_id = 0
+    while True:
+        rows = conn.execute(query, [last_id, *params, page_size]).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+
+class RateLimiter:
+    """Token bucket capping messages per minute across all sending threads.
+
+    A caller may take more tokens than are available; the bucket goes into
+    debt and the caller sleeps until it is paid off, so whole batches can
+    be admitted at once while the long-run rate still holds.
+    """
+
+    def __init__(self, per_minute=0):
+        self.rate = per_minute / 60.0
+        self.burst = max(1.0, per_minute / 6.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class SMTPConnection:
+    """One persistent SMTP session that sends batches of messages.
+
+    When the server advertises PIPELINING (RFC 2920) a message costs one
+    round trip: its content, the end-of-data dot and the next message's
+    MAIL FROM / RCPT TO / DATA go out in a single write, and the replies
+    are read back in order. Other servers get one command per round trip.
+    """
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+        self.pipelining = smtp.has_extn('pipelining')
+
+    def send_batch(self, sender, messages, results):
+        """Send [(recipient, data, ...)]; fills results[i] with the (code, reply) of message i.
+
+        Raises on connection failure; results filled so far stay valid.
+        """
+        if self.pipelining:
+            self._send_pipelined(sender, messages, results)
+        else:
+            for index, message in enumerate(messages):
+                results[index] = self._sendmail(sender, message[0], message[1])
+        self.sent += len(messages)
+        self.last_used = time.monotonic()
+
+    def _sendmail(self, sender, recipient, data):
+        # Not smtplib's sendmail(): data is already dot-stuffed and would be stuffed twice
+        for reply in (self.smtp.mail(sender), self.smtp.rcpt(recipient)):
+            if reply[0] >= 300:
+                self.smtp.rset()
+                return reply
+        reply = self.smtp.docmd('DATA')
+        if reply[0] != 354:
+            self.smtp.rset()
+            return reply
+        self.smtp.send(data + b'.\r\n')
+        return self.smtp.getreply()
+
+    def _send_pipelined(self, sender, messages, results):
+        envelope_from = b'MAIL FROM:<' + sender.encode('ascii') + b'>\r\n'
+        carry, carry_replies = b'', []
+        for index in range(len(messages) + 1):
+            group, replies = carry, carry_replies
+            if index < len(messages):
+                recipient = messages[index][0].encode('utf-8')
+                group += envelope_from + b'RCPT TO:<' + recipient + b'>\r\nDATA\r\n'
+                replies = replies + ['mail', 'rcpt', 'data']
+            if not group:
+                return
+            self.smtp.send(group)
+            carry, carry_replies = b'', []
+            envelope = []
+            for kind in replies:
+                reply = self.smtp.getreply()
+                if isinstance(kind, int):
+                    results[kind] = reply
+                elif kind in ('mail', 'rcpt', 'data'):
+                    envelope.append(reply)
+            if index == len(messages):
+                return
+            (mail, _), (rcpt, _), (data, _) = envelope
+            if mail < 300 and rcpt < 300 and data == 354:
+                carry, carry_replies = messages[index][1] + b'.\r\n', [index]
+                continue
+            results[index] = next(reply for reply in envelope if reply[0] >= 300)
+            if data == 354:
+                # Server took DATA without a valid envelope; end it empty
+                carry, carry_replies = b'.\r\n', ['ignore']
+            elif mail < 300:
+                carry, carry_replies = b'RSET\r\n', ['ignore']
+
+    def noop(self):
+        return self.smtp.noop()[0] == 250
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+
+class SMTPConnectionPool:
+    """Bounded pool of logged-in SMTP sessions, reused across batches.
+
+    Sessions are opened lazily, handed out most-recently-used first, checked
+    with NOOP after sitting idle and recycled after `max_messages` so no
+    single session runs into the server's per-connection limits. A session
+    that raised is closed instead of going back to the pool.
+    """
+
+    def __init__(self, host=DEFAULT_SMTP_HOST, port=DEFAULT_SMTP_PORT, username=None,
+                 password=None, starttls=True, size=4, timeout=30.0, max_messages=500,
+                 idle_check=30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.idle_check = idle_check
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self.opened = 0
+
+    def _open(self):
+        if self.port == smtplib.SMTP_SSL_PORT:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                    context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.starttls and smtp.has_extn('starttls'):
+                smtp.starttls(context=ssl.create_default_context())
+                smtp.ehlo()
+            if self.username:
+                smtp.login(self.username, self.password or '')
+        except BaseException:
+            smtp.close()
+            raise
+        self.opened += 1
+        return SMTPConnection(smtp)
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if time.monotonic() - conn.last_used < self.idle_check:
+                return conn
+            try:
+                if conn.noop():
+                    return conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            conn.close()
+        return self._open()
+
+    @contextlib.contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            conn = self._checkout()
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            if conn.sent >= self.max_messages:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class NotificationDispatcher:
+    """Streams rendered notifications through the SMTP pool.
+
+    The calling thread reads subscribers and fills templates into batches
+    on a bounded queue; one sender thread per pool slot drains it. A full
+    queue blocks the reader, so at most a few batches are ever in memory.
+    4xx replies and dropped connections are retried with jittered
+    exponential backoff up to `max_attempts`; 5xx replies fail the message
+    at once. A message whose connection dropped after its content was
+    written may be delivered twice.
+    """
+
+    def __init__(self, store, pool, sender=DEFAULT_SENDER, base_url=BASE_URL, batch_size=50,
+                 rate_per_minute=0, max_attempts=4, backoff=1.0):
+        self.store = store
+        self.pool = pool
+        self.sender = sender
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = batch_size
+        self.limiter = RateLimiter(rate_per_minute)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.domain = sender.rpartition('@')[2] or None
+
+    def notify(self, products, stores=None, tags=None, important=False):
+        """Mail `products` to every subscriber of `stores`/`tags` (everyone if both None)"""
+        templates = render_notification(products, self.sender)
+        conn = self.store.connect()
+        try:
+            rows = stream_subscribers(conn, stores, tags, important)
+            return self.send(self.message(templates, row) for row in rows)
+        finally:
+            conn.close()
+
+    def message(self, templates, row, **fields):
+        """(recipient, data) for one subscriber row; `fields` fill per-recipient slots"""
+        _, email, lang, unsubscribe_token, dashboard_token = row
+        lang = lang if lang in templates else 'en'
+        unsubscribe_url = f"{self.base_url}/unsubscribe?token={unsubscribe_token}&lang={lang}"
+        dashboard_url = f"{self.base_url}/dashboard?lang={lang}"
+        if dashboard_token:
+            dashboard_url += f"&key={dashboard_token}"
+        fields.update(to=email, date=self.date, message_id=make_msgid(domain=self.domain),
+                      unsubscribe_url=unsubscribe_url, dashboard_url=dashboard_url)
+        return email, templates[lang].fill(fields)
+
+    @property
+    def date(self):
+        return formatdate(usegmt=True)
+
+    def send(self, messages, on_result=None):
+        """Send an iterable of (recipient, data, ...); returns {'sent', 'failed', 'retried'}.
+
+        `on_result(message, outcome)` is called from the sender threads with
+        'sent', 'failed' (permanent) or 'deferred' (temporary failures ran
+        out of attempts) once for every message.
+        """
+        stats = {'sent': 0, 'failed': 0, 'retried': 0}
+        lock = threading.Lock()
+        batches = queue.Queue(maxsize=self.pool.size * 2)
+        senders = [threading.Thread(target=self._sender, args=(batches, stats, lock, on_result),
+                                    name=f"dhgate-smtp-{slot}", daemon=True)
+                   for slot in range(self.pool.size)]
+        for thread in senders:
+            thread.start()
+        try:
+            batch = []
+            for message in messages:
+                if not message[0].isascii():
+                    # No SMTPUTF8 support; such an address cannot be delivered
+                    with lock:
+                        stats['failed'] += 1
+                    if on_result is not None:
+                        on_result(message, 'failed')
+                    continue
+                batch.append(message)
+                if len(batch) >= self.batch_size:
+                    batches.put(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+        finally:
+            for _ in senders:
+                batches.put(None)
+            for thread in senders:
+                thread.join()
+        return stats
+
+    def _sender(self, batches, stats, lock, on_result):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            sent, failed, retried = self._deliver(batch, on_result)
+            with lock:
+                stats['sent'] += sent
+                stats['failed'] += failed
+                stats['retried'] += retried
+
+    def _deliver(self, batch, on_result):
+        sent = failed = retried = 0
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.acquire(len(batch))
+            results = [None] * len(batch)
+            try:
+                with self.pool.connection() as conn:
+                    conn.send_batch(self.sender, batch, results)
+            except (smtplib.SMTPException, OSError) as e:
+                print(f"⚠️ SMTP verbinding mislukt: {e}", file=sys.stderr)
+            retry = []
+            for message, result in zip(batch, results):
+                if result is None or 400 <= result[0] < 500:
+                    retry.append(message)
+                elif result[0] < 300:
+                    sent += 1
+                    if on_result is not None:
+                        on_result(message, 'sent')
+                else:
+                    failed += 1
+                    print(f"❌ {message[0]} geweigerd: {result[0]} {result[1]!r}", file=sys.stderr)
+                    if on_result is not None:
+                        on_result(message, 'failed')
+            if not retry:
+                break
+            if attempt == self.max_attempts:
+                failed += len(retry)
+                if on_result is not None:
+                    for message in retry:
+                        on_result(message, 'deferred')
+                break
+            retried += len(retry)
+            batch = retry
+            time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        return sent, failed, retried
+
+
+def add_smtp_arguments(parser):
+    """Add the database and SMTP flags shared by the mail CLIs"""
+    parser.add_argument("--db", default=os.environ.get("DHGATE_DB", signup_store.DEFAULT_DB_PATH),
+                        help="SQLite database (env DHGATE_DB)")
+    parser.add_argument("--smtp-host", default=os.environ.get("DHGATE_SMTP_HOST", DEFAULT_SMTP_HOST),
+                        help="SMTP server (env DHGATE_SMTP_HOST)")
+    parser.add_argument("--smtp-port", type=int,
+                        default=_env_int("DHGATE_SMTP_PORT", DEFAULT_SMTP_PORT),
+                        help="SMTP port; 465 uses implicit TLS (env DHGATE_SMTP_PORT)")
+    parser.add_argument("--smtp-user", default=os.environ.get("DHGATE_SMTP_USER"),
+                        help="SMTP login; the password is read from DHGATE_SMTP_PASSWORD")
+    parser.add_argument("--no-starttls", dest="starttls", action="store_false",
+                        help="do not upgrade the connection with STARTTLS")
+    parser.add_argument("--sender", default=os.environ.get("DHGATE_SMTP_SENDER", DEFAULT_SENDER),
+                        help="From address (env DHGATE_SMTP_SENDER)")
+    parser.add_argument("--base-url", default=os.environ.get("DHGATE_BASE_URL", BASE_URL),
+                        help="site URL used in links (env DHGATE_BASE_URL)")
+    parser.add_argument("--connections", type=int, default=_env_int("DHGATE_SMTP_CONNECTIONS", 4),
+                        help="persistent SMTP connections (env DHGATE_SMTP_CONNECTIONS)")
+    parser.add_argument("--batch-size", type=int, default=_env_int("DHGATE_SMTP_BATCH", 50),
+                        help="messages per pipelined batch (env DHGATE_SMTP_BATCH)")
+    parser.add_argument("--rate", type=int, default=_env_int("DHGATE_SMTP_RATE", 0),
+                        help="max messages per minute, 0 = unlimited (env DHGATE_SMTP_RATE)")
+    parser.add_argument("--max-attempts", type=int, default=_env_int("DHGATE_SMTP_ATTEMPTS", 4),
+                        help="delivery attempts for temporary failures (env DHGATE_SMTP_ATTEMPTS)")
+
+
+def build_dispatcher(args, store):
+    """NotificationDispatcher for parsed add_smtp_arguments() flags"""
+    pool = SMTPConnectionPool(args.smtp_host, args.smtp_port, args.smtp_user,
+                              os.environ.get("DHGATE_SMTP_PASSWORD"), args.starttls,
+                              size=args.connections)
+    return NotificationDispatcher(store, pool, args.sender, args.base_url, args.batch_size,
+                                  args.rate, args.max_attempts)
+
+
+def parse_args(argv=None):
+    """Parse CLI flags; SMTP settings default to DHGATE_SMTP_* environment variables"""
+    parser = argparse.ArgumentParser(description="Send DHgate Monitor product notifications")
+    parser.add_argument("products", help="JSON file with a list of {title, price, url} products")
+    parser.add_argument("--store", action="append", dest="stores",
+                        help="only subscribers of this store (repeatable)")
+    parser.add_argument("--tag", action="append", dest="tags",
+                        help="only subscribers watching this tag (repeatable)")
+    parser.add_argument("--important", action="store_true",
+                        help="also reach subscribers who only want important notifications")
+    add_smtp_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.products, encoding='utf-8') as f:
+        products = json.load(f)
+    store = signup_store.SignupStore(args.db)
+    store.initialize()
+    dispatcher = build_dispatcher(args, store)
+    started = time.monotonic()
+    try:
+        stats = dispatcher.notify(products, args.stores, args.tags, args.important)
+    finally:
+        dispatcher.pool.close()
+        store.close()
+    print(f"📧 {stats['sent']} verstuurd, {stats['failed']} mislukt, "
+          f"{stats['retried']} opnieuw geprobeerd in {time.monotonic() - started:.1f}s "
+          f"over {dispatcher.pool.opened} verbinding(en)")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor prijsgeschiedenis
+Append-only tijdreeksen in memory-mapped segmenten met uur- en dagtotalen
+"""
+
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    import numpy
+except ImportError:  # pure-Python fallback below
+    numpy = None
+
+DEFAULT_HISTORY_DIR = "price-history"
+
+HOUR = 3600
+DAY = 86400
+
+# 16-byte segment header: magic, format version, record size, committed record count
+HEADER = struct.Struct('<4sHHQ')
+MAGIC = b'DHPH'
+VERSION = 1
+GROW_RECORDS = 65536
+
+# Raw observation: product key, unix time, price in cents, stock (1/0, -1 unknown)
+RAW = struct.Struct('<qIih2x')
+# Pre-aggregated bucket: key, bucket start, points, points in stock, min, max,
+# open, close (cents), sum and sum of squares of the price for mean and spread
+TIER = struct.Struct('<qIIIiiiidd')
+
+if numpy is not None:
+    RAW_DTYPE = numpy.dtype({'names': ['key', 'ts', 'cents', 'stock'],
+                             'formats': ['<i8', '<u4', '<i4', '<i2'],
+                             'offsets': [0, 8, 12, 16], 'itemsize': RAW.size})
+    TIER_DTYPE = numpy.dtype({'names': ['key', 'ts', 'count', 'instock', 'min', 'max', 'open',
+                                        'close', 'sum', 'sumsq'],
+                              'formats': ['<i8', '<u4', '<u4', '<u4', '<i4', '<i4', '<i4', '<i4',
+                                          '<f8', '<f8'],
+                              'offsets': [0, 8, 12, 16, 20, 24, 28, 32, 36, 44],
+                              'itemsize': TIER.size})
+
+# Tier name -> (record layout, bucket seconds, segment period)
+TIERS = {
+    'raw': (RAW, 0, 'month'),
+    'hourly': (TIER, HOUR, 'year'),
+    'daily': (TIER, DAY, 'year'),
+}
+# Longest range (seconds) each tier answers when the caller does not choose
+AUTO_TIERS = (('raw', 2 * DAY), ('hourly', 62 * DAY), ('daily', None))
+
+
+def period_of(ts, period):
+    moment = datetime.fromtimestamp(ts, timezone.utc)
+    return f"{moment.year:04d}-{moment.month:02d}" if period == 'month' else f"{moment.year:04d}"
+
+
+def periods_between(start, end, period):
+    """Segment period names covering [start, end)"""
+    names = []
+    moment = datetime.fromtimestamp(start, timezone.utc).replace(day=1, hour=0, minute=0, second=0,
+                                                                 microsecond=0)
+    if period == 'year':
+        moment = moment.replace(month=1)
+    while moment.timestamp() < end:
+        names.append(period_of(moment.timestamp(), period))
+        if period == 'month':
+            moment = moment.replace(year=moment.year + moment.month // 12,
+                                    month=moment.month % 12 + 1)
+        else:
+            moment = moment.replace(year=moment.year + 1)
+    return names
+
+
+class Segment:
+    """One append-only file of fixed-width records, memory-mapped.
+
+    The header's record count is only advanced after the records are in
+    place, so readers in other processes (mapping the same file) always see
+    a complete prefix. The writer grows the file in GROW_RECORDS steps.
+    """
+
+    def __init__(self, path, record, writable=False):
+        self.path = path
+        self.record = record
+        self.writable = writable
+        self._map = None
+        self._file = None
+        if writable and not os.path.exists(path):
+            # Readers in other processes must never map a file without its header
+            with open(path + ".tmp", 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, record.size, 0))
+            os.replace(path + ".tmp", path)
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'r+b' if self.writable else 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), size,
+                              access=mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ)
+        magic, version, record_size, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or record_size != self.record.size:
+            self.close()
+            raise ValueError(f"{self.path} is not a price history segment of this layout")
+
+    @property
+    def count(self):
+        return HEADER.unpack_from(self._map)[3]
+
+    def _set_count(self, count):
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.record.size, count)
+
+    def append(self, data):
+        """Append packed records (a multiple of the record size)"""
+        count = self.count
+        end = HEADER.size + (count * self.record.size) + len(data)
+        if end > len(self._map):
+            capacity = max(end, HEADER.size + (count + GROW_RECORDS) * self.record.size,
+                           2 * len(self._map))
+            self._map.flush()
+            self._map.resize(capacity)
+        start = HEADER.size + count * self.record.size
+        self._map[start:start + len(data)] = data
+        self._set_count(count + len(data) // self.record.size)
+
+    def truncate(self, count):
+        """Forget records from `count` on (used to make rollups idempotent)"""
+        if count < self.count:
+            self._set_count(count)
+
+    def buffer(self):
+        """Read-only view of the committed records"""
+        count = self.count
+        end = HEADER.size + count * self.record.size
+        if end > len(self._map):
+            # Another process grew the file since it was mapped
+            self._map.close()
+            self._file.close()
+            self._open()
+        return memoryview(self._map)[HEADER.size:end].toreadonly()
+
+    def flush(self):
+        if self.writable:
+            self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# Column access: NumPy structured arrays over the mapped bytes when available,
+# tuples from struct.iter_unpack otherwise
+
+def _records(buffer, record):
+    if numpy is not None:
+        return numpy.frombuffer(buffer, dtype=RAW_DTYPE if record is RAW else TIER_DTYPE)
+    return list(record.iter_unpack(buffer))
+
+
+def _as_buckets(rows, raw):
+    """Raw points as one-point buckets, so raw and tier data aggregate alike
+    (unknown stock counts as not in stock)"""
+    if numpy is not None:
+        if not raw:
+            return rows
+        buckets = numpy.zeros(len(rows), dtype=TIER_DTYPE)
+        cents = rows['cents']
+        for name in ('min', 'max', 'open', 'close'):
+            buckets[name] = cents
+        buckets['key'] = rows['key']
+        buckets['ts'] = rows['ts']
+        buckets['count'] = 1
+        buckets['instock'] = rows['stock'] > 0
+        buckets['sum'] = cents
+        buckets['sumsq'] = cents.astype('<f8') ** 2
+        return buckets
+    if not raw:
+        return rows
+    return [(key, ts, 1, int(stock > 0), cents, cents, cents, cents, float(cents),
+             float(cents) ** 2) for key, ts, cents, stock in rows]
+
+
+def _select(rows, start, end, keys=None):
+    if numpy is not None:
+        mask = (rows['ts'] >= start) & (rows['ts'] < end)
+        if keys is not None:
+            mask &= numpy.isin(rows['key'], numpy.fromiter(keys, dtype='<i8'))
+        return rows[mask]
+    keys = set(keys) if keys is not None else None
+    return [row for row in rows if start <= row[1] < end and (keys is None or row[0] in keys)]
+
+
+def _concat(parts):
+    if numpy is not None:
+        return numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=TIER_DTYPE)
+    return [row for part in parts for row in part]
+
+
+def aggregate(buckets, size):
+    """Merge bucket records into `size`-second buckets per product.
+
+    Returns records in (key, bucket) order; open/close follow time order.
+    """
+    if numpy is not None:
+        if not len(buckets):
+            return buckets
+        bucket = (buckets['ts'] // size) * size
+        order = numpy.lexsort((buckets['ts'], bucket, buckets['key']))
+        rows, bucket = buckets[order], bucket[order]
+        starts = numpy.flatnonzero(numpy.concatenate((
+            [True], (rows['key'][1:] != rows['key'][:-1]) | (bucket[1:] != bucket[:-1]))))
+        ends = numpy.append(starts[1:], len(rows)) - 1
+        merged = numpy.zeros(len(starts), dtype=TIER_DTYPE)
+        merged['key'] = rows['key'][starts]
+        merged['ts'] = bucket[starts]
+        for name in ('count', 'instock', 'sum', 'sumsq'):
+            merged[name] = numpy.add.reduceat(rows[name], starts)
+        merged['min'] = numpy.minimum.reduceat(rows['min'], starts)
+        merged['max'] = numpy.maximum.reduceat(rows['max'], starts)
+        merged['open'] = rows['open'][starts]
+        merged['close'] = rows['close'][ends]
+        return merged
+    merged = {}
+    for row in sorted(buckets, key=lambda row: (row[0], row[1])):
+        key, ts, count, instock, low, high, first, last, total, squares = row
+        slot = (key, ts // size * size)
+        current = merged.get(slot)
+        if current is None:
+            merged[slot] = [key, slot[1], count, instock, low, high, first, last, total, squares]
+            continue
+        current[2] += count
+        current[3] += instock
+        current[4] = min(current[4], low)
+        current[5] = max(current[5], high)
+        current[7] = last
+        current[8] += total
+        current[9] += squares
+    return [tuple(merged[slot]) for slot in sorted(merged)]
+
+
+def summarize(buckets):
+    """{key: rollup} over time-ordered bucket records of any tier.
+
+    Rollups: min/max/mean price, % change from first open to last close,
+    volatility (standard deviation of bucket-to-bucket % returns of the
+    close) and the share of observations in stock. Prices are in dollars.
+    """
+    if numpy is not None:
+        if not len(buckets):
+            return {}
+        rows = buckets[numpy.lexsort((buckets['ts'], buckets['key']))]
+        keys = rows['key']
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = numpy.append(starts[1:], len(rows)) - 1
+        count = numpy.add.reduceat(rows['count'].astype('<f8'), starts)
+        total = numpy.add.reduceat(rows['sum'], starts)
+        instock = numpy.add.reduceat(rows['instock'].astype('<f8'), starts)
+        low = numpy.minimum.reduceat(rows['min'], starts)
+        high = numpy.maximum.reduceat(rows['max'], starts)
+        first = rows['open'][starts].astype('<f8')
+        last = rows['close'][ends].astype('<f8')
+        close = rows['close'].astype('<f8')
+        # Returns between consecutive buckets of the same product
+        same = keys[1:] == keys[:-1]
+        previous = close[:-1]
+        returns = numpy.where(same & (previous > 0), close[1:] / numpy.where(previous > 0, previous, 1) - 1, 0.0)
+        valid = (same & (previous > 0)).astype('<f8')
+        group = numpy.cumsum(numpy.concatenate(([0], (~same).astype('<i8'))))[1:] if len(rows) > 1 \
+            else numpy.zeros(0, dtype='<i8')
+        n = numpy.bincount(group, weights=valid, minlength=len(starts))
+        s1 = numpy.bincount(group, weights=returns * valid, minlength=len(starts))
+        s2 = numpy.bincount(group, weights=returns ** 2 * valid, minlength=len(starts))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            variance = numpy.where(n > 1, (s2 - s1 ** 2 / numpy.maximum(n, 1)) / numpy.maximum(n - 1, 1), 0.0)
+            change = numpy.where(first > 0, (last / numpy.where(first > 0, first, 1) - 1) * 100, 0.0)
+        volatility = numpy.sqrt(numpy.maximum(variance, 0.0)) * 100
+        return {int(keys[start]): _rollup(count[i], total[i], low[i], high[i], change[i],
+                                          volatility[i], instock[i], first[i], last[i])
+                for i, start in enumerate(starts)}
+    grouped = {}
+    for row in sorted(buckets, key=lambda row: (row[0], row[1])):
+        grouped.setdefault(row[0], []).append(row)
+    result = {}
+    for key, rows in grouped.items():
+        count = sum(row[2] for row in rows)
+        closes = [row[7] for row in rows]
+        returns = [b / a - 1 for a, b in zip(closes, closes[1:]) if a > 0]
+        volatility = 0.0
+        if len(returns) > 1:
+            mean = sum(returns) / len(returns)
+            volatility = math.sqrt(sum((r - mean) ** 2 for r in returns) / (len(returns) - 1)) * 100
+        first, last = rows[0][6], rows[-1][7]
+        change = (last / first - 1) * 100 if first > 0 else 0.0
+        result[key] = _rollup(count, sum(row[8] for row in rows), min(row[4] for row in rows),
+                              max(row[5] for row in rows), change, volatility,
+                              sum(row[3] for row in rows), first, last)
+    return result
+
+
+def _rollup(count, total, low, high, change, volatility, instock, first, last):
+    count = float(count)
+    return {'points': int(count), 'min': int(low) / 100, 'max': int(high) / 100,
+            'mean': round(float(total) / count / 100, 4) if count else None,
+            'first': float(first) / 100, 'last': float(last) / 100,
+            'change_pct': round(float(change), 4), 'volatility_pct': round(float(volatility), 4),
+            'in_stock': round(float(instock) / count, 4) if count else None}
+
+
+def _series(buckets):
+    """[[ts, min, max, mean, close]] in time order (prices in dollars)"""
+    if numpy is not None:
+        rows = buckets[numpy.argsort(buckets['ts'], kind='stable')]
+        return [[int(row['ts']), int(row['min']) / 100, int(row['max']) / 100,
+                 round(float(row['sum']) / int(row['count']) / 100, 4), int(row['close']) / 100]
+                for row in rows]
+    return [[row[1], row[4] / 100, row[5] / 100, round(row[8] / row[2] / 100, 4), row[7] / 100]
+            for row in sorted(buckets, key=lambda row: row[1])]
+
+
+class PriceHistory:
+    """Per-product price and stock series in append-only segment files.
+
+    Raw observations go to one segment per month; `rollup()` folds complete
+    hours into the hourly tier and complete days into the daily tier (one
+    segment per year each), so long-range queries read pre-aggregated
+    buckets instead of raw points. Rollups are driven by a watermark file
+    and trim any half-written tail first, so a crash mid-rollup is
+    repaired by the next one. Observations older than the hourly
+    watermark still land in the raw tier but no longer reach the others.
+
+    Product keys are change_detection.product_key() values. One process
+    writes; any number may read the same directory. A writer with
+    `auto_rollup` rolls up on the first append of every new hour.
+    """
+
+    def __init__(self, directory=DEFAULT_HISTORY_DIR, writable=True, auto_rollup=True):
+        self.directory = directory
+        self.writable = writable
+        self.auto_rollup = auto_rollup
+        self._next_rollup = 0
+        self._segments = {}
+        self._lock = threading.RLock()
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+
+    def configure(self, directory):
+        """Switch to another directory (None: no history) before first use"""
+        self.close()
+        self.directory = directory
+        if self.writable and directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _segment(self, tier, period):
+        name = (tier, period)
+        segment = self._segments.get(name)
+        if segment is None:
+            path = os.path.join(self.directory, f"{tier}-{period}.seg")
+            if self.directory is None or not self.writable and not os.path.exists(path):
+                return None
+            segment = self._segments[name] = Segment(path, TIERS[tier][0], self.writable)
+        return segment
+
+    # Writing
+
+    def append(self, points):
+        """Append (key, ts, cents, stock) observations"""
+        by_period = {}
+        for key, ts, cents, stock in points:
+            by_period.setdefault(period_of(ts, 'month'), []).append(
+                RAW.pack(key, int(ts), cents, stock))
+        with self._lock:
+            for period, records in by_period.items():
+                self._segment('raw', period).append(b''.join(records))
+            now = time.time()
+            if self.auto_rollup and now >= self._next_rollup:
+                self._next_rollup = (int(now) // HOUR + 1) * HOUR
+                self.rollup(now)
+        return sum(len(records) for records in by_period.values())
+
+    def _watermarks(self):
+        try:
+            with open(os.path.join(self.directory, "rollup.json"), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_watermarks(self, marks):
+        path = os.path.join(self.directory, "rollup.json")
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(marks, f)
+        os.replace(path + ".tmp", path)
+
+    def rollup(self, now=None):
+        """Fold complete hours and days into their tiers; returns buckets written"""
+        now = int(now or time.time())
+        written = 0
+        with self._lock:
+            marks = self._watermarks()
+            for tier, source in (('hourly', 'raw'), ('daily', 'hourly')):
+                size = TIERS[tier][1]
+                cutoff = now // size * size
+                start = marks.get(tier)
+                if start is None:
+                    start = self._first_ts(source)
+                    if start is None:
+                        continue
+                    start = start // size * size
+                if start >= cutoff:
+                    continue
+                self._trim(tier, start)
+                buckets = aggregate(self._read(source, start, cutoff), size)
+                written += self._write_tier(tier, buckets)
+                marks[tier] = cutoff
+                self._save_watermarks(marks)
+        return written
+
+    def _first_ts(self, tier):
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(tier + '-') and name.endswith('.seg'))
+        for name in names:
+            rows = _records(self._segment(tier, name[len(tier) + 1:-4]).buffer(), TIERS[tier][0])
+            if len(rows):
+                return int(min(rows['ts'])) if numpy is not None else min(row[1] for row in rows)
+        return None
+
+    def _trim(self, tier, start):
+        """Drop tier buckets at or after `start` (left by an interrupted rollup)"""
+        first = period_of(start, TIERS[tier][2])
+        for name in os.listdir(self.directory):
+            if name.startswith(tier + '-') and name.endswith('.seg') and name[len(tier) + 1:-4] >= first:
+                segment = self._segment(tier, name[len(tier) + 1:-4])
+                rows = _records(segment.buffer(), TIER)
+                keep = len(rows)
+                while keep and (rows[keep - 1]['ts'] if numpy is not None else rows[keep - 1][1]) >= start:
+                    keep -= 1
+                segment.truncate(keep)
+
+    def _write_tier(self, tier, buckets):
+        period = TIERS[tier][2]
+        if numpy is not None:
+            rows = buckets[numpy.argsort(buckets['ts'], kind='stable')]
+            starts, inverse = numpy.unique(rows['ts'], return_inverse=True)
+            names = numpy.array([period_of(int(ts), period) for ts in starts] or [''])[inverse]
+            for name in sorted(set(names)):
+                self._segment(tier, name).append(rows[names == name].tobytes())
+            return len(rows)
+        by_period = {}
+        for row in sorted(buckets, key=lambda row: row[1]):
+            by_period.setdefault(period_of(row[1], period), []).append(TIER.pack(*row))
+        for name, records in sorted(by_period.items()):
+            self._segment(tier, name).append(b''.join(records))
+        return len(buckets)
+
+    # Reading
+
+    def _read(self, tier, start, end, keys=None):
+        """Bucket records of `tier` in [start, end), raw points included as buckets"""
+        record, _, period = TIERS[tier]
+        parts = []
+        with self._lock:
+            for name in periods_between(start, end, period):
+                segment = self._segment(tier, name)
+                if segment is not None:
+                    rows = _select(_records(segment.buffer(), record), start, end, keys)
+                    parts.append(_as_buckets(rows, record is RAW))
+        return _concat(parts)
+
+    def choose_tier(self, start, end):
+        span = end - start
+        for tier, longest in AUTO_TIERS:
+            if longest is None or span <= longest:
+                return tier
+
+    def series(self, key, start, end, tier=None):
+        """Chart points [[ts, min, max, mean, close]] for one product"""
+        tier = tier or self.choose_tier(start, end)
+        buckets = self._read(tier, start, end, [key])
+        if tier == 'raw':
+            buckets = aggregate(buckets, 60) if len(buckets) > 5000 else buckets
+        return {'tier': tier, 'points': _series(buckets)}
+
+    def summaries(self, keys=None, start=0, end=None, tier=None):
+        """{key: rollup} for many products at once (all of them if keys is None)"""
+        end = end or int(time.time()) + 1
+        return summarize(self._read(tier or self.choose_tier(start, end), start, end, keys))
+
+    def flush(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.flush()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
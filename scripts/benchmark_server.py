@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the local DHgate Monitor server (server.py)
+
+Starts the server on an ephemeral port (as a subprocess, or in-process),
+drives every route plus the large assets with N concurrent clients and
+reports req/s, p50/p95/p99 latency and bytes/s per scenario as JSON.
+
+Results can be stored as a baseline and compared on later runs; a drop
+larger than --threshold exits with status 1 so a regression fails loudly.
+Baselines are kept per host and per load configuration, because numbers
+from a different machine or concurrency say nothing about each other.
+
+Usage:
+    python3 scripts/benchmark_server.py                      # run and compare
+    python3 scripts/benchmark_server.py --save-baseline      # store this run
+    python3 scripts/benchmark_server.py --server-args "--mode pool --pool-size 32"
+    python3 scripts/benchmark_server.py --url http://127.0.0.1:3000   # running server
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "benchmark-baseline.json"
+# Item code whose price history seed_price_history() writes for the chart scenario
+HISTORY_PRODUCT = "700000001"
+HISTORY_DAYS = 30
+
+# (name, path, extra request headers)
+SCENARIOS = (
+    ("home", "/", {}),
+    ("home-gzip", "/", {"Accept-Encoding": "gzip"}),
+    ("dashboard", "/dashboard", {}),
+    ("dashboard-nl-dark", "/dashboard?lang=nl&theme=dark", {}),
+    ("newsroom", "/newsroom", {}),
+    ("service", "/service", {}),
+    ("contact", "/contact", {}),
+    ("privacy", "/privacy", {}),
+    ("terms", "/terms", {}),
+    ("delete-data", "/delete-data", {}),
+    ("add-shop", "/add_shop", {}),
+    ("settings", "/settings", {}),
+    ("unsubscribe", "/unsubscribe?token=benchmark0token0benchmark0token00", {}),
+    ("widget", "/signup-widget.js", {}),
+    ("asset-css", "/assets/icons/dhgate-monitor-icons.css", {}),
+    ("asset-logo", "/assets/DHGateLogo.png", {}),
+    ("asset-header-large", "/assets/dhgatevisualheader.png", {}),
+    ("metrics", "/metrics", {}),
+    ("price-history", f"/api/price-history?product={HISTORY_PRODUCT}&days={HISTORY_DAYS}", {}),
+)
+
+
+# Server-Sent Events streams never finish their response, so a client
+# would block on them until --timeout; they are not request/response routes
+STREAMING_PATHS = ("/events",)
+
+
+def registered_paths():
+    """Exact GET routes of server.ROUTER, to catch routes missing above"""
+    sys.path.insert(0, str(ROOT))
+    try:
+        import server
+    except ImportError:
+        return []
+    # Debug routes are admin-only and answer 404 without a token
+    return [route.path for route in server.ROUTER.routes()
+            if "GET" in route.methods and not route.path.endswith("/")
+            and not route.path.startswith("/debug/") and route.path not in STREAMING_PATHS]
+
+
+def build_scenarios(selected):
+    scenarios = list(SCENARIOS)
+    covered = {urllib.parse.urlsplit(path).path for _, path, _ in scenarios}
+    for path in registered_paths():
+        if path not in covered:
+            scenarios.append((path.strip("/") or path, path, {}))
+    if selected:
+        scenarios = [scenario for scenario in scenarios if scenario[0] in selected]
+    return scenarios
+
+
+def seed_price_history(directory):
+    """Hourly prices for HISTORY_PRODUCT over HISTORY_DAYS, rolled up like the crawler does"""
+    sys.path.insert(0, str(ROOT))
+    import change_detection
+    import price_history
+    history = price_history.PriceHistory(directory)
+    key = change_detection.product_key(HISTORY_PRODUCT)
+    now = int(time.time())
+    start = now - HISTORY_DAYS * 86400
+    history.append([(key, ts, 1999 + (ts // 3600) % 24 * 10, 1) for ts in range(start, now, 3600)])
+    history.rollup(now)
+    history.close()
+    return directory
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_listening(port, timeout=15, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+class SubprocessServer:
+    """server.py in its own interpreter, so it does not share our GIL"""
+
+    def __init__(self, server_args):
+        self.server_args = server_args
+        self.process = None
+        self.port = None
+
+    def __enter__(self):
+        self.port = free_port()
+        # A throwaway database, so benchmarks never write to the real one
+        self._tmpdir = tempfile.TemporaryDirectory()
+        history = seed_price_history(os.path.join(self._tmpdir.name, "history"))
+        command = [sys.executable, str(ROOT / "server.py"), "--port", str(self.port),
+                   "--access-log", "off", "--db", os.path.join(self._tmpdir.name, "bench.db"),
+                   "--history-dir", history] + self.server_args
+        self.process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        try:
+            wait_until_listening(self.port, process=self.process)
+        except RuntimeError:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._tmpdir.cleanup()
+
+
+class InProcessServer:
+    """server.py serving from a thread of this process.
+
+    Quicker to start and easy to profile, but the load generator competes
+    with the server for the GIL, so absolute numbers are lower.
+    """
+
+    def __init__(self, server_args):
+        self.server_args = server_args
+        self.port = None
+        self._httpd = None
+        self._engine = None
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        sys.path.insert(0, str(ROOT))
+        os.chdir(ROOT)
+        import server
+        self._tmpdir = tempfile.TemporaryDirectory()
+        history = seed_price_history(os.path.join(self._tmpdir.name, "history"))
+        args = server.parse_args(["--port", "0", "--host", "127.0.0.1", "--access-log", "off",
+                                  "--db", os.path.join(self._tmpdir.name, "bench.db"),
+                                  "--history-dir", history] + self.server_args)
+        server.configure_access_log(args)
+        server.SIGNUP_STORE.configure(path=args.db, batch_size=args.db_commit_batch)
+        server.SIGNUP_STORE.initialize()
+        server.PRICE_HISTORY.configure(directory=args.history_dir)
+        server.STATIC_CACHE.configure(max_bytes=args.static_cache_bytes,
+                                      check_interval=args.static_check_interval,
+                                      stream_threshold=args.sendfile_threshold)
+        server.STATIC_CACHE.warm(server.PRELOAD_FILES)
+        server.RENDER_CACHE.warm()
+        if args.engine == "asyncio":
+            self._loop = asyncio.new_event_loop()
+            self._engine = server.AsyncioDHgateServer(args)
+            self.port = self._loop.run_until_complete(self._engine.start())[1]
+            self._thread = threading.Thread(target=self._run_loop, daemon=True)
+        else:
+            self._httpd = server.build_server(args)
+            self.port = self._httpd.server_address[1]
+            self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run_loop(self):
+        try:
+            self._loop.run_until_complete(self._engine.serve_forever())
+        except asyncio.CancelledError:
+            pass
+        # Finish the connection coroutines before the loop goes away
+        pending = asyncio.all_tasks(self._loop)
+        for task in pending:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+    def __exit__(self, *exc):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+        else:
+            self._loop.call_soon_threadsafe(self._engine.close)
+        self._thread.join(timeout=10)
+        self._tmpdir.cleanup()
+
+
+class ExternalServer:
+    """An already running server given with --url"""
+
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def client(host, port, path, headers, deadline, keepalive, timeout, out):
+    """One client: sequential requests until the deadline"""
+    latencies = []
+    received = 0
+    errors = 0
+    headers = dict(headers)
+    if not keepalive:
+        headers["Connection"] = "close"
+    conn = None
+    while time.perf_counter() < deadline:
+        if conn is None:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        started = time.perf_counter()
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = None
+            continue
+        latencies.append(time.perf_counter() - started)
+        received += len(body)
+        if response.status != 200:
+            errors += 1
+        if not keepalive or response.will_close:
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+    out.append((latencies, received, errors))
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, received, errors, elapsed):
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "bytes_per_s": int(received / elapsed),
+    }
+
+
+def run_scenario(host, port, path, headers, options):
+    """Warm up, then measure one scenario with --concurrency clients"""
+    if options.warmup > 0:
+        client(host, port, path, headers, time.perf_counter() + options.warmup,
+               options.keepalive, options.timeout, [])
+    out = []
+    started = time.perf_counter()
+    deadline = started + options.duration
+    threads = [threading.Thread(target=client,
+                                args=(host, port, path, headers, deadline,
+                                      options.keepalive, options.timeout, out))
+               for _ in range(options.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies = [value for result in out for value in result[0]]
+    return summarize(latencies, sum(result[1] for result in out),
+                     sum(result[2] for result in out), elapsed), latencies
+
+
+def host_key():
+    return (f"{platform.system().lower()}-{platform.machine()}-{os.cpu_count()}cpu-"
+            f"py{sys.version_info[0]}.{sys.version_info[1]}")
+
+
+def config_key(options):
+    server_args = " ".join(options.server_args) or "default"
+    return (f"{options.server}:{server_args}|c{options.concurrency}|"
+            f"{'keepalive' if options.keepalive else 'close'}")
+
+
+def load_baselines(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"version": 1, "baselines": {}}
+
+
+def compare(report, baseline, threshold):
+    """Regressions of this run against a stored baseline"""
+    regressions = []
+    for name, current in report["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        if current["errors"] and not previous["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors")
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - threshold):
+            regressions.append(f"{name}: {current['rps']} req/s vs baseline {previous['rps']}")
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms vs baseline {previous['p95_ms']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DHgate Monitor local server")
+    parser.add_argument("--server", choices=("subprocess", "inprocess"), default="subprocess",
+                        help="run server.py in a child process (default) or in this process")
+    parser.add_argument("--server-args", default="",
+                        help='extra server.py flags, e.g. "--engine asyncio --pool-size 32"')
+    parser.add_argument("--url", help="benchmark an already running server instead")
+    parser.add_argument("--concurrency", "-c", type=int, default=16,
+                        help="concurrent clients per scenario (default: 16)")
+    parser.add_argument("--duration", "-d", type=float, default=3.0,
+                        help="measured seconds per scenario (default: 3)")
+    parser.add_argument("--warmup", type=float, default=0.5,
+                        help="warm-up seconds per scenario (default: 0.5)")
+    parser.add_argument("--no-keepalive", dest="keepalive", action="store_false",
+                        help="open a new connection for every request")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="per-request socket timeout in seconds (default: 10)")
+    parser.add_argument("--scenario", action="append", default=[],
+                        help="only run this scenario (repeatable)")
+    parser.add_argument("--output", "-o", help="write the JSON report to this file")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE),
+                        help="baseline file (default: scripts/benchmark-baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the baseline for this host and configuration")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed req/s drop or p95 increase before failing (default: 0.25)")
+    options = parser.parse_args(argv)
+    options.server_args = shlex.split(options.server_args)
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    scenarios = build_scenarios(set(options.scenario))
+    if not scenarios:
+        print("❌ No scenarios selected", file=sys.stderr)
+        return 2
+
+    if options.url:
+        target = ExternalServer(options.url)
+    elif options.server == "inprocess":
+        target = InProcessServer(options.server_args)
+    else:
+        target = SubprocessServer(options.server_args)
+
+    report = {
+        "host": host_key(),
+        "config": config_key(options),
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "concurrency": options.concurrency,
+        "duration": options.duration,
+        "keepalive": options.keepalive,
+        "scenarios": {},
+    }
+    all_latencies = []
+    totals = {"requests": 0, "errors": 0, "bytes_per_s": 0, "rps": 0.0}
+    try:
+        with target:
+            host = getattr(target, "host", "127.0.0.1")
+            for name, path, headers in scenarios:
+                result, latencies = run_scenario(host, target.port, path, headers, options)
+                report["scenarios"][name] = result
+                all_latencies.extend(latencies)
+                print(f"  {name:<20} {result['rps']:>9.1f} req/s  p50 {result['p50_ms']:>8.3f} ms  "
+                      f"p99 {result['p99_ms']:>8.3f} ms  {result['bytes_per_s'] / 1e6:>8.2f} MB/s"
+                      f"{'  errors: ' + str(result['errors']) if result['errors'] else ''}",
+                      file=sys.stderr)
+    except RuntimeError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+
+    all_latencies.sort()
+    for result in report["scenarios"].values():
+        totals["requests"] += result["requests"]
+        totals["errors"] += result["errors"]
+    totals["rps"] = round(totals["requests"] / (options.duration * len(scenarios)), 1)
+    totals["bytes_per_s"] = int(sum(result["bytes_per_s"] for result in report["scenarios"].values())
+                                / len(scenarios))
+    totals["p50_ms"] = round(percentile(all_latencies, 0.50) * 1000, 3)
+    totals["p95_ms"] = round(percentile(all_latencies, 0.95) * 1000, 3)
+    totals["p99_ms"] = round(percentile(all_latencies, 0.99) * 1000, 3)
+    report["total"] = totals
+
+    text = json.dumps(report, indent=2)
+    if options.output:
+        Path(options.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+    baselines = load_baselines(options.baseline)
+    key = f"{report['host']}/{report['config']}"
+    if options.save_baseline:
+        baselines["baselines"][key] = {name: report[name] for name in
+                                       ("python", "started_at", "duration", "scenarios", "total")}
+        with open(options.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"💾 Baseline saved for {key}", file=sys.stderr)
+        return 0
+
+    baseline = baselines["baselines"].get(key)
+    if baseline is None:
+        print(f"ℹ️  No baseline for {key}; run with --save-baseline to store one", file=sys.stderr)
+        return 1 if totals["errors"] else 0
+    regressions = compare(report, baseline, options.threshold)
+    if regressions:
+        print(f"🔴 Performance regression (threshold {options.threshold:.0%}):", file=sys.stderr)
+        for line in regressions:
+            print(f"   {line}", file=sys.stderr)
+        return 1
+    print(f"✅ Within {options.threshold:.0%} of the baseline for {key}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,106 +4,1849 @@ DHgate Monitor Local Development Server
 Simuleert alle routes van dhgate-monitor.com
 """
 
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import cProfile
+import email.utils
+import errno
+import gzip
+import hashlib
+import hmac
+import html
 import http.server
+import io
+import marshal
+import math
+import pstats
+import queue
+import random
+import signal
+import socket
 import socketserver
+import stat
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import OrderedDict
 import urllib.parse
 import os
 import json
 from pathlib import Path
 
+import change_detection
+import event_stream
+import price_history
+import shared_cache
+import signup_store
+
+DEFAULT_PORT = 3000
+SERVER_MODES = ("single", "thread", "pool")
+SERVER_ENGINES = ("threaded", "asyncio")
+HTTP_PROTOCOLS = ("HTTP/1.0", "HTTP/1.1")
+# Errors after which the rest of the request cannot be trusted
+CLOSING_ERROR_CODES = frozenset((400, 408, 413, 414, 431))
+MAX_HEADER_BYTES = 65536
+MAX_BODY_BYTES = 1024 * 1024
+
+# Minimal response for connections rejected before a handler is created
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: 20\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"\r\n"
+    b"Server is overloaded"
+)
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.png': 'image/png',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.ttf': 'font/ttf',
+    '.eot': 'application/vnd.ms-fontobject',
+}
+DEFAULT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+# Response compression: PNG and WOFF/WOFF2 are already compressed
+COMPRESSIBLE_TYPES = frozenset((
+    'text/html', 'text/css', 'text/plain', 'application/javascript',
+    'application/json', 'image/svg+xml', 'image/x-icon', 'font/ttf',
+    'application/vnd.ms-fontobject',
+))
+MIN_COMPRESS_BYTES = 1024
+SUPPORTED_ENCODINGS = ('gzip', 'deflate')  # in order of preference
+
+# Cache-Control per route prefix, first match wins
+CACHE_CONTROL_POLICY = (
+    ('/assets/', 'public, max-age=604800'),
+    ('/signup-widget.js', 'public, max-age=3600'),
+    ('/unsubscribe', 'private, no-cache'),
+    ('/metrics', 'no-store'),
+    ('/api/', 'no-store'),
+    ('/debug/', 'no-store'),
+    ('/', 'public, max-age=60'),
+)
+
+
+def content_type_for(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), DEFAULT_CONTENT_TYPE)
+
+
+def cache_control_for(path):
+    for prefix, value in CACHE_CONTROL_POLICY:
+        if path.startswith(prefix):
+            return value
+    return 'no-cache'
+
+
+def content_etag(body):
+    """Strong ETag derived from the response bytes"""
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def etag_matches(header, etag):
+    """Weak comparison of an If-None-Match header against etag"""
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def is_compressible(content_type, size):
+    return size >= MIN_COMPRESS_BYTES and content_type.split(';')[0] in COMPRESSIBLE_TYPES
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick gzip or deflate from an Accept-Encoding header; None means identity"""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+    best, best_q = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = qualities.get(coding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(body, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9, mtime=0)
+    return zlib.compress(body, 9)
+
+
+def parse_byte_range(header, size):
+    """Parse a single-range Range header.
+
+    Returns (start, end) inclusive, RANGE_NOT_SATISFIABLE, or None when the
+    header should be ignored (other units, several ranges, bad syntax).
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if start >= size:
+                return RANGE_NOT_SATISFIABLE
+            if end < start:
+                return None
+        else:
+            suffix = int(last)
+            if suffix == 0:
+                return RANGE_NOT_SATISFIABLE
+            start, end = max(size - suffix, 0), size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return RANGE_NOT_SATISFIABLE
+    return start, min(end, size - 1)
+
+
+RANGE_NOT_SATISFIABLE = 'unsatisfiable'
+
+
+def shared_key(*parts):
+    """Key of a body in the shared response cache"""
+    return '\0'.join(str(part) for part in parts)
+
+
+def static_path(filename, root=None):
+    """Normalize a requested file path; None if it escapes the site root or root dir"""
+    path = os.path.normpath(filename.lstrip('/'))
+    if path.startswith('..') or os.path.isabs(path):
+        return None
+    if root is not None and not path.startswith(root + os.sep):
+        return None
+    return path
+
+
+class EncodedVariant:
+    """A compressed copy of a cached body with its own validator and headers"""
+    __slots__ = ('body', 'etag', 'headers')
+
+    def __init__(self, body, etag, encoding, content_type):
+        self.body = body
+        self.etag = etag
+        self.headers = (
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+            ('Content-Encoding', encoding),
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+        )
+
+
+class StaticFile:
+    """Cached file bytes plus the headers that go with them"""
+    __slots__ = ('path', 'body', 'size', 'mtime_ns', 'mtime', 'etag', 'last_modified',
+                 'content_type', 'compressible', 'variants', 'footprint', 'headers',
+                 'checked_at')
+
+    def __init__(self, path, body, stat_result, checked_at):
+        self.path = path
+        # None for large files that are always streamed from disk
+        self.body = body
+        self.size = stat_result.st_size if body is None else len(body)
+        self.mtime_ns = stat_result.st_mtime_ns
+        self.mtime = int(stat_result.st_mtime)
+        # Validators come from stat() so they never require hashing the file
+        self.etag = f'"{self.mtime_ns:x}-{self.size:x}"'
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+        self.content_type = content_type_for(path)
+        self.compressible = is_compressible(self.content_type, self.size)
+        # encoding -> EncodedVariant, or None when compression did not pay off
+        self.variants = {}
+        # Bodies in the shared response cache cost no private memory
+        self.footprint = 0 if body is None or isinstance(body, memoryview) else self.size
+        headers = [
+            ('Content-Type', self.content_type),
+            ('Content-Length', str(self.size)),
+            ('ETag', self.etag),
+            ('Last-Modified', self.last_modified),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        if self.compressible:
+            headers.append(('Vary', 'Accept-Encoding'))
+        self.headers = tuple(headers)
+        self.checked_at = checked_at
+
+
+class StaticFileCache:
+    """Shared in-memory cache for serve_file.
+
+    Entries are keyed by normalized path and revalidated with a stat()
+    at most once per check_interval seconds (0 = on every request). The
+    total size is capped at max_bytes with least-recently-used eviction;
+    files larger than max_entry_bytes are read from disk every time
+    instead of displacing the hot entries. Incompressible files of at
+    least stream_threshold bytes are cached as metadata only and streamed
+    from disk with sendfile().
+
+    Compressed variants are built on first use (or by warm()), stored on
+    the entry and counted against the same budget, so they disappear
+    together with the raw bytes when the file changes or is evicted.
+
+    After share(), bodies and variants that the supervisor published to
+    the shared response cache are used from there instead of being read
+    and compressed again by every worker.
+    """
+
+    shared = None
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_entry_bytes=None, check_interval=1.0,
+                 stream_threshold=256 * 1024):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.configure(max_bytes, max_entry_bytes, check_interval, stream_threshold)
+
+    def configure(self, max_bytes=None, max_entry_bytes=None, check_interval=None,
+                  stream_threshold=None):
+        with self._lock:
+            if stream_threshold is not None:
+                self.stream_threshold = stream_threshold
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_entry_bytes is not None:
+                self.max_entry_bytes = max_entry_bytes
+            elif max_bytes is not None:
+                self.max_entry_bytes = max_bytes // 4
+            if check_interval is not None:
+                self.check_interval = check_interval
+            self._evict()
+
+    def get(self, path):
+        """Return the StaticFile for path; raises OSError if it cannot be read"""
+        return self.lookup(path)[0]
+
+    def lookup(self, path):
+        """Like get(), but returns (entry, cache hit)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry, True
+        if entry is not None:
+            st = os.stat(path)
+            if st.st_mtime_ns == entry.mtime_ns and st.st_size == entry.size:
+                with self._lock:
+                    entry.checked_at = now
+                    if path in self._entries:
+                        self._entries.move_to_end(path)
+                    self.hits += 1
+                return entry, True
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode):
+            raise IsADirectoryError(path)
+        if (st.st_size >= self.stream_threshold
+                and not is_compressible(content_type_for(path), st.st_size)):
+            entry = StaticFile(path, None, st, now)
+        else:
+            body = self._shared_body(path, st.st_mtime_ns, st.st_size)
+            if body is None:
+                with open(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    body = f.read()
+            entry = StaticFile(path, body, st, now)
+        with self._lock:
+            self.misses += 1
+            self._store(entry)
+        return entry, False
+
+    def variant(self, entry, encoding):
+        """Compressed variant of a cached entry; None to serve identity"""
+        if not entry.compressible:
+            return None
+        try:
+            return entry.variants[encoding]
+        except KeyError:
+            pass
+        with self._lock:
+            if self._entries.get(entry.path) is not entry:
+                # Uncached (too large) or stale entry: not worth compressing
+                return None
+        body = self._shared_body(entry.path, entry.mtime_ns, entry.size, encoding)
+        shared = body is not None
+        if not shared:
+            body = compress(entry.body, encoding)
+        variant = None
+        if len(body) < entry.size * 0.9:
+            variant = EncodedVariant(body, f'{entry.etag[:-1]}-{encoding}"', encoding,
+                                     entry.content_type)
+        with self._lock:
+            if encoding not in entry.variants and self._entries.get(entry.path) is entry:
+                entry.variants[encoding] = variant
+                if variant is not None and not shared:
+                    entry.footprint += len(body)
+                    self.bytes_used += len(body)
+                    self._evict()
+        return variant
+
+    def warm(self, paths, encodings=SUPPORTED_ENCODINGS):
+        """Load files and build their compressed variants ahead of traffic"""
+        for path in paths:
+            try:
+                entry = self.get(path)
+            except OSError:
+                continue
+            for encoding in encodings:
+                self.variant(entry, encoding)
+
+    def _shared_body(self, path, mtime_ns, size, encoding='identity'):
+        if self.shared is None:
+            return None
+        return self.shared.get(shared_key('static', path, mtime_ns, size, encoding))
+
+    def share(self, cache):
+        """Publish cached bodies and variants to `cache` and use them from there.
+
+        Only the single writer of the shared cache (the supervisor, before
+        and between forks) calls this; workers only read from it.
+        """
+        self.shared = cache
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if entry.body is not None]
+        for entry in entries:
+            view = cache.publish(shared_key('static', entry.path, entry.mtime_ns, entry.size,
+                                            'identity'), entry.body)
+            if view is None:
+                continue
+            entry.body = view
+            footprint = 0
+            for encoding, variant in entry.variants.items():
+                if variant is None:
+                    continue
+                view = cache.publish(shared_key('static', entry.path, entry.mtime_ns, entry.size,
+                                                encoding), variant.body)
+                if view is None:
+                    footprint += len(variant.body)
+                else:
+                    variant.body = view
+            with self._lock:
+                self.bytes_used += footprint - entry.footprint
+                entry.footprint = footprint
+
+    def _store(self, entry):
+        old = self._entries.pop(entry.path, None)
+        if old is not None:
+            self.bytes_used -= old.footprint
+        if entry.footprint > self.max_entry_bytes:
+            return
+        self._entries[entry.path] = entry
+        self.bytes_used += entry.footprint
+        self._evict()
+
+    def _evict(self):
+        while self.bytes_used > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self.bytes_used -= old.footprint
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes_used = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+STATIC_CACHE = StaticFileCache()
+
+# Hot files that are loaded and compressed before the first request
+PRELOAD_FILES = (
+    'index.html',
+    'signup-widget.js',
+    'assets/icons/dhgate-monitor-icons.css',
+)
+
+
+class AccessLogger:
+    """Structured access log that never blocks the request path.
+
+    Requests only put a small tuple on a bounded queue; a background
+    thread turns them into compact JSON lines and writes them in batches.
+    When the queue is full the record is dropped and counted instead of
+    stalling the server on a slow log pipe. sample_rate < 1 keeps that
+    fraction of successful requests; 5xx responses and error messages are
+    always kept.
+    """
+
+    def __init__(self, stream=None, sample_rate=1.0, queue_size=10000,
+                 batch_size=256, flush_interval=0.5):
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def configure(self, stream=None, sample_rate=None, queue_size=None):
+        if stream is not None:
+            self.stream = stream
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if queue_size is not None:
+            self._queue = queue.Queue(maxsize=queue_size)
+
+    @property
+    def enabled(self):
+        return self.stream is not None
+
+    def log_request(self, request, duration):
+        if self.stream is None:
+            return
+        status = request.response_status
+        if self.sample_rate < 1.0 and status < 500 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        route = request.route
+        self._put(('request', time.time(),
+                   request.client_address[0] if request.client_address else '-',
+                   request.command, route.name if route is not None else None,
+                   request.route_path, status, request.bytes_sent, duration,
+                   request.cache_status))
+
+    def log_message(self, client, message):
+        if self.stream is None:
+            return
+        self._put(('message', time.time(), client, message))
+
+    def _put(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        # Threads do not survive fork(), so every worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="dhgate-access-log",
+                                                daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    @staticmethod
+    def format(record):
+        if record[0] == 'message':
+            _, ts, client, message = record
+            entry = {'ts': round(ts, 3), 'level': 'error', 'client': client, 'message': message}
+        else:
+            _, ts, client, method, route, path, status, size, duration, cache = record
+            entry = {'ts': round(ts, 3), 'client': client, 'method': method, 'route': route,
+                     'path': path, 'status': status, 'bytes': size,
+                     'ms': round(duration * 1000, 3)}
+            if cache is not None:
+                entry['cache'] = cache
+        return json.dumps(entry, separators=(',', ':'), ensure_ascii=False)
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                self._write(batch)
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            self.stream.write('\n'.join(self.format(record) for record in batch) + '\n')
+            self.stream.flush()
+            self.written += len(batch)
+        except (OSError, ValueError):
+            self.dropped += len(batch)
+
+    def close(self):
+        """Flush what is queued and stop the writer thread"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join(timeout=2)
+            self._pid = None
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'written': self.written,
+                'dropped': self.dropped, 'sampled_out': self.sampled_out}
+
+
+ACCESS_LOG = AccessLogger(stream=sys.stdout)
+
+# Write path for signups and form posts; opened by main() via --db
+SIGNUP_STORE = signup_store.SignupStore()
+
+# One copy of the rendered pages and hot static files for all --workers, and
+# per-worker request counters every worker can read; mapped by main() before forking
+SHARED_CACHE = shared_cache.SharedResponseCache()
+SHARED_COUNTERS = shared_cache.SharedCounters()
+
+# Live events for /events; streams of the threaded engines are written by one loop thread
+EVENT_BROADCASTER = event_stream.EventBroadcaster(SIGNUP_STORE)
+EVENT_STREAMS = event_stream.EventStreamLoop(EVENT_BROADCASTER)
+
+# Read-only view of the crawler's price history; pointed at --history-dir by main()
+PRICE_HISTORY = price_history.PriceHistory(writable=False)
+MAX_HISTORY_DAYS = 730
+MAX_HISTORY_PRODUCTS = 100
+
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class _MetricsShard:
+    """Counters owned and written by a single thread"""
+    __slots__ = ('thread', 'requests', 'latency', 'bytes', 'started', 'finished')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.requests = {}  # (route, status) -> count
+        self.latency = {}   # route -> [count per bucket..., overflow count, sum of seconds]
+        self.bytes = {}     # route -> bytes sent
+        self.started = 0
+        self.finished = 0
+
+    def merge(self, other):
+        for key, count in other.requests.items():
+            self.requests[key] = self.requests.get(key, 0) + count
+        for route, counts in other.latency.items():
+            mine = self.latency.get(route)
+            if mine is None:
+                self.latency[route] = list(counts)
+            else:
+                for i, value in enumerate(counts):
+                    mine[i] += value
+        for route, size in other.bytes.items():
+            self.bytes[route] = self.bytes.get(route, 0) + size
+        self.started += other.started
+        self.finished += other.finished
+
+
+class RequestMetrics:
+    """Per-route request counters and latency histograms.
+
+    Every thread updates its own shard, so recording a request takes no
+    lock and never contends with other workers; a scrape sums the shards.
+    Shards of threads that have exited (thread-per-connection mode) are
+    folded into one retired shard so their number stays bounded.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _MetricsShard(None)
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _MetricsShard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+                if len(self._shards) % 256 == 0:
+                    self._fold_dead()
+            return shard
+
+    def _fold_dead(self):
+        # Called with the lock held; a dead thread can no longer write its shard
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def request_started(self):
+        self._shard().started += 1
+
+    def observe(self, route, status, duration, size, started=True):
+        shard = self._shard()
+        key = (route, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        counts = shard.latency.get(route)
+        if counts is None:
+            counts = shard.latency[route] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, duration)] += 1
+        counts[-1] += duration
+        shard.bytes[route] = shard.bytes.get(route, 0) + size
+        if started:
+            shard.finished += 1
+
+    def snapshot(self):
+        """Sum of all shards as one _MetricsShard"""
+        total = _MetricsShard(None)
+        with self._lock:
+            self._fold_dead()
+            total.merge(self._retired)
+            shards = list(self._shards)
+        for shard in shards:
+            # Copies first: the owning thread may be adding keys meanwhile
+            copy = _MetricsShard(None)
+            copy.requests = dict(shard.requests)
+            copy.latency = {route: list(counts) for route, counts in list(shard.latency.items())}
+            copy.bytes = dict(shard.bytes)
+            copy.started = shard.started
+            copy.finished = shard.finished
+            total.merge(copy)
+        return total
+
+    def render(self, routes=()):
+        """Request metrics in the Prometheus text exposition format"""
+        total = self.snapshot()
+        # Every registered route is exported, also before its first request
+        names = sorted(set(routes) | set(total.latency))
+        empty = [0] * (len(self.buckets) + 2)
+        lines = [
+            '# HELP dhgate_http_requests_total HTTP requests by route and status.',
+            '# TYPE dhgate_http_requests_total counter',
+        ]
+        for (route, status), count in sorted(total.requests.items()):
+            lines.append(f'dhgate_http_requests_total{{route="{route}",status="{status}"}} {count}')
+        lines += [
+            '# HELP dhgate_http_request_duration_seconds HTTP request latency by route.',
+            '# TYPE dhgate_http_request_duration_seconds histogram',
+        ]
+        for route in names:
+            counts = total.latency.get(route, empty)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'dhgate_http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+            cumulative += counts[-2]
+            lines.append(f'dhgate_http_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {cumulative}')
+            lines.append(f'dhgate_http_request_duration_seconds_sum{{route="{route}"}} {counts[-1]:.6f}')
+            lines.append(f'dhgate_http_request_duration_seconds_count{{route="{route}"}} {cumulative}')
+        lines += [
+            '# HELP dhgate_http_response_bytes_total Response body bytes sent by route.',
+            '# TYPE dhgate_http_response_bytes_total counter',
+        ]
+        for route in names:
+            lines.append(f'dhgate_http_response_bytes_total{{route="{route}"}} {total.bytes.get(route, 0)}')
+        lines += [
+            '# HELP dhgate_http_requests_in_flight Requests currently being handled.',
+            '# TYPE dhgate_http_requests_in_flight gauge',
+            f'dhgate_http_requests_in_flight {max(total.started - total.finished, 0)}',
+        ]
+        return lines
+
+
+METRICS = RequestMetrics()
+
+# Route label for requests that matched no route (404s, malformed requests)
+UNMATCHED_ROUTE = 'unmatched'
+
+
+def counter_lines(name, help_text, kind, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+
+def hit_ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def render_metrics(server=None):
+    """Full /metrics payload: request metrics plus cache and log counters"""
+    lines = METRICS.render(route.name for route in ROUTER.routes())
+    static = STATIC_CACHE.stats()
+    lines += counter_lines('dhgate_static_cache_hits_total', 'Static file cache hits.', 'counter', static['hits'])
+    lines += counter_lines('dhgate_static_cache_misses_total', 'Static file cache misses.', 'counter', static['misses'])
+    lines += counter_lines('dhgate_static_cache_evictions_total', 'Static file cache evictions.', 'counter', static['evictions'])
+    lines += counter_lines('dhgate_static_cache_entries', 'Files held in the static cache.', 'gauge', static['entries'])
+    lines += counter_lines('dhgate_static_cache_bytes', 'Bytes held in the static cache.', 'gauge', static['bytes'])
+    lines += counter_lines('dhgate_static_cache_hit_ratio', 'Static cache hits per lookup.', 'gauge', f'{hit_ratio(static):.4f}')
+    render = RENDER_CACHE.stats()
+    lines += counter_lines('dhgate_render_cache_hits_total', 'Rendered page cache hits.', 'counter', render['hits'])
+    lines += counter_lines('dhgate_render_cache_misses_total', 'Rendered page cache misses.', 'counter', render['misses'])
+    lines += counter_lines('dhgate_render_cache_entries', 'Page variants held in the render cache.', 'gauge', render['entries'])
+    lines += counter_lines('dhgate_render_cache_hit_ratio', 'Render cache hits per lookup.', 'gauge', f'{hit_ratio(render):.4f}')
+    store = SIGNUP_STORE.stats()
+    lines += counter_lines('dhgate_signup_commits_total', 'Signup store transactions committed.', 'counter', store['commits'])
+    lines += counter_lines('dhgate_signup_writes_total', 'Signup store writes committed.', 'counter', store['writes'])
+    tokens = SIGNUP_STORE.token_cache.stats()
+    lines += counter_lines('dhgate_token_cache_hits_total', 'Dashboard token cache hits.', 'counter', tokens['hits'])
+    lines += counter_lines('dhgate_token_cache_misses_total', 'Dashboard token cache misses.', 'counter', tokens['misses'])
+    lines += counter_lines('dhgate_token_cache_entries', 'Dashboard tokens held in the cache.', 'gauge', tokens['entries'])
+    log = ACCESS_LOG.stats()
+    lines += counter_lines('dhgate_access_log_written_total', 'Access log lines written.', 'counter', log['written'])
+    lines += counter_lines('dhgate_access_log_dropped_total', 'Access log lines dropped on a full queue.', 'counter', log['dropped'])
+    lines += counter_lines('dhgate_access_log_queued', 'Access log lines waiting to be written.', 'gauge', log['queued'])
+    if SHARED_CACHE.enabled:
+        shared = SHARED_CACHE.stats()
+        lines += counter_lines('dhgate_shared_cache_bytes', 'Bytes published to the cross-worker response cache.', 'gauge', shared['bytes'])
+        lines += counter_lines('dhgate_shared_cache_capacity_bytes', 'Size of the cross-worker response cache.', 'gauge', shared['capacity'])
+    if SHARED_COUNTERS.enabled:
+        rows = SHARED_COUNTERS.snapshot()
+        lines += ['# HELP dhgate_worker_requests_total Requests served by each worker process.',
+                  '# TYPE dhgate_worker_requests_total counter']
+        lines += [f'dhgate_worker_requests_total{{worker="{slot}"}} {row["requests"]}'
+                  for slot, row in enumerate(rows)]
+        lines += ['# HELP dhgate_worker_responses_total Responses by worker and status class.',
+                  '# TYPE dhgate_worker_responses_total counter']
+        lines += [f'dhgate_worker_responses_total{{worker="{slot}",class="{name[-3:]}"}} {row[name]}'
+                  for slot, row in enumerate(rows) for name in SHARED_COUNTERS.names
+                  if name.startswith('responses_')]
+        lines += ['# HELP dhgate_worker_response_bytes_total Response body bytes sent by each worker.',
+                  '# TYPE dhgate_worker_response_bytes_total counter']
+        lines += [f'dhgate_worker_response_bytes_total{{worker="{slot}"}} {row["bytes_sent"]}'
+                  for slot, row in enumerate(rows)]
+    admission = ADMISSION.stats()
+    lines += counter_lines('dhgate_admission_in_flight', 'Requests admitted and not yet finished.', 'gauge', admission['in_flight'])
+    lines += counter_lines('dhgate_admission_queued', 'Requests waiting for an admission slot.', 'gauge', admission['queued'])
+    lines += counter_lines('dhgate_admission_overload_rejections_total', 'Requests answered 503 by admission control.', 'counter', admission['rejected_overload'])
+    lines += counter_lines('dhgate_admission_rate_limited_total', 'Requests answered 429 by the per-client rate limit.', 'counter', admission['rejected_rate'])
+    lines += counter_lines('dhgate_admission_clients', 'Client token buckets held.', 'gauge', admission['clients'])
+    events = EVENT_BROADCASTER.stats()
+    lines += counter_lines('dhgate_event_streams', 'Open /events streams.', 'gauge', events['subscribers'])
+    lines += counter_lines('dhgate_events_published_total', 'Events fanned out to streams.', 'counter', events['published'])
+    lines += counter_lines('dhgate_events_delivered_total', 'Event frames queued for streams.', 'counter', events['delivered'])
+    lines += counter_lines('dhgate_event_slow_disconnects_total', 'Streams dropped for falling behind.', 'counter', events['slow_disconnects'])
+    if server is not None and hasattr(server, 'active_connections'):
+        lines += counter_lines('dhgate_open_connections', 'Connections currently being served.', 'gauge', server.active_connections)
+    if server is not None and hasattr(server, 'queued_connections'):
+        lines += counter_lines('dhgate_queued_connections', 'Accepted connections waiting for a worker.', 'gauge', server.queued_connections)
+    return '\n'.join(lines) + '\n'
+
+
+class RequestProfiler:
+    """Opt-in cProfile sampling of route handlers (admin debug surface).
+
+    With sample_every = N about one in N requests runs its handler under
+    cProfile and the stats are merged per route. A session profiles every
+    request for a fixed number of seconds into a single pstats dump. Only
+    one request is profiled at a time: a request that overlaps a profiled
+    one runs unprofiled instead of waiting. While disabled the request path
+    only checks the `active` flag. State is per process, so with --workers
+    every worker keeps its own stats.
+    """
+    max_session_seconds = 300
+
+    def __init__(self):
+        self.sample_every = 0
+        self.active = False
+        self._profile_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = {}    # route name -> pstats.Stats
+        self._samples = {}  # route name -> profiled requests
+        self._session = None
+        self.session_requests = 0
+        self.session_ends = None
+
+    def configure(self, sample_every):
+        self.sample_every = max(0, sample_every)
+        self.active = bool(self.sample_every) or self.session_running()
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._samples.clear()
+
+    def session_running(self):
+        return self.session_ends is not None and time.monotonic() < self.session_ends
+
+    def start_session(self, seconds):
+        seconds = min(max(seconds, 1), self.max_session_seconds)
+        with self._lock:
+            self._session = None
+            self.session_requests = 0
+            self.session_ends = time.monotonic() + seconds
+        self.active = True
+        return seconds
+
+    def session_remaining(self):
+        if not self.session_running():
+            return 0
+        return self.session_ends - time.monotonic()
+
+    def call(self, route, request, query_params):
+        """Run route.handler, under cProfile when this request is picked"""
+        in_session = self.session_running()
+        # Random rather than every Nth, so interleaved routes are not skipped
+        picked = in_session or (self.sample_every and
+                                random.randrange(self.sample_every) == 0)
+        if not picked:
+            if not self.sample_every:
+                self.active = False  # the session has ended
+            return route.handler(request, query_params)
+        if not self._profile_lock.acquire(blocking=False):
+            return route.handler(request, query_params)
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(route.handler, request, query_params)
+        finally:
+            self._profile_lock.release()
+            self._merge(route.name, profile, in_session)
+
+    def _merge(self, name, profile, in_session):
+        profile.create_stats()
+        if not profile.stats:
+            return
+        with self._lock:
+            if in_session:
+                if self._session is None:
+                    self._session = pstats.Stats(profile)
+                else:
+                    self._session.add(profile)
+                self.session_requests += 1
+            if self.sample_every:
+                stats = self._stats.get(name)
+                if stats is None:
+                    self._stats[name] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+                self._samples[name] = self._samples.get(name, 0) + 1
+
+    def report(self, route=None, sort='cumulative', limit=30):
+        """Aggregated per-route stats as text, busiest routes first"""
+        out = io.StringIO()
+        with self._lock:
+            names = [route] if route is not None else sorted(
+                self._samples, key=self._samples.get, reverse=True)
+            out.write(f"sample_every={self.sample_every} routes={len(self._stats)}\n")
+            for name in names:
+                stats = self._stats.get(name)
+                if stats is None:
+                    continue
+                out.write(f"\n=== {name} ({self._samples[name]} profiled requests) ===\n")
+                stats.stream = out
+                stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def session_dump(self):
+        """Last finished session in the pstats file format, or None"""
+        with self._lock:
+            if self._session is None:
+                return None
+            return marshal.dumps(self._session.stats)
+
+
+class AllocationTracer:
+    """tracemalloc snapshots on demand, diffed between two points in time"""
+    ignored = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.snapshots = []  # at most [previous, latest]
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self):
+        with self._lock:
+            self.snapshots = []
+        tracemalloc.stop()
+
+    def snapshot(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.ignored)
+        with self._lock:
+            self.snapshots = self.snapshots[-1:] + [snapshot]
+            return len(self.snapshots)
+
+    def report(self, key_type='lineno', limit=30):
+        """Growth between the last two snapshots, or the top of the only one"""
+        with self._lock:
+            snapshots = list(self.snapshots)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"tracing={self.tracing} traced={current} peak={peak} snapshots={len(snapshots)}"]
+        if len(snapshots) == 2:
+            lines.append(f"--- top {limit} differences since the previous snapshot ---")
+            stats = snapshots[1].compare_to(snapshots[0], key_type)
+        elif snapshots:
+            lines.append(f"--- top {limit} allocations ---")
+            stats = snapshots[0].statistics(key_type)
+        else:
+            stats = []
+        lines.extend(str(stat) for stat in stats[:limit])
+        return '\n'.join(lines) + '\n'
+
+
+class AdmissionController:
+    """Admission control in front of the route handlers.
+
+    Requests are admitted while fewer than max_in_flight are being handled;
+    dynamic routes stop short of that by a `reserve` share, so cheap cached
+    routes (assets, pre-rendered pages) still get in when the dynamic ones
+    are saturated, and they are woken first when a slot frees up. Up to
+    max_queued requests wait at most queue_timeout seconds for a slot; the
+    rest get a 503 with Retry-After before any handler work. The asyncio
+    engine does not wait here: its handler thread pool queue is the queue.
+
+    With client_rate set, every client IP has a token bucket (cheap routes
+    cost a fraction of a token) and an empty bucket means 429. The buckets
+    live in an LRU capped at max_clients entries, so a flood of addresses
+    only evicts idle clients instead of growing memory.
+    """
+
+    cheap_cost = 0.2
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._clients = OrderedDict()  # client ip -> [tokens, last refill]
+        self._clients_lock = threading.Lock()
+        self.in_flight = 0
+        self.queued = 0
+        self.cheap_waiting = 0
+        self.rejected_overload = 0
+        self.rejected_rate = 0
+        self.configure(0, 0, 2.0, 0.25, 0.0, 50.0, 10000)
+
+    def configure(self, max_in_flight=None, max_queued=None, queue_timeout=None, reserve=None,
+                  client_rate=None, client_burst=None, max_clients=None):
+        with self._cond:
+            if max_in_flight is not None:
+                self.max_in_flight = max_in_flight
+            if max_queued is not None:
+                self.max_queued = max_queued
+            if queue_timeout is not None:
+                self.queue_timeout = queue_timeout
+            if reserve is not None:
+                self.reserve = reserve
+            if client_rate is not None:
+                self.client_rate = client_rate
+            if client_burst is not None:
+                self.client_burst = client_burst
+            if max_clients is not None:
+                self.max_clients = max_clients
+            self.dynamic_limit = max(1, int(self.max_in_flight * (1 - self.reserve)))
+
+    def admit(self, client, cheap, wait=True):
+        """None when admitted (release() afterwards), else (status, Retry-After seconds)"""
+        if self.client_rate:
+            retry_after = self._take_token(client, self.cheap_cost if cheap else 1.0)
+            if retry_after:
+                self.rejected_rate += 1
+                return 429, retry_after
+        with self._cond:
+            if not self.max_in_flight:
+                self.in_flight += 1
+                return None
+            limit = self.max_in_flight if cheap else self.dynamic_limit
+            if self._has_room(cheap, limit if wait else limit + self.max_queued):
+                self.in_flight += 1
+                return None
+            if not wait or self.queued >= self.max_queued:
+                self.rejected_overload += 1
+                return 503, max(1, math.ceil(self.queue_timeout))
+            self.queued += 1
+            self.cheap_waiting += cheap
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while not self._has_room(cheap, limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_overload += 1
+                        return 503, max(1, math.ceil(self.queue_timeout))
+                    self._cond.wait(remaining)
+                self.in_flight += 1
+                return None
+            finally:
+                self.queued -= 1
+                self.cheap_waiting -= cheap
+
+    def _has_room(self, cheap, limit):
+        # Waiting cheap requests go first
+        return self.in_flight < limit and (cheap or not self.cheap_waiting)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            if self.queued:
+                self._cond.notify_all()
+
+    def _take_token(self, client, cost):
+        """0 when the client may proceed, else seconds until it has a token again"""
+        now = time.monotonic()
+        with self._clients_lock:
+            bucket = self._clients.get(client)
+            if bucket is None:
+                bucket = self._clients[client] = [self.client_burst, now]
+                if len(self._clients) > self.max_clients:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(client)
+                bucket[0] = min(self.client_burst, bucket[0] + (now - bucket[1]) * self.client_rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            return max(1, math.ceil((cost - bucket[0]) / self.client_rate))
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'queued': self.queued, 'clients': len(self._clients),
+                'rejected_overload': self.rejected_overload, 'rejected_rate': self.rejected_rate}
+
+
+def refusal_response(status, retry_after):
+    """Minimal 429/503 for requests turned away before any handler work"""
+    reason, _ = http.server.BaseHTTPRequestHandler.responses[status]
+    body = reason.encode('ascii')
+    return (f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Retry-After: {retry_after}\r\n"
+            f"Connection: close\r\n\r\n").encode('ascii') + body
+
+
+PROFILER = RequestProfiler()
+ADMISSION = AdmissionController()
+ALLOCATION_TRACER = AllocationTracer()
+
+
+def is_admin(request):
+    """Whether the request carries the admin token (X-Admin-Token or Bearer)"""
+    expected = getattr(request.server, 'admin_token', None)
+    if not expected:
+        return False
+    given = request.headers.get('X-Admin-Token', '')
+    if not given:
+        scheme, _, given = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer':
+            given = ''
+    return bool(given) and hmac.compare_digest(given.encode(), expected.encode())
+
+
+def require_admin(request, route):
+    """Before hook: debug routes answer 404 unless the admin token matches"""
+    if is_admin(request):
+        return False
+    request.send_error(404, f"Not found: {request.route_path}")
+    return True
+
+
 class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
+    """Request handler for all dhgate-monitor.com routes.
+
+    Concurrency: the server creates a fresh handler instance for every
+    connection, so per-request state lives on the instance. The handlers
+    also share these module singletons, each synchronised on its own:
+
+      ROUTER, templates, constants  built at import, read-only afterwards
+      STATIC_CACHE, RENDER_CACHE    one lock around the entry maps
+      METRICS                       per-thread shards; scrapes take a lock
+      ACCESS_LOG                    bounded queue, one writer thread
+      ADMISSION                     a Condition for slots, a lock for buckets
+      PROFILER, ALLOCATION_TRACER   a lock; PROFILER profiles one request
+                                    at a time (non-blocking acquire)
+      SIGNUP_STORE                  writes go to its single writer thread;
+                                    reads use a connection per thread
+      EVENT_BROADCASTER/STREAMS     a lock; streams run on their own thread
+      PRICE_HISTORY                 an RLock around the read-only segments
+      SHARED_CACHE                  seqlock; only the supervisor writes it
+      SHARED_COUNTERS               a lane per thread; overflow lane locked
+
+    Any new module-level state shared between requests must either be
+    immutable or guarded the same way.
+    """
+
+    # Headers and body go out as separate writes; with Nagle enabled the
+    # body waits for the client's delayed ACK (~40 ms) on keep-alive
+    disable_nagle_algorithm = True
+
+    # Per-request state, reset for every request on a keep-alive connection
+    requests_left = None  # None = no cap on requests per connection
+    body_consumed = False
+    response_status = None
+    response_framed = False
+    route = None
+    route_path = None
+    cache_status = None
+    bytes_sent = 0
+    dispatched = False
+    event_stream = None
+    # The asyncio engine admits requests before they reach a handler thread
+    admission_control = True
+    
+    def setup(self):
+        # Per-connection socket timeout so a stalled client cannot hold a
+        # worker thread forever
+        self.timeout = getattr(self.server, 'request_timeout', None)
+        self.protocol_version = getattr(self.server, 'protocol_version', self.protocol_version)
+        super().setup()
+    
+    def handle(self):
+        """Serve requests on one connection until framing or limits require closing"""
+        max_requests = getattr(self.server, 'max_keepalive_requests', 0)
+        self.requests_left = max_requests or None
+        self.close_connection = True
+        self.handle_request()
+        while not self.close_connection and self.wait_for_next_request():
+            self.handle_request()
+    
+    def handle_request(self):
+        self.body_consumed = False
+        self.handle_one_request()
+        if self.requests_left is not None:
+            self.requests_left -= 1
+    
+    def handle_one_request(self):
+        self.response_status = None
+        self.route = None
+        self.route_path = None
+        self.cache_status = None
+        self.bytes_sent = 0
+        self.dispatched = False
+        started = time.perf_counter()
+        super().handle_one_request()
+        if self.response_status is not None:
+            duration = time.perf_counter() - started
+            route = self.route
+            METRICS.observe(route.name if route is not None else UNMATCHED_ROUTE,
+                            self.response_status, duration, self.bytes_sent,
+                            started=self.dispatched)
+            SHARED_COUNTERS.record_response(self.response_status, self.bytes_sent)
+            ACCESS_LOG.log_request(self, duration)
+    
+    def log_request(self, code='-', size='-'):
+        # Replaced by the structured access log written after each request
+        pass
+    
+    def log_message(self, format, *args):
+        ACCESS_LOG.log_message(self.client_address[0] if self.client_address else '-',
+                               format % args)
+    
+    def wait_for_next_request(self):
+        """Wait up to the keep-alive timeout for the next request on this connection"""
+        if self.server.idle_connections_should_close():
+            return False
+        self.connection.settimeout(getattr(self.server, 'keepalive_timeout', None))
+        self.server.connection_idle(True)
+        try:
+            # Returns at once when a pipelined request is already buffered
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.server.connection_idle(False)
+            self.connection.settimeout(self.timeout)
+    
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.response_framed = False
+        super().send_response(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() in ('content-length', 'transfer-encoding'):
+            self.response_framed = True
+        super().send_header(keyword, value)
+    
+    def end_headers(self):
+        if not self.close_connection and self.response_status is not None:
+            if self.must_close():
+                self.send_header('Connection', 'close')
+            elif self.request_version == 'HTTP/1.0':
+                # HTTP/1.0 clients only keep the connection when told so
+                self.send_header('Connection', 'keep-alive')
+        super().end_headers()
+    
+    def must_close(self):
+        """Whether the response on its own requires closing the connection"""
+        if self.requests_left is not None and self.requests_left <= 1:
+            return True
+        if not self.body_consumed and (
+                self.headers.get('Content-Length', '0').strip() not in ('', '0')
+                or 'Transfer-Encoding' in self.headers):
+            # An unread request body would be parsed as the next request
+            return True
+        status = self.response_status
+        has_body = status >= 200 and status not in (204, 304)
+        return has_body and not self.response_framed and self.command != 'HEAD'
+
     def do_GET(self):
+        self.dispatch()
+    
+    def do_HEAD(self):
+        self.dispatch()
+    
+    def do_OPTIONS(self):
+        self.dispatch()
+    
+    # Dispatched too, so known routes answer 405 instead of 501
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+    
+    def dispatch(self):
+        """Resolve the route and run it with its before/after hooks"""
+        METRICS.request_started()
+        self.dispatched = True
         # Parse URL and query parameters
         parsed_url = urllib.parse.urlparse(self.path)
         path = parsed_url.path
+        self.route_path = path
         query_params = urllib.parse.parse_qs(parsed_url.query)
         
-        print(f"🌐 Request: {path} with params: {query_params}")
-        
-        # Handle different routes
-        if path == "/" or path == "":
-            # Homepage
-            self.serve_file("index.html")
-        elif path == "/dashboard":
-            # Dashboard page
-            self.serve_dashboard(query_params)
-        elif path == "/newsroom":
-            # Newsroom page
-            self.serve_newsroom(query_params)
-        elif path == "/service":
-            # Service page
-            self.serve_service(query_params)
-        elif path == "/contact":
-            # Contact page
-            self.serve_contact(query_params)
-        elif path == "/privacy":
-            # Privacy page
-            self.serve_privacy(query_params)
-        elif path == "/terms":
-            # Terms page
-            self.serve_terms(query_params)
-        elif path == "/delete-data":
-            # Delete data page
-            self.serve_delete_data(query_params)
-        elif path == "/add_shop":
-            # Add shop page
-            self.serve_add_shop(query_params)
-        elif path == "/settings":
-            # Settings page
-            self.serve_settings(query_params)
-        elif path == "/unsubscribe":
-            # Unsubscribe page
-            self.serve_unsubscribe(query_params)
-        elif path.startswith("/assets/"):
-            # Serve static assets
-            self.serve_file(path[1:])  # Remove leading slash
-        elif path == "/signup-widget.js":
-            # Serve widget script
-            self.serve_file("signup-widget.js")
-        elif path == "/favicon.ico":
-            # Serve favicon or return 404
-            self.send_error(404, "Favicon not found")
-        else:
-            # Default: serve homepage
-            print(f"⚠️ Unknown route: {path}, serving homepage")
-            self.serve_file("index.html")
+        if self.command == 'OPTIONS' and self.path == '*':
+            self.send_allow(ROUTER.methods)
+            return
+        
+        route = ROUTER.resolve(path)
+        self.route = route
+        if route is None:
+            self.send_error(404, f"Not found: {path}")
+            return
+        if self.command == 'OPTIONS':
+            self.send_allow(route.allow)
+            return
+        if self.command not in route.methods:
+            self.send_error(405, headers=(('Allow', route.allow),))
+            return
+        if self.admission_control and not self.admit(route):
+            return
+        
+        try:
+            try:
+                for hook in ROUTER.before_hooks + route.before_hooks:
+                    if hook(self, route):
+                        return  # the hook has answered the request itself
+                if PROFILER.active:
+                    PROFILER.call(route, self, query_params)
+                else:
+                    route.handler(self, query_params)
+            finally:
+                for hook in route.after_hooks + ROUTER.after_hooks:
+                    hook(self, route)
+        finally:
+            if self.admission_control:
+                ADMISSION.release()
+    
+    def admit(self, route):
+        """Admission control; False after answering with a 429 or 503"""
+        refusal = ADMISSION.admit(self.client_address[0] if self.client_address else '-',
+                                  route.cheap and self.command in ('GET', 'HEAD'))
+        if refusal is None:
+            return True
+        status, retry_after = refusal
+        self.close_connection = True
+        self.send_error(status, headers=(('Retry-After', str(retry_after)), ('Connection', 'close')))
+        return False
+    
+    def send_allow(self, allow):
+        self.send_response(204)
+        self.send_header('Allow', allow)
+        self.end_headers()
+    
+    def write_body(self, data):
+        """Write a response body, or nothing for HEAD"""
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+            self.bytes_sent += len(data)
+    
+    def send_error(self, code, message=None, explain=None, headers=()):
+        """BaseHTTPRequestHandler.send_error with optional extra headers"""
+        try:
+            shortmsg, longmsg = self.responses[code]
+        except KeyError:
+            shortmsg, longmsg = '???', '???'
+        if message is None:
+            message = shortmsg
+        if explain is None:
+            explain = longmsg
+        self.log_error("code %d, message %s", code, message)
+        self.send_response(code, message)
+        if code in CLOSING_ERROR_CODES:
+            self.send_header('Connection', 'close')
+        for name, value in headers:
+            self.send_header(name, value)
+        
+        body = None
+        if code >= 200 and code not in (204, 205, 304):
+            content = (self.error_message_format % {
+                'code': code,
+                'message': html.escape(message, quote=False),
+                'explain': html.escape(explain, quote=False)
+            })
+            body = content.encode('UTF-8', 'replace')
+            self.send_header("Content-Type", self.error_content_type)
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        
+        if body:
+            self.write_body(body)
+    
+    def serve_homepage(self, query_params):
+        """Serve homepage"""
+        self.serve_file("index.html")
+    
+    def serve_widget(self, query_params):
+        """Serve widget script"""
+        self.serve_file("signup-widget.js")
+    
+    def serve_asset(self, query_params):
+        """Serve static assets"""
+        self.serve_file(self.route_path[1:], root="assets")  # Remove leading slash
+    
+    def serve_metrics(self, query_params):
+        """Serve request and cache metrics for Prometheus"""
+        self.send_bytes(render_metrics(self.server).encode('utf-8'),
+                        'text/plain; version=0.0.4; charset=utf-8')
+    
+    def serve_debug_profile(self, query_params):
+        """GET: per-route cProfile report; POST: set ?sample=N, ?reset=1"""
+        try:
+            if self.command == 'POST':
+                if 'sample' in query_params:
+                    PROFILER.configure(int(query_params['sample'][0]))
+                if query_params.get('reset', ['0'])[0] not in ('', '0'):
+                    PROFILER.reset()
+                self.send_text(f"sample_every={PROFILER.sample_every}\n")
+                return
+            limit = int(query_params.get('limit', ['30'])[0])
+        except ValueError:
+            self.send_error(400, "sample and limit must be integers")
+            return
+        sort = query_params.get('sort', ['cumulative'])[0]
+        route = query_params.get('route', [None])[0]
+        try:
+            self.send_text(PROFILER.report(route, sort, limit))
+        except KeyError:
+            self.send_error(400, f"Unknown sort key: {sort}")
+    
+    def serve_debug_profile_session(self, query_params):
+        """POST: profile every request for ?seconds=N; GET: download the pstats file"""
+        if self.command == 'POST':
+            try:
+                seconds = PROFILER.start_session(float(query_params.get('seconds', ['30'])[0]))
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            self.send_text(f"session running for {seconds:g}s\n", status=202)
+            return
+        if PROFILER.session_running():
+            remaining = PROFILER.session_remaining()
+            self.send_error(409, f"Session still running for {remaining:.0f}s",
+                            headers=(('Retry-After', str(int(remaining) + 1)),))
+            return
+        dump = PROFILER.session_dump()
+        if dump is None:
+            self.send_error(404, "No profiling session recorded")
+            return
+        filename = time.strftime('dhgate-profile-%Y%m%d-%H%M%S.pstats')
+        self.send_bytes(dump, 'application/octet-stream', headers=(
+            ('Content-Disposition', f'attachment; filename="{filename}"'),
+            ('X-Profiled-Requests', str(PROFILER.session_requests)),
+        ))
+    
+    def serve_debug_tracemalloc(self, query_params):
+        """GET: snapshot diff; POST ?action=start|snapshot|stop"""
+        if self.command == 'POST':
+            action = query_params.get('action', ['snapshot'])[0]
+            if action == 'start':
+                try:
+                    ALLOCATION_TRACER.start(int(query_params.get('frames', ['1'])[0]))
+                except ValueError:
+                    self.send_error(400, "frames must be an integer")
+                    return
+            elif action == 'stop':
+                ALLOCATION_TRACER.stop()
+            elif action == 'snapshot':
+                if not ALLOCATION_TRACER.tracing:
+                    self.send_error(409, "tracemalloc is not tracing; POST action=start first")
+                    return
+                ALLOCATION_TRACER.snapshot()
+            else:
+                self.send_error(400, f"Unknown action: {action}")
+                return
+        key_type = query_params.get('key', ['lineno'])[0]
+        if key_type not in ('lineno', 'filename', 'traceback'):
+            self.send_error(400, f"Unknown key: {key_type}")
+            return
+        try:
+            limit = int(query_params.get('limit', ['30'])[0])
+        except ValueError:
+            self.send_error(400, "limit must be an integer")
+            return
+        self.send_text(ALLOCATION_TRACER.report(key_type, limit))
+    
+    def serve_widget_signup(self, query_params):
+        """Widget signup API: JSON {email, stores, tags, lang} -> dashboardToken"""
+        data = self.read_request_data()
+        if data is None:
+            return
+        lang = data.get('lang') if data.get('lang') in SUPPORTED_LANGS else 'en'
+        try:
+            result = SIGNUP_STORE.signup(data.get('email'), data.get('stores'),
+                                         data.get('tags'), lang)
+        except signup_store.ValidationError as e:
+            self.send_json({'success': False, 'message': str(e)}, status=400)
+            return
+        except concurrent.futures.TimeoutError:
+            self.send_json({'success': False, 'message': 'Signup is busy, try again'}, status=503,
+                           headers=(('Retry-After', '1'),))
+            return
+        if result['created']:
+            EVENT_BROADCASTER.publish(event_stream.ADMIN_CHANNEL, 'signup',
+                                      {'id': result['id'], 'lang': lang})
+        message = ("Monitoring geactiveerd! Je ontvangt emails wanneer er nieuwe producten "
+                   "gevonden worden in de geselecteerde winkels." if lang == 'nl' else
+                   "Monitoring activated! You'll receive emails when new matching products "
+                   "are found in your selected stores.")
+        self.send_json({'success': True, 'message': message, 'emailSent': False,
+                        'dashboardToken': result['dashboard_token']})
+    
+    def serve_events(self, query_params):
+        """Server-Sent Events stream replacing dashboard and admin polling.
+
+        Everyone gets the public channel; ?key=<dashboard token> adds the
+        subscription's own events and those of the stores it follows, and
+        ?channel=admin with the admin token adds admin notifications.
+        Last-Event-ID (or ?lastEventId= for polyfills) resumes a stream.
+        """
+        channels = {event_stream.PUBLIC_CHANNEL}
+        key = query_params.get('key', query_params.get('token', ['']))[0]
+        if key:
+            subscription = SIGNUP_STORE.resolve_dashboard_token(key)
+            if subscription is None:
+                self.send_error(403, "Invalid or expired dashboard key")
+                return
+            channels.add(event_stream.subscription_channel(subscription['id']))
+            channels.update(event_stream.store_channel(store)
+                            for store in SIGNUP_STORE.stores_for_subscription(subscription['id']))
+        if query_params.get('channel', [''])[0] == event_stream.ADMIN_CHANNEL:
+            if not is_admin(self):
+                self.send_error(403, "Admin token required")
+                return
+            channels.add(event_stream.ADMIN_CHANNEL)
+        last_event_id = self.headers.get('Last-Event-ID') or query_params.get('lastEventId', [''])[0]
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-store')
+        # Keeps reverse proxies from buffering the stream
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.start_event_stream(EVENT_BROADCASTER.subscribe(channels, last_event_id))
+    
+    def start_event_stream(self, subscriber):
+        """Hand the connection to the event stream loop; no handler thread stays behind"""
+        self.event_stream = subscriber
+        self.close_connection = True
+        self.wfile.flush()
+        # The server's shutdown_request() now finds a closed socket object
+        # and leaves the connection itself alone
+        EVENT_STREAMS.attach(socket.socket(fileno=self.connection.detach()), subscriber)
     
-    def serve_file(self, filename):
+    def serve_price_history(self, query_params):
+        """Dashboard charts: ?product=<id>[,<id>...]&days=30[&tier=raw|hourly|daily]
+
+        One product gets its chart points and rollup; several get rollups only.
+        """
+        products = [value for value in query_params.get('product', [''])[0].split(',') if value]
+        try:
+            days = float(query_params.get('days', ['30'])[0])
+        except ValueError:
+            self.send_json({'success': False, 'message': 'days must be a number'}, status=400)
+            return
+        tier = query_params.get('tier', [None])[0]
+        if not products or len(products) > MAX_HISTORY_PRODUCTS or not 0 < days <= MAX_HISTORY_DAYS \
+                or tier not in (None, *price_history.TIERS):
+            self.send_json({'success': False, 'message': 'Invalid product, days or tier'}, status=400)
+            return
+        if PRICE_HISTORY.directory is None:
+            self.send_json({'success': False, 'message': 'Price history is not enabled'}, status=404)
+            return
+        end = int(time.time()) + 1
+        start = end - int(days * 86400)
+        keys = {change_detection.product_key(product): product for product in products}
+        summaries = PRICE_HISTORY.summaries(list(keys), start, end, tier)
+        payload = {'success': True, 'start': start, 'end': end,
+                   'summaries': {product: summaries.get(key) for key, product in keys.items()}}
+        if len(keys) == 1:
+            payload.update(PRICE_HISTORY.series(next(iter(keys)), start, end, tier))
+        self.send_json(payload)
+    
+    def handle_form(self, query_params, save):
+        """Run save(data, query_params) for a form or JSON POST and answer it.
+        
+        Forms get a 303 redirect to the returned URL (post/redirect/get);
+        JSON requests get the returned payload as JSON.
+        """
+        data = self.read_request_data()
+        if data is None:
+            return
+        as_json = self.wants_json()
+        try:
+            payload, location = save(data, query_params)
+        except signup_store.ValidationError as e:
+            if as_json:
+                self.send_json({'success': False, 'message': str(e)}, status=400)
+            else:
+                self.send_error(400, str(e))
+            return
+        except concurrent.futures.TimeoutError:
+            self.send_error(503, "Database busy", headers=(('Retry-After', '1'),))
+            return
+        if as_json:
+            self.send_json(payload)
+            return
+        self.send_response(303)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def read_request_data(self):
+        """Request body as a dict (JSON or form encoded); None after an error reply"""
+        if 'Transfer-Encoding' in self.headers:
+            self.send_error(411, "Chunked request bodies are not supported")
+            return None
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return None
+        if length < 0:
+            self.send_error(400, "Invalid Content-Length")
+            return None
+        if length > MAX_BODY_BYTES:
+            self.send_error(413, "Request body too large")
+            return None
+        body = self.rfile.read(length) if length else b''
+        self.body_consumed = True
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        try:
+            if content_type == 'application/json':
+                data = json.loads(body or b'{}')
+                if not isinstance(data, dict):
+                    raise ValueError("expected an object")
+                return data
+            fields = urllib.parse.parse_qs(body.decode('utf-8'), keep_blank_values=True)
+            return {name: values[0] for name, values in fields.items()}
+        except (ValueError, UnicodeDecodeError):
+            if self.wants_json():
+                self.send_json({'success': False, 'message': 'Invalid request body'}, status=400)
+            else:
+                self.send_error(400, "Invalid request body")
+            return None
+    
+    def wants_json(self):
+        content_type = self.headers.get('Content-Type', '')
+        return 'application/json' in content_type or 'application/json' in self.headers.get('Accept', '')
+    
+    @staticmethod
+    def page_url(path, **params):
+        query = urllib.parse.urlencode({name: value for name, value in params.items() if value})
+        return f"{path}?{query}" if query else path
+    
+    def send_json(self, payload, status=200, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_bytes(body, 'application/json; charset=utf-8', status, headers,
+                        cache_control='no-store')
+    
+    def send_text(self, text, status=200):
+        self.send_bytes(text.encode('utf-8'), 'text/plain; charset=utf-8', status)
+    
+    def send_bytes(self, body, content_type, status=200, headers=(), cache_control=None):
+        """Send a complete, uncached response body"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache_control or cache_control_for(self.route_path))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.write_body(body)
+    
+    def serve_file(self, filename, root=None):
         """Serve a static file"""
         try:
-            with open(filename, 'rb') as f:
-                content = f.read()
+            path = static_path(filename, root)
+            if path is None:
+                raise FileNotFoundError(filename)
+            entry, hit = STATIC_CACHE.lookup(path)
+            self.cache_status = 'hit' if hit else 'miss'
+            cache_control = cache_control_for(self.route_path)
             
-            # Determine content type
-            if filename.endswith('.html'):
-                content_type = 'text/html; charset=utf-8'
-            elif filename.endswith('.js'):
-                content_type = 'application/javascript; charset=utf-8'
-            elif filename.endswith('.css'):
-                content_type = 'text/css; charset=utf-8'
-            elif filename.endswith('.png'):
-                content_type = 'image/png'
-            elif filename.endswith('.svg'):
-                content_type = 'image/svg+xml'
-            else:
-                content_type = 'text/plain; charset=utf-8'
+            byte_range = None
+            range_header = self.headers.get('Range')
+            if range_header and self.if_range_matches(entry):
+                byte_range = parse_byte_range(range_header, entry.size)
+            
+            representation = entry
+            if entry.compressible and byte_range is None:
+                encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+                if encoding:
+                    representation = STATIC_CACHE.variant(entry, encoding) or entry
+            
+            if self.is_not_modified(representation.etag, entry.mtime):
+                self.send_not_modified(representation.etag, cache_control, entry.last_modified,
+                                       'Accept-Encoding' if entry.compressible else None)
+                return
+            
+            if byte_range == RANGE_NOT_SATISFIABLE:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{entry.size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            
+            if byte_range is not None:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Type', entry.content_type)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{entry.size}')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.send_header('ETag', entry.etag)
+                self.send_header('Last-Modified', entry.last_modified)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
+                self.send_entry_body(entry, start, end - start + 1)
+                return
             
             self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', str(len(content)))
+            for name, value in representation.headers:
+                self.send_header(name, value)
+            self.send_header('Cache-Control', cache_control)
             self.end_headers()
-            self.wfile.write(content)
+            if representation is entry:
+                self.send_entry_body(entry, 0, entry.size)
+            else:
+                self.write_body(representation.body)
             
-        except FileNotFoundError:
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
             self.send_error(404, f"File not found: {filename}")
         except Exception as e:
             self.send_error(500, f"Server error: {str(e)}")
     
-    def serve_dashboard(self, query_params):
-        """Serve dashboard page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
+    def if_range_matches(self, entry):
+        """A Range request only applies if If-Range (when sent) still matches"""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == entry.etag  # strong comparison
+        try:
+            since = email.utils.parsedate_to_datetime(if_range)
+        except (TypeError, ValueError, IndexError):
+            return False
+        return since is not None and since.tzinfo is not None and entry.mtime == int(since.timestamp())
+    
+    def send_entry_body(self, entry, offset, count):
+        """Write part of a static file from memory, or stream it when large"""
+        if self.command == 'HEAD':
+            return
+        if entry.body is not None and count < STATIC_CACHE.stream_threshold:
+            self.wfile.write(memoryview(entry.body)[offset:offset + count])
+            self.bytes_sent += count
+        else:
+            self.send_file_body(entry.path, offset, count)
+    
+    def send_file_body(self, path, offset, count):
+        """Stream a byte range of a file to the client with sendfile (zero-copy)"""
+        with open(path, 'rb') as f:
+            self.wfile.flush()
+            sent = self.connection.sendfile(f, offset, count)
+        self.bytes_sent += sent
+        if sent < count:
+            # The file shrank after the headers went out; the response is
+            # short, so the connection cannot be reused
+            self.close_connection = True
+    
+    def is_not_modified(self, etag, mtime=None):
+        """Evaluate If-None-Match / If-Modified-Since (RFC 7232 precedence)"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None or mtime is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError, IndexError):
+            return False
+        if since is None or since.tzinfo is None:
+            return False
+        return mtime <= since.timestamp()
+    
+    def send_not_modified(self, etag, cache_control, last_modified=None, vary=None):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', cache_control)
+        if vary:
+            self.send_header('Vary', vary)
+        self.end_headers()
+    
+    def serve_page(self, page, query_params):
+        """Serve a pre-rendered page from the render cache"""
+        lang, theme = page_params(query_params)
+        rendered, hit = RENDER_CACHE.lookup(page, lang, theme)
+        self.cache_status = 'hit' if hit else 'miss'
+        self.send_rendered(rendered)
+    
+    def send_rendered(self, page):
+        """Send a RenderedPage, compressed and/or as 304 where possible"""
+        cache_control = cache_control_for(self.route_path)
+        
+        representation = page
+        encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        if encoding:
+            representation = page.variant(encoding) or page
         
+        if self.is_not_modified(representation.etag):
+            self.send_not_modified(representation.etag, cache_control, vary='Accept-Encoding')
+            return
+        
+        self.send_response(200)
+        for name, value in representation.headers:
+            self.send_header(name, value)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        self.write_body(representation.body)
+    
+    def send_html(self, html):
+        """Send a one-off page with a content ETag and the route's Cache-Control"""
+        self.send_rendered(RenderedPage(html.encode('utf-8'), cache_variants=False))
+    
+    def serve_dashboard(self, query_params):
+        """Serve dashboard page; a ?key= (or ?token=) must be a valid dashboard token"""
+        token = query_params.get('key', query_params.get('token', ['']))[0]
+        if token and SIGNUP_STORE.resolve_dashboard_token(token) is None:
+            self.send_error(403, "Invalid or expired dashboard key")
+            return
+        self.serve_page('dashboard', query_params)
+    
+    @staticmethod
+    def render_dashboard(lang, theme):
+        """Render dashboard page"""
         dashboard_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -159,16 +1902,15 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(dashboard_html.encode('utf-8'))
+        return dashboard_html
     
     def serve_newsroom(self, query_params):
         """Serve newsroom page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        self.serve_page('newsroom', query_params)
+    
+    @staticmethod
+    def render_newsroom(lang, theme):
+        """Render newsroom page"""
         newsroom_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -214,16 +1956,15 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(newsroom_html.encode('utf-8'))
+        return newsroom_html
     
     def serve_service(self, query_params):
         """Serve service page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        self.serve_page('service', query_params)
+    
+    @staticmethod
+    def render_service(lang, theme):
+        """Render service page"""
         service_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -269,16 +2010,25 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(service_html.encode('utf-8'))
+        return service_html
     
     def serve_contact(self, query_params):
-        """Serve contact page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        """Serve contact page; POST stores the message"""
+        if self.command == 'POST':
+            self.handle_form(query_params, self.save_contact_message)
+            return
+        self.serve_page('contact', query_params)
+    
+    def save_contact_message(self, data, query_params):
+        result = SIGNUP_STORE.save_contact_message(data.get('name'), data.get('email'),
+                                                   data.get('message'))
+        EVENT_BROADCASTER.publish(event_stream.ADMIN_CHANNEL, 'contact', {'id': result['id']})
+        lang, theme = page_params(query_params)
+        return {'success': True}, self.page_url('/contact', lang=lang, theme=theme, sent='1')
+    
+    @staticmethod
+    def render_contact(lang, theme):
+        """Render contact page"""
         contact_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -306,7 +2056,7 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
         </div>
         
         <div class="contact-form">
-            <form>
+            <form method="post">
                 <div class="form-group">
                     <label for="name">Name:</label>
                     <input type="text" id="name" name="name" required>
@@ -330,16 +2080,15 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(contact_html.encode('utf-8'))
+        return contact_html
     
     def serve_privacy(self, query_params):
         """Serve privacy page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        self.serve_page('privacy', query_params)
+    
+    @staticmethod
+    def render_privacy(lang, theme):
+        """Render privacy page"""
         privacy_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -381,16 +2130,15 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(privacy_html.encode('utf-8'))
+        return privacy_html
     
     def serve_terms(self, query_params):
         """Serve terms page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        self.serve_page('terms', query_params)
+    
+    @staticmethod
+    def render_terms(lang, theme):
+        """Render terms page"""
         terms_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -432,16 +2180,15 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(terms_html.encode('utf-8'))
+        return terms_html
     
     def serve_delete_data(self, query_params):
         """Serve delete data page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        self.serve_page('delete_data', query_params)
+    
+    @staticmethod
+    def render_delete_data(lang, theme):
+        """Render delete data page"""
         delete_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -486,16 +2233,29 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(delete_html.encode('utf-8'))
+        return delete_html
     
     def serve_add_shop(self, query_params):
-        """Serve add shop page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        """Serve add shop page; POST adds the shop to the subscription"""
+        if self.command == 'POST':
+            self.handle_form(query_params, self.save_shop)
+            return
+        self.serve_page('add_shop', query_params)
+    
+    def save_shop(self, data, query_params):
+        key = data.get('key') or query_params.get('key', [''])[0]
+        result = SIGNUP_STORE.add_shop(key, data.get('shop_url'), data.get('shop_name'),
+                                       data.get('monitoring_type'))
+        event = {'store': result['store']}
+        EVENT_BROADCASTER.publish(event_stream.subscription_channel(result['id']), 'shop_added', event)
+        EVENT_BROADCASTER.publish(event_stream.ADMIN_CHANNEL, 'shop_added', event)
+        lang, theme = page_params(query_params)
+        return ({'success': True, 'store': result['store']},
+                self.page_url('/dashboard', key=key, lang=lang, theme=theme))
+    
+    @staticmethod
+    def render_add_shop(lang, theme):
+        """Render add shop page"""
         add_shop_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -523,7 +2283,7 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
         </div>
         
         <div class="form">
-            <form>
+            <form method="post">
                 <div class="form-group">
                     <label for="shop_url">Shop URL:</label>
                     <input type="url" id="shop_url" name="shop_url" placeholder="https://www.dhgate.com/store/..." required>
@@ -551,16 +2311,26 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(add_shop_html.encode('utf-8'))
+        return add_shop_html
     
     def serve_settings(self, query_params):
-        """Serve settings page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
-        
+        """Serve settings page; POST saves language and notifications"""
+        if self.command == 'POST':
+            self.handle_form(query_params, self.save_settings)
+            return
+        self.serve_page('settings', query_params)
+    
+    def save_settings(self, data, query_params):
+        key = data.get('key') or query_params.get('key', [''])[0]
+        lang = data.get('language') or data.get('lang')
+        SIGNUP_STORE.update_settings(key, lang, data.get('notifications'))
+        _, theme = page_params(query_params)
+        theme = data.get('theme') if data.get('theme') in SUPPORTED_THEMES else theme
+        return {'success': True}, self.page_url('/settings', key=key, lang=lang, theme=theme)
+    
+    @staticmethod
+    def render_settings(lang, theme):
+        """Render settings page"""
         settings_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -588,7 +2358,7 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
         </div>
         
         <div class="settings">
-            <form>
+            <form method="post">
                 <div class="setting-group">
                     <label for="language">Language:</label>
                     <select id="language" name="language">
@@ -622,17 +2392,60 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(settings_html.encode('utf-8'))
+        return settings_html
     
     def serve_unsubscribe(self, query_params):
-        """Serve unsubscribe page"""
-        lang = query_params.get('lang', ['en'])[0]
-        theme = query_params.get('theme', ['light'])[0]
+        """Serve unsubscribe page; POST (also RFC 8058 one-click) unsubscribes the token"""
+        if self.command == 'POST':
+            self.handle_form(query_params, self.confirm_unsubscribe)
+            return
+        if query_params.get('status', [''])[0] == 'unsubscribed':
+            self.serve_page('unsubscribed', query_params)
+            return
+        lang, theme = page_params(query_params)
         token = query_params.get('token', [''])[0]
-        
+        self.send_rendered(UNSUBSCRIBE_TEMPLATE.render(lang, theme, html.escape(token)))
+    
+    def confirm_unsubscribe(self, data, query_params):
+        token = data.get('token') or query_params.get('token', [''])[0]
+        if SIGNUP_STORE.unsubscribe(token) is None:
+            raise signup_store.ValidationError("Unknown unsubscribe link")
+        lang, theme = page_params(query_params)
+        return ({'success': True},
+                self.page_url('/unsubscribe', status='unsubscribed', lang=lang, theme=theme))
+    
+    @staticmethod
+    def render_unsubscribed(lang, theme):
+        """Render the unsubscribe confirmation page"""
+        return f"""
+<!DOCTYPE html>
+<html lang="{lang}">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Unsubscribed - DHgate Monitor</title>
+    <style>
+        body {{ font-family: Arial, sans-serif; margin: 40px; background: {'#1a1a1a' if theme == 'dark' else '#f5f5f5'}; color: {'#ffffff' if theme == 'dark' else '#333333'}; }}
+        .container {{ max-width: 600px; margin: 0 auto; }}
+        .content {{ background: {'#2a2a2a' if theme == 'dark' else '#ffffff'}; padding: 30px; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); text-align: center; }}
+        .btn {{ display: inline-block; padding: 10px 20px; background: #007bff; color: white; text-decoration: none; border-radius: 5px; margin: 5px; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="content">
+            <h2>✅ {'Je bent uitgeschreven' if lang == 'nl' else 'You have been unsubscribed'}</h2>
+            <p>{'Je ontvangt geen emails meer van DHgate Monitor.' if lang == 'nl' else 'You will no longer receive emails from DHgate Monitor.'}</p>
+            <a href="/?lang={lang}&theme={theme}" class="btn">← {'Terug naar de homepage' if lang == 'nl' else 'Back to Homepage'}</a>
+        </div>
+    </div>
+</body>
+</html>
+        """
+    
+    @staticmethod
+    def render_unsubscribe(lang, theme, token):
+        """Render unsubscribe page"""
         unsubscribe_html = f"""
 <!DOCTYPE html>
 <html lang="{lang}">
@@ -665,7 +2478,9 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
             
             <p>This will stop all email notifications from DHgate Monitor.</p>
             
-            <button class="btn btn-danger">Unsubscribe</button>
+            <form method="post" style="display: inline;">
+                <button type="submit" class="btn btn-danger">Unsubscribe</button>
+            </form>
             <a href="/?lang={lang}&theme={theme}" class="btn">Cancel</a>
         </div>
     </div>
@@ -673,40 +2488,1327 @@ class DHgateMonitorHandler(http.server.SimpleHTTPRequestHandler):
 </html>
         """
         
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(unsubscribe_html.encode('utf-8'))
+        return unsubscribe_html
+
+class Route:
+    """A registered route: handler, allowed methods and per-route hooks.
+
+    Before hooks run as hook(request, route) ahead of the handler; a hook
+    that returns True has sent the response itself and the handler is
+    skipped. After hooks always run, also when the handler raised.
+    """
+    __slots__ = ('path', 'handler', 'methods', 'allow', 'name', 'cheap', 'before_hooks',
+                 'after_hooks')
+
+    def __init__(self, path, handler, methods=('GET', 'HEAD'), name=None, cheap=False):
+        self.path = path
+        self.handler = handler
+        self.methods = frozenset(methods)
+        self.allow = ', '.join(sorted(self.methods | {'OPTIONS'}))
+        self.name = name or path
+        # Served from a cache on GET/HEAD; admitted ahead of dynamic routes
+        self.cheap = cheap
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add_methods(self, *methods):
+        self.methods = self.methods | frozenset(methods)
+        self.allow = ', '.join(sorted(self.methods | {'OPTIONS'}))
+
+    def add_before_hook(self, hook):
+        self.before_hooks.append(hook)
+
+    def add_after_hook(self, hook):
+        self.after_hooks.append(hook)
+
+
+class Router:
+    """Exact-match dict plus a short list of prefix routes"""
+
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = []
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add(self, path, handler, methods=('GET', 'HEAD'), name=None, cheap=False):
+        route = self.exact[path] = Route(path, handler, methods, name, cheap)
+        return route
+
+    def add_prefix(self, prefix, handler, methods=('GET', 'HEAD'), name=None, cheap=False):
+        route = Route(prefix, handler, methods, name or prefix + '*', cheap)
+        self.prefixes.append((prefix, route))
+        # Longest prefix wins
+        self.prefixes.sort(key=lambda item: len(item[0]), reverse=True)
+        return route
+
+    def resolve(self, path):
+        route = self.exact.get(path)
+        if route is not None:
+            return route
+        for prefix, route in self.prefixes:
+            if path.startswith(prefix):
+                return route
+        return None
+
+    def routes(self):
+        return list(self.exact.values()) + [route for _, route in self.prefixes]
+
+    @property
+    def methods(self):
+        methods = {'OPTIONS'}
+        for route in self.routes():
+            methods |= route.methods
+        return ', '.join(sorted(methods))
+
+    def add_before_hook(self, hook):
+        """Hook for every route"""
+        self.before_hooks.append(hook)
+
+    def add_after_hook(self, hook):
+        """Hook for every route"""
+        self.after_hooks.append(hook)
+
+
+ROUTER = Router()
+ROUTER.add('/', DHgateMonitorHandler.serve_homepage, name='home', cheap=True)
+ROUTER.add('/dashboard', DHgateMonitorHandler.serve_dashboard)
+ROUTER.add('/newsroom', DHgateMonitorHandler.serve_newsroom, cheap=True)
+ROUTER.add('/service', DHgateMonitorHandler.serve_service, cheap=True)
+ROUTER.add('/contact', DHgateMonitorHandler.serve_contact, cheap=True)
+ROUTER.add('/privacy', DHgateMonitorHandler.serve_privacy, cheap=True)
+ROUTER.add('/terms', DHgateMonitorHandler.serve_terms, cheap=True)
+ROUTER.add('/delete-data', DHgateMonitorHandler.serve_delete_data, cheap=True)
+ROUTER.add('/add_shop', DHgateMonitorHandler.serve_add_shop, cheap=True)
+ROUTER.add('/settings', DHgateMonitorHandler.serve_settings, cheap=True)
+ROUTER.add('/unsubscribe', DHgateMonitorHandler.serve_unsubscribe)
+ROUTER.add('/signup-widget.js', DHgateMonitorHandler.serve_widget, cheap=True)
+ROUTER.add('/metrics', DHgateMonitorHandler.serve_metrics)
+ROUTER.add('/api/widget-signup', DHgateMonitorHandler.serve_widget_signup, methods=('POST',))
+ROUTER.add('/api/price-history', DHgateMonitorHandler.serve_price_history)
+ROUTER.add('/events', DHgateMonitorHandler.serve_events)
+for form_path in ('/contact', '/add_shop', '/settings', '/unsubscribe'):
+    ROUTER.exact[form_path].add_methods('POST')
+
+# Admin-only debug surface; 404 unless --admin-token is set and sent
+DEBUG_ROUTES = (
+    ROUTER.add('/debug/profile', DHgateMonitorHandler.serve_debug_profile,
+               methods=('GET', 'HEAD', 'POST')),
+    ROUTER.add('/debug/profile/session', DHgateMonitorHandler.serve_debug_profile_session,
+               methods=('GET', 'HEAD', 'POST')),
+    ROUTER.add('/debug/tracemalloc', DHgateMonitorHandler.serve_debug_tracemalloc,
+               methods=('GET', 'HEAD', 'POST')),
+)
+for debug_route in DEBUG_ROUTES:
+    debug_route.add_before_hook(require_admin)
+ROUTER.add_prefix('/assets/', DHgateMonitorHandler.serve_asset, name='/assets/', cheap=True)
+
+
+SUPPORTED_LANGS = ('en', 'nl')
+SUPPORTED_THEMES = ('light', 'dark')
+
+
+def page_params(query_params):
+    """lang/theme from the query, normalized to the supported values"""
+    lang = query_params.get('lang', ['en'])[0]
+    theme = query_params.get('theme', ['light'])[0]
+    return (lang if lang in SUPPORTED_LANGS else SUPPORTED_LANGS[0],
+            theme if theme in SUPPORTED_THEMES else SUPPORTED_THEMES[0])
+
+
+class RenderedPage:
+    """Encoded page bytes with precomputed headers and compressed variants"""
+    __slots__ = ('body', 'etag', 'headers', 'cache_variants', 'variants')
+
+    def __init__(self, body, cache_variants=True):
+        self.body = body
+        self.etag = content_etag(body)
+        self.headers = (
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('ETag', self.etag),
+            ('Vary', 'Accept-Encoding'),
+        )
+        # One-off pages are not worth compressing per request
+        self.cache_variants = cache_variants
+        self.variants = {}
+
+    def variant(self, encoding):
+        if not self.cache_variants or len(self.body) < MIN_COMPRESS_BYTES:
+            return None
+        try:
+            return self.variants[encoding]
+        except KeyError:
+            pass
+        body = compress(self.body, encoding)
+        variant = None
+        if len(body) < len(self.body) * 0.9:
+            variant = EncodedVariant(body, f'{self.etag[:-1]}-{encoding}"', encoding,
+                                     'text/html; charset=utf-8')
+        # Racing threads build identical variants; the last write wins
+        self.variants[encoding] = variant
+        return variant
+
+
+class RenderCache:
+    """Pre-rendered pages keyed by (page, lang, theme).
+
+    page_params() maps unknown lang/theme values to the defaults, so the
+    cache never holds more than pages x languages x themes entries no
+    matter what clients send.
+    """
+
+    def __init__(self, renderers):
+        self.renderers = renderers
+        self._pages = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, page, lang, theme):
+        return self.lookup(page, lang, theme)[0]
+
+    def lookup(self, page, lang, theme):
+        """Returns (RenderedPage, cache hit)"""
+        key = (page, lang, theme)
+        rendered = self._pages.get(key)
+        if rendered is not None:
+            self.hits += 1
+            return rendered, True
+        with self._lock:
+            rendered = self._pages.get(key)
+            if rendered is not None:
+                return rendered, True
+            self.misses += 1
+            html_text = self.renderers[page](lang, theme)
+            rendered = RenderedPage(html_text.encode('utf-8'))
+            self._pages[key] = rendered
+        return rendered, False
+
+    def warm(self):
+        """Render and compress every combination ahead of traffic"""
+        for page in self.renderers:
+            for lang in SUPPORTED_LANGS:
+                for theme in SUPPORTED_THEMES:
+                    rendered = self.get(page, lang, theme)
+                    for encoding in SUPPORTED_ENCODINGS:
+                        rendered.variant(encoding)
+
+    def share(self, cache):
+        """Move every rendered page and its variants into the shared cache"""
+        with self._lock:
+            for (page, lang, theme), rendered in self._pages.items():
+                view = cache.publish(shared_key('page', page, lang, theme, 'identity'), rendered.body)
+                if view is not None:
+                    rendered.body = view
+                for encoding, variant in rendered.variants.items():
+                    if variant is not None:
+                        view = cache.publish(shared_key('page', page, lang, theme, encoding),
+                                             variant.body)
+                        if view is not None:
+                            variant.body = view
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self):
+        return {'entries': len(self._pages), 'hits': self.hits, 'misses': self.misses}
+
+
+class FragmentTemplate:
+    """Page with one dynamic fragment, kept as pre-encoded prefix and suffix"""
+    marker = '\x00fragment\x00'
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self._parts = {}
+
+    def parts(self, lang, theme):
+        key = (lang, theme)
+        parts = self._parts.get(key)
+        if parts is None:
+            prefix, suffix = self.renderer(lang, theme, self.marker).split(self.marker)
+            parts = self._parts[key] = (prefix.encode('utf-8'), suffix.encode('utf-8'))
+        return parts
+
+    def render(self, lang, theme, fragment):
+        """fragment must already be HTML-escaped"""
+        prefix, suffix = self.parts(lang, theme)
+        return RenderedPage(prefix + fragment.encode('utf-8') + suffix, cache_variants=False)
+
+    def warm(self):
+        for lang in SUPPORTED_LANGS:
+            for theme in SUPPORTED_THEMES:
+                self.parts(lang, theme)
+
+
+RENDER_CACHE = RenderCache({
+    'dashboard': DHgateMonitorHandler.render_dashboard,
+    'newsroom': DHgateMonitorHandler.render_newsroom,
+    'service': DHgateMonitorHandler.render_service,
+    'contact': DHgateMonitorHandler.render_contact,
+    'privacy': DHgateMonitorHandler.render_privacy,
+    'terms': DHgateMonitorHandler.render_terms,
+    'delete_data': DHgateMonitorHandler.render_delete_data,
+    'add_shop': DHgateMonitorHandler.render_add_shop,
+    'settings': DHgateMonitorHandler.render_settings,
+    'unsubscribed': DHgateMonitorHandler.render_unsubscribed,
+})
+UNSUBSCRIBE_TEMPLATE = FragmentTemplate(DHgateMonitorHandler.render_unsubscribe)
+
+
+class ConnectionLimitMixIn:
+    """Caps the number of open connections and rejects the excess with 503"""
+    max_connections = 0  # 0 = unlimited
+    request_timeout = None
+
+    def _init_connection_limit(self, max_connections):
+        self.max_connections = max_connections
+        self._active_requests = set()
+        self._active_lock = threading.Lock()
+        self._idle_connections = 0
+
+    @property
+    def active_connections(self):
+        return len(self._active_requests)
+
+    @property
+    def busy_connections(self):
+        """Open connections that are not waiting for their next keep-alive request"""
+        return len(self._active_requests) - self._idle_connections
+
+    def connection_idle(self, idle):
+        with self._active_lock:
+            self._idle_connections += 1 if idle else -1
+
+    def verify_request(self, request, client_address):
+        with self._active_lock:
+            if self.max_connections and len(self._active_requests) >= self.max_connections:
+                accepted = False
+            else:
+                self._active_requests.add(request)
+                accepted = True
+        if not accepted:
+            self.reject_request(request)
+        return accepted
+
+    def idle_connections_should_close(self):
+        """Whether idle keep-alive connections should make room for waiting ones"""
+        return False
+
+    def reject_request(self, request):
+        """Send a fast 503 without creating a handler"""
+        try:
+            request.sendall(OVERLOADED_RESPONSE)
+        except OSError:
+            pass
+
+    def shutdown_request(self, request):
+        with self._active_lock:
+            self._active_requests.discard(request)
+        super().shutdown_request(request)
+
+
+class SingleDHgateServer(ConnectionLimitMixIn, socketserver.TCPServer):
+    """One request at a time (the original behaviour)"""
+    allow_reuse_address = True
+    reuse_port = False
+
+    def __init__(self, server_address, handler_class, max_connections=0,
+                 backlog=None, bind_and_activate=True):
+        self._init_connection_limit(max_connections)
+        if backlog:
+            self.request_queue_size = backlog
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def use_socket(self, listener):
+        """Serve from an already bound and listening socket (pre-fork mode)"""
+        self.socket.close()
+        self.socket = listener
+        self.server_address = listener.getsockname()
+
+
+class ThreadingDHgateServer(socketserver.ThreadingMixIn, SingleDHgateServer):
+    """One thread per connection"""
+    daemon_threads = True
+
+
+class PooledDHgateServer(SingleDHgateServer):
+    """Fixed-size worker pool fed by a bounded accept queue.
+
+    Accepted connections wait in the queue until a worker is free; when
+    the queue is full the connection is answered with a 503 immediately
+    instead of letting latency grow with the queue depth.
+    """
+
+    def __init__(self, server_address, handler_class, pool_size=16,
+                 queue_size=64, max_connections=0, backlog=None,
+                 bind_and_activate=True):
+        super().__init__(server_address, handler_class, max_connections,
+                         backlog, bind_and_activate)
+        self.pool_size = pool_size
+        self._requests = queue.Queue(maxsize=queue_size)
+        self._workers = []
+        for index in range(pool_size):
+            worker = threading.Thread(target=self._process_queue,
+                                      name=f"dhgate-worker-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def queued_connections(self):
+        return self._requests.qsize()
+
+    def idle_connections_should_close(self):
+        # An idle keep-alive connection would otherwise hold a pool worker
+        # while accepted connections wait in the queue
+        return not self._requests.empty()
+
+    def process_request(self, request, client_address):
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject_request(request)
+            self.shutdown_request(request)
+
+    def _process_queue(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            try:
+                self._requests.put(None, timeout=1)
+            except queue.Full:
+                break
+
+
+class AsyncRequestAdapter(DHgateMonitorHandler):
+    """Runs DHgateMonitorHandler against one fully read request.
+
+    The asyncio engine does all socket I/O itself; this adapter feeds the
+    raw request bytes through the regular parsing and route code and
+    collects the response in memory, so both engines share one route table.
+    """
+    admission_control = False
+
+    def __init__(self, raw_request, client_address, server, requests_left=None):
+        # BaseRequestHandler.__init__ would start reading from a socket
+        self.protocol_version = server.protocol_version
+        self.requests_left = requests_left
+        # The engine has already read the whole body off the socket
+        self.body_consumed = True
+        self.rfile = io.BytesIO(raw_request)
+        self.wfile = io.BytesIO()
+        self.request = None
+        self.connection = None
+        self.client_address = client_address
+        self.server = server
+        self.directory = os.getcwd()
+        self.close_connection = True
+        self.file_body = None
+
+    def send_file_body(self, path, offset, count):
+        # The engine streams the file after the buffered headers
+        self.file_body = (path, offset, count)
+        self.bytes_sent += count
+
+    def start_event_stream(self, subscriber):
+        # The engine writes the stream after the buffered headers
+        self.event_stream = subscriber
+        self.close_connection = True
+
+    def run(self):
+        """Handle the request; returns (response bytes, keep-alive flag, file body)"""
+        self.handle_one_request()
+        response = self.wfile.getvalue()
+        if self.event_stream is None:
+            response = _ensure_framing(response, self.command)
+        return response, not self.close_connection, self.file_body
+
+
+def _ensure_framing(response, method):
+    """Add Content-Length to a buffered response that lacks framing"""
+    head, sep, body = response.partition(b"\r\n\r\n")
+    if not sep or method == "HEAD":
+        return response
+    lowered = head.lower()
+    if b"\r\ncontent-length:" in lowered or b"\r\ntransfer-encoding:" in lowered:
+        return response
+    status = head.split(b" ", 2)[1:2]
+    if status and (status[0].startswith(b"1") or status[0] in (b"204", b"304")):
+        return response
+    return head + b"\r\nContent-Length: " + str(len(body)).encode("ascii") + sep + body
+
+
+def _request_path(head):
+    """Path of the request line, '' when it cannot be parsed"""
+    parts = head.split(b" ", 2)
+    if len(parts) < 3:
+        return ''
+    return urllib.parse.urlsplit(parts[1].decode('latin-1')).path
+
+
+def _content_length(head):
+    """Declared body length; None when it is not a number or declared twice differently"""
+    lengths = set()
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            value = value.strip()
+            if not value.isdigit():
+                return None
+            lengths.add(int(value))
+    if len(lengths) > 1:
+        return None
+    return lengths.pop() if lengths else 0
+
+
+# Seconds a stopping worker waits for requests in progress; below
+# WorkerSupervisor.shutdown_grace, after which a worker is killed
+SHUTDOWN_DRAIN = 5.0
+
+
+class AsyncioDHgateServer:
+    """asyncio serving engine (--engine asyncio).
+
+    Every connection is a coroutine instead of a thread, so thousands of
+    idle keep-alive connections cost only a few kilobytes each. Reads are
+    bounded by the request timeout, idle keep-alive connections by the
+    keep-alive timeout and writes by the write timeout; the next request
+    on a connection is not read until the previous response has drained,
+    which applies backpressure to slow readers. Route handling runs on a
+    small thread pool through AsyncRequestAdapter.
+    """
+
+    write_buffer_limit = 64 * 1024
+    sendfile_chunk = 1024 * 1024
+
+    def __init__(self, args, handler_class=AsyncRequestAdapter):
+        self.args = args
+        self.handler_class = handler_class
+        self.request_timeout = args.request_timeout or None
+        self.keepalive_timeout = args.keepalive_timeout or None
+        self.protocol_version = args.protocol
+        self.max_keepalive_requests = args.max_keepalive_requests
+        self.write_timeout = args.write_timeout or None
+        self.max_connections = args.max_connections
+        self.admin_token = args.admin_token or None
+        self.event_heartbeat = args.event_heartbeat
+        self.connections = 0
+        self.idle = 0  # connections waiting for their next request
+        self._idle_writers = set()
+        self.closing = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.pool_size, thread_name_prefix="dhgate-async")
+        self.server_address = None
+        self._server = None
+
+    @property
+    def active_connections(self):
+        return self.connections
+
+    async def start(self, sock=None):
+        if sock is not None:
+            self._server = await asyncio.start_server(
+                self.handle_connection, sock=sock, limit=MAX_HEADER_BYTES)
+        else:
+            self._server = await asyncio.start_server(
+                self.handle_connection, self.args.host or '0.0.0.0', self.args.port,
+                backlog=self.args.backlog, reuse_address=True,
+                reuse_port=self.args.reuse_port or None, limit=MAX_HEADER_BYTES)
+        self.server_address = self._server.sockets[0].getsockname()
+        return self.server_address
+
+    async def serve_forever(self, sock=None):
+        if self._server is None:
+            await self.start(sock)
+        async with self._server:
+            try:
+                await self._server.serve_forever()
+            finally:
+                self.executor.shutdown(wait=False)
+
+    def close(self):
+        """Stop accepting; idle keep-alive connections are closed right away,
+        busy ones after their response"""
+        self.closing = True
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._idle_writers):
+            writer.close()
+
+    async def drain(self, timeout=SHUTDOWN_DRAIN):
+        """After close(): wait for the open connections to finish their requests"""
+        deadline = time.monotonic() + timeout
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def handle_connection(self, reader, writer):
+        if self.max_connections and self.connections >= self.max_connections:
+            writer.write(OVERLOADED_RESPONSE)
+            await self._close(writer)
+            return
+        self.connections += 1
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+        client_address = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        timeout = self.request_timeout
+        requests_left = self.max_keepalive_requests or None
+        counted = True
+        try:
+            while not self.closing:
+                self.idle += 1
+                self._idle_writers.add(writer)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                finally:
+                    self.idle -= 1
+                    self._idle_writers.discard(writer)
+                if b"\r\ntransfer-encoding:" in head.lower():
+                    writer.write(b"HTTP/1.1 411 Length Required\r\n"
+                                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                length = _content_length(head)
+                if length is None:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\n"
+                                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                if length > MAX_BODY_BYTES:
+                    writer.write(b"HTTP/1.1 413 Payload Too Large\r\n"
+                                 b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                body = b""
+                if length:
+                    body = await asyncio.wait_for(reader.readexactly(length),
+                                                  self.request_timeout)
+                # Admission before the request can queue for a handler thread
+                route = ROUTER.resolve(_request_path(head))
+                refusal = ADMISSION.admit(client_address[0] if client_address else '-',
+                                          route is not None and route.cheap
+                                          and head.startswith((b"GET ", b"HEAD ")), wait=False)
+                if refusal is not None:
+                    writer.write(refusal_response(*refusal))
+                    break
+                adapter = self.handler_class(head + body, client_address, self, requests_left)
+                if requests_left is not None:
+                    requests_left -= 1
+                try:
+                    response, keep_alive, file_body = await loop.run_in_executor(
+                        self.executor, adapter.run)
+                finally:
+                    ADMISSION.release()
+                writer.write(response)
+                await asyncio.wait_for(writer.drain(), self.write_timeout)
+                if file_body is not None and not await self._send_file(writer, *file_body):
+                    break
+                if adapter.event_stream is not None:
+                    # Like the threaded engines' detached streams, open
+                    # streams do not count against --max-connections
+                    self.connections -= 1
+                    counted = False
+                    await self._stream_events(reader, writer, adapter.event_stream)
+                    break
+                if not keep_alive or self.closing:
+                    break
+                # Waiting for the next request on an idle keep-alive connection
+                timeout = self.keepalive_timeout
+        except asyncio.LimitOverrunError:
+            writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"
+                         b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            if counted:
+                self.connections -= 1
+            await self._close(writer)
+
+    async def _stream_events(self, reader, writer, subscriber):
+        """Write an event stream until the client leaves or falls behind.
+
+        The subscriber's buffer bounds what can queue up while a drain is
+        waiting; a client that does not drain within the write timeout is
+        dropped. Idle streams get a heartbeat comment.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wakeup():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass  # the loop has closed
+
+        subscriber.wakeup = wakeup
+        ready.set()
+        gone = asyncio.ensure_future(self._until_eof(reader))
+        try:
+            while not subscriber.closed:
+                waiter = asyncio.ensure_future(ready.wait())
+                done, _ = await asyncio.wait((waiter, gone), timeout=self.event_heartbeat,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if gone in done:
+                    break
+                if waiter not in done:
+                    waiter.cancel()
+                    EVENT_BROADCASTER.heartbeat(subscriber)
+                ready.clear()
+                data = subscriber.take()
+                if data:
+                    writer.write(data)
+                    await asyncio.wait_for(writer.drain(), self.write_timeout)
+                    subscriber.sent(len(data))
+        finally:
+            gone.cancel()
+            EVENT_BROADCASTER.unsubscribe(subscriber)
+
+    @staticmethod
+    async def _until_eof(reader):
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    async def _send_file(self, writer, path, offset, count):
+        """Zero-copy file body in slices, each bounded by the write timeout"""
+        loop = asyncio.get_running_loop()
+        end = offset + count
+        with open(path, 'rb') as f:
+            while offset < end:
+                sent = await asyncio.wait_for(
+                    loop.sendfile(writer.transport, f, offset,
+                                  min(self.sendfile_chunk, end - offset)),
+                    self.write_timeout)
+                if not sent:
+                    return False
+                offset += sent
+        return True
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await asyncio.wait_for(writer.wait_closed(), 1)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+
+
+def run_asyncio_server(args, sock=None, on_started=None):
+    """Run the asyncio engine until SIGTERM/SIGINT or KeyboardInterrupt"""
+    engine = AsyncioDHgateServer(args)
+
+    async def serve():
+        await engine.start(sock)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM,):
+            try:
+                loop.add_signal_handler(signum, engine.close)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if on_started is not None:
+            on_started(engine.server_address)
+        try:
+            await engine.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        # Let requests in progress finish before asyncio.run() cancels the connections
+        await engine.drain()
+
+    asyncio.run(serve())
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def parse_args(argv=None):
+    """Parse CLI flags; every flag can also be set through an environment variable"""
+    parser = argparse.ArgumentParser(description="DHgate Monitor local development server")
+    parser.add_argument("--host", default=os.environ.get("DHGATE_HOST", ""),
+                        help="interface to bind (env DHGATE_HOST, default: all)")
+    parser.add_argument("--port", type=int, default=_env_int("DHGATE_PORT", DEFAULT_PORT),
+                        help="port to listen on (env DHGATE_PORT)")
+    parser.add_argument("--engine", choices=SERVER_ENGINES,
+                        default=os.environ.get("DHGATE_ENGINE", "threaded"),
+                        help="serving engine: socketserver threads or asyncio "
+                             "(env DHGATE_ENGINE)")
+    parser.add_argument("--mode", choices=SERVER_MODES,
+                        default=os.environ.get("DHGATE_SERVER_MODE", "thread"),
+                        help="concurrency mode: single, thread-per-request or fixed pool "
+                             "(env DHGATE_SERVER_MODE)")
+    parser.add_argument("--pool-size", type=int, default=_env_int("DHGATE_POOL_SIZE", 16),
+                        help="worker threads in pool mode (env DHGATE_POOL_SIZE)")
+    parser.add_argument("--accept-queue", type=int, default=_env_int("DHGATE_ACCEPT_QUEUE", 64),
+                        help="accepted connections waiting for a pool worker before "
+                             "new ones get a 503 (env DHGATE_ACCEPT_QUEUE)")
+    parser.add_argument("--max-connections", type=int,
+                        default=_env_int("DHGATE_MAX_CONNECTIONS", 0),
+                        help="maximum open connections, 0 = unlimited "
+                             "(env DHGATE_MAX_CONNECTIONS)")
+    parser.add_argument("--max-in-flight", type=int, default=_env_int("DHGATE_MAX_IN_FLIGHT", 64),
+                        help="requests handled at once before new ones queue, 0 = unlimited "
+                             "(env DHGATE_MAX_IN_FLIGHT)")
+    parser.add_argument("--max-queued", type=int, default=_env_int("DHGATE_MAX_QUEUED", 128),
+                        help="requests waiting for a slot before new ones get a 503 "
+                             "(env DHGATE_MAX_QUEUED)")
+    parser.add_argument("--queue-timeout", type=float,
+                        default=_env_float("DHGATE_QUEUE_TIMEOUT", 2.0),
+                        help="seconds a queued request waits before its 503 "
+                             "(env DHGATE_QUEUE_TIMEOUT)")
+    parser.add_argument("--priority-reserve", type=float,
+                        default=_env_float("DHGATE_PRIORITY_RESERVE", 0.25),
+                        help="share of the in-flight slots kept for cached routes such as "
+                             "/assets/ (env DHGATE_PRIORITY_RESERVE)")
+    parser.add_argument("--client-rate", type=float,
+                        default=_env_float("DHGATE_CLIENT_RATE", 0.0),
+                        help="requests per second per client IP before 429s, 0 = off "
+                             "(env DHGATE_CLIENT_RATE)")
+    parser.add_argument("--client-burst", type=float,
+                        default=_env_float("DHGATE_CLIENT_BURST", 50.0),
+                        help="requests a client IP may burst above --client-rate "
+                             "(env DHGATE_CLIENT_BURST)")
+    parser.add_argument("--max-clients", type=int, default=_env_int("DHGATE_MAX_CLIENTS", 10000),
+                        help="client IPs tracked for rate limiting, least recent evicted first "
+                             "(env DHGATE_MAX_CLIENTS)")
+    parser.add_argument("--backlog", type=int, default=_env_int("DHGATE_LISTEN_BACKLOG", 128),
+                        help="kernel listen backlog (env DHGATE_LISTEN_BACKLOG)")
+    parser.add_argument("--request-timeout", type=float,
+                        default=_env_float("DHGATE_REQUEST_TIMEOUT", 30.0),
+                        help="socket timeout per connection in seconds "
+                             "(env DHGATE_REQUEST_TIMEOUT)")
+    parser.add_argument("--write-timeout", type=float,
+                        default=_env_float("DHGATE_WRITE_TIMEOUT", 30.0),
+                        help="asyncio engine: seconds a client may take to drain a "
+                             "response (env DHGATE_WRITE_TIMEOUT)")
+    parser.add_argument("--protocol", choices=HTTP_PROTOCOLS,
+                        default=os.environ.get("DHGATE_HTTP_PROTOCOL", "HTTP/1.1"),
+                        help="HTTP/1.1 keeps connections alive, HTTP/1.0 closes after "
+                             "every response (env DHGATE_HTTP_PROTOCOL)")
+    parser.add_argument("--keepalive-timeout", type=float,
+                        default=_env_float("DHGATE_KEEPALIVE_TIMEOUT", 15.0),
+                        help="seconds an idle keep-alive connection stays open "
+                             "(env DHGATE_KEEPALIVE_TIMEOUT)")
+    parser.add_argument("--max-keepalive-requests", type=int,
+                        default=_env_int("DHGATE_MAX_KEEPALIVE_REQUESTS", 100),
+                        help="requests per connection before it is closed, 0 = unlimited "
+                             "(env DHGATE_MAX_KEEPALIVE_REQUESTS)")
+    parser.add_argument("--static-cache-bytes", type=int,
+                        default=_env_int("DHGATE_STATIC_CACHE_BYTES", 16 * 1024 * 1024),
+                        help="byte budget of the in-memory static file cache, 0 disables "
+                             "caching (env DHGATE_STATIC_CACHE_BYTES)")
+    parser.add_argument("--static-check-interval", type=float,
+                        default=_env_float("DHGATE_STATIC_CHECK_INTERVAL", 1.0),
+                        help="seconds between mtime checks of a cached file "
+                             "(env DHGATE_STATIC_CHECK_INTERVAL)")
+    parser.add_argument("--sendfile-threshold", type=int,
+                        default=_env_int("DHGATE_SENDFILE_THRESHOLD", 256 * 1024),
+                        help="files of at least this many bytes are streamed with "
+                             "sendfile() (env DHGATE_SENDFILE_THRESHOLD)")
+    parser.add_argument("--access-log", default=os.environ.get("DHGATE_ACCESS_LOG", "-"),
+                        help="access log destination: '-' for stdout, a file path, or "
+                             "'off' (env DHGATE_ACCESS_LOG)")
+    parser.add_argument("--access-log-sample", type=float,
+                        default=_env_float("DHGATE_ACCESS_LOG_SAMPLE", 1.0),
+                        help="fraction of non-5xx requests to log (env DHGATE_ACCESS_LOG_SAMPLE)")
+    parser.add_argument("--access-log-queue", type=int,
+                        default=_env_int("DHGATE_ACCESS_LOG_QUEUE", 10000),
+                        help="records buffered before new ones are dropped "
+                             "(env DHGATE_ACCESS_LOG_QUEUE)")
+    parser.add_argument("--workers", type=int, default=_env_int("DHGATE_WORKERS", 1),
+                        help="number of pre-forked worker processes, 1 = no forking "
+                             "(env DHGATE_WORKERS)")
+    parser.add_argument("--reuse-port", action="store_true",
+                        default=os.environ.get("DHGATE_REUSE_PORT", "") not in ("", "0"),
+                        help="let every worker bind the port with SO_REUSEPORT instead of "
+                             "sharing one inherited socket (env DHGATE_REUSE_PORT)")
+    parser.add_argument("--shared-cache-bytes", type=int,
+                        default=_env_int("DHGATE_SHARED_CACHE_BYTES", 64 * 1024 * 1024),
+                        help="with --workers: shared memory for one copy of the rendered pages "
+                             "and hot static files, 0 = per-worker copies "
+                             "(env DHGATE_SHARED_CACHE_BYTES)")
+    parser.add_argument("--db", default=os.environ.get("DHGATE_DB", signup_store.DEFAULT_DB_PATH),
+                        help="SQLite database for signups and form posts (env DHGATE_DB)")
+    parser.add_argument("--db-commit-batch", type=int,
+                        default=_env_int("DHGATE_DB_COMMIT_BATCH", 256),
+                        help="most writes grouped into one commit (env DHGATE_DB_COMMIT_BATCH)")
+    parser.add_argument("--event-heartbeat", type=float,
+                        default=_env_float("DHGATE_EVENT_HEARTBEAT", 15.0),
+                        help="seconds between heartbeats on idle /events streams "
+                             "(env DHGATE_EVENT_HEARTBEAT)")
+    parser.add_argument("--event-buffer", type=int,
+                        default=_env_int("DHGATE_EVENT_BUFFER", 64 * 1024),
+                        help="unsent bytes an /events client may fall behind before it is "
+                             "disconnected (env DHGATE_EVENT_BUFFER)")
+    parser.add_argument("--event-poll", type=float,
+                        default=_env_float("DHGATE_EVENT_POLL", 1.0),
+                        help="seconds between checks for events published by other "
+                             "processes (env DHGATE_EVENT_POLL)")
+    parser.add_argument("--history-dir",
+                        default=os.environ.get("DHGATE_HISTORY_DIR", price_history.DEFAULT_HISTORY_DIR),
+                        help="price history written by crawl_scheduler.py, served read-only on "
+                             "/api/price-history; empty disables it (env DHGATE_HISTORY_DIR)")
+    parser.add_argument("--admin-token", default=os.environ.get("DHGATE_ADMIN_TOKEN", ""),
+                        help="token for the /debug/ profiling routes, sent as X-Admin-Token; "
+                             "unset keeps them disabled (env DHGATE_ADMIN_TOKEN)")
+    parser.add_argument("--profile-sample", type=int,
+                        default=_env_int("DHGATE_PROFILE_SAMPLE", 0),
+                        help="profile 1 in N requests with cProfile, 0 = off "
+                             "(env DHGATE_PROFILE_SAMPLE)")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not hasattr(os, "fork"):
+        parser.error("--workers requires a platform with os.fork()")
+    if args.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--reuse-port is not supported on this platform")
+    if args.pool_size < 1:
+        parser.error("--pool-size must be at least 1")
+    if args.accept_queue < 1:
+        parser.error("--accept-queue must be at least 1")
+    if args.max_in_flight < 0 or args.max_queued < 0 or args.max_clients < 1:
+        parser.error("--max-in-flight and --max-queued must be 0 or more, --max-clients at least 1")
+    if not 0 <= args.priority_reserve < 1:
+        parser.error("--priority-reserve must be at least 0 and below 1")
+    if args.client_rate < 0 or args.client_burst < 1:
+        parser.error("--client-rate must be 0 or more and --client-burst at least 1")
+    if args.shared_cache_bytes < 0:
+        parser.error("--shared-cache-bytes must be 0 or more")
+    if args.db_commit_batch < 1:
+        parser.error("--db-commit-batch must be at least 1")
+    if args.profile_sample < 0:
+        parser.error("--profile-sample must be 0 or more")
+    if args.event_heartbeat <= 0 or args.event_poll <= 0:
+        parser.error("--event-heartbeat and --event-poll must be positive")
+    return args
+
+
+def build_server(args, handler_class=DHgateMonitorHandler, bind_and_activate=True):
+    """Create the socketserver for the configured concurrency mode"""
+    address = (args.host, args.port)
+    if args.mode == "pool":
+        httpd = PooledDHgateServer(address, handler_class,
+                                   pool_size=args.pool_size,
+                                   queue_size=args.accept_queue,
+                                   max_connections=args.max_connections,
+                                   backlog=args.backlog,
+                                   bind_and_activate=bind_and_activate)
+    elif args.mode == "thread":
+        httpd = ThreadingDHgateServer(address, handler_class,
+                                      max_connections=args.max_connections,
+                                      backlog=args.backlog,
+                                      bind_and_activate=bind_and_activate)
+    else:
+        httpd = SingleDHgateServer(address, handler_class,
+                                   max_connections=args.max_connections,
+                                   backlog=args.backlog,
+                                   bind_and_activate=bind_and_activate)
+    httpd.request_timeout = args.request_timeout or None
+    httpd.keepalive_timeout = args.keepalive_timeout or None
+    httpd.protocol_version = args.protocol
+    # A single-threaded server cannot afford idle keep-alive connections
+    httpd.max_keepalive_requests = 1 if args.mode == "single" else args.max_keepalive_requests
+    httpd.admin_token = args.admin_token or None
+    return httpd
+
+
+class WorkerSupervisor:
+    """Pre-fork supervisor for --workers N.
+
+    The supervisor never serves requests itself. It forks N workers that
+    either share one inherited listening socket or each bind the port with
+    SO_REUSEPORT, restarts workers that die unexpectedly (with a backoff
+    for workers that crash right after starting) and forwards shutdown
+    signals to them. SIGHUP restarts the workers one slot at a time: the
+    next worker is only stopped once the previous slot's replacement
+    reports (over a pipe) that it is serving, so N-1 workers keep taking
+    connections throughout.
+
+    Workers are forked before any server threads exist, so the children
+    start from a single-threaded process.
+    """
+
+    poll_interval = 0.2
+    shutdown_grace = 10.0
+    max_restart_delay = 30.0
+
+    def __init__(self, args):
+        self.args = args
+        self.listener = None
+        self.workers = {}  # pid -> slot
+        self._started = {}  # slot -> start time
+        self._crashes = {}  # slot -> consecutive quick crashes
+        self._restart_at = {}  # slot -> earliest respawn time
+        self._ready = {}  # slot -> read end of the pipe its worker reports "serving" on
+        self._roll = []  # slots still to restart for a reload
+        self._rolling = None  # (slot, pids being replaced) of the restart in progress
+        self._stopping = False
+        self._reload = False
+
+    def open_listener(self):
+        """Bind the port once so errors surface before forking"""
+        sock = socket.socket(socket.AF_INET6 if ":" in self.args.host else socket.AF_INET)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.args.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.args.host, self.args.port))
+        if not self.args.reuse_port:
+            # Shared mode: the children inherit this listening socket. In
+            # reuse-port mode it only reserves the port and never listens,
+            # so the kernel balances connections over the workers' sockets.
+            sock.listen(self.args.backlog)
+        self.listener = sock
+        return sock.getsockname()[1]
+
+    def spawn(self, slot):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            os.close(ready_read)
+            for fd in self._ready.values():
+                os.close(fd)
+            try:
+                code = self._run_worker(slot, ready_write)
+            except Exception as e:
+                print(f"❌ Worker {os.getpid()} gestopt door fout: {e}", file=sys.stderr)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        os.close(ready_write)
+        os.set_blocking(ready_read, False)
+        if slot in self._ready:
+            os.close(self._ready.pop(slot))
+        self._ready[slot] = ready_read
+        self.workers[pid] = slot
+        self._started[slot] = time.monotonic()
+        return pid
+
+    @staticmethod
+    def _report_ready(ready_fd):
+        try:
+            os.write(ready_fd, b"1")
+        finally:
+            os.close(ready_fd)
+
+    def _run_worker(self, slot, ready_fd):
+        SHARED_COUNTERS.use_row(slot)
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        # Ctrl+C reaches the whole process group; the supervisor decides
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        args = self.args
+        if args.engine == "asyncio":
+            if args.reuse_port:
+                args = argparse.Namespace(**vars(args))
+                args.port = self.listener.getsockname()[1]
+                self.listener.close()
+                sock = None
+            else:
+                sock = self.listener
+            try:
+                def started(address):
+                    self._report_ready(ready_fd)
+                    print(f"👷 Worker {slot} gestart (pid {os.getpid()})")
+
+                run_asyncio_server(args, sock, on_started=started)
+            finally:
+                SIGNUP_STORE.close()
+                ACCESS_LOG.close()
+            return 0
+        if args.reuse_port:
+            args = argparse.Namespace(**vars(args))
+            args.port = self.listener.getsockname()[1]
+            self.listener.close()
+            httpd = build_server(args, bind_and_activate=False)
+            httpd.reuse_port = True
+            httpd.server_bind()
+            httpd.server_activate()
+        else:
+            httpd = build_server(args, bind_and_activate=False)
+            httpd.use_socket(self.listener)
+
+        def stop(signum, frame):
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        self._report_ready(ready_fd)
+        print(f"👷 Worker {slot} gestart (pid {os.getpid()})")
+        try:
+            httpd.serve_forever()
+        finally:
+            # Requests in progress finish before os._exit() ends their threads
+            deadline = time.monotonic() + SHUTDOWN_DRAIN
+            while httpd.busy_connections > 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            httpd.server_close()
+            SIGNUP_STORE.close()
+            ACCESS_LOG.close()
+        return 0
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    def signal_workers(self, signum):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _is_ready(self, slot):
+        """True once the slot's current worker has reported serving (or died trying)"""
+        fd = self._ready.get(slot)
+        if fd is None:
+            return True
+        try:
+            os.read(fd, 1)  # a byte when serving, b"" when the worker exited first
+        except BlockingIOError:
+            return False
+        os.close(self._ready.pop(slot))
+        return True
+
+    def _advance_reload(self):
+        """Restart the next slot once the previous one's replacement is serving"""
+        if self._rolling is not None:
+            slot, replaced = self._rolling
+            pids = [pid for pid, worker_slot in self.workers.items() if worker_slot == slot]
+            if not pids or set(pids) & replaced or not self._is_ready(slot):
+                return
+            self._rolling = None
+        while self._roll:
+            slot = self._roll.pop(0)
+            pids = [pid for pid, worker_slot in self.workers.items() if worker_slot == slot]
+            if not pids:
+                continue  # down already; it comes back as a new worker anyway
+            self._rolling = (slot, set(pids))
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            return
+
+    def _reap(self):
+        """Collect exited workers; returns the slots that need a replacement"""
+        freed = []
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            slot = self.workers.pop(pid, None)
+            if slot is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if not self._stopping:
+                uptime = time.monotonic() - self._started.get(slot, 0)
+                if uptime < 1.0:
+                    self._crashes[slot] = self._crashes.get(slot, 0) + 1
+                else:
+                    self._crashes[slot] = 0
+                delay = min(self.max_restart_delay, 2 ** self._crashes[slot] - 1)
+                self._restart_at[slot] = time.monotonic() + delay
+                if code != 0:
+                    print(f"⚠️ Worker {slot} (pid {pid}) gestopt met code {code}, "
+                          f"herstart over {delay:.0f}s")
+            freed.append(slot)
+        return freed
+
+    def run(self):
+        previous = {signum: signal.signal(signum, handler) for signum, handler in (
+            (signal.SIGTERM, self._on_stop),
+            (signal.SIGINT, self._on_stop),
+            (signal.SIGHUP, self._on_reload),
+        )}
+        try:
+            for slot in range(self.args.workers):
+                self.spawn(slot)
+            pending = set()
+            refresh_at = time.monotonic()
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    print("🔄 Workers worden een voor een herstart")
+                    # The restarted workers map a fresh region; the old one
+                    # goes away with the last worker still using it
+                    share_caches(self.args, fresh=True)
+                    self._roll = list(range(self.args.workers))
+                    self._rolling = None
+                pending.update(self._reap())
+                now = time.monotonic()
+                if SHARED_CACHE.enabled and now >= refresh_at:
+                    # Changed hot files are read and compressed here once,
+                    # not by every worker
+                    refresh_at = now + max(self.args.static_check_interval, 1.0)
+                    STATIC_CACHE.warm(PRELOAD_FILES)
+                    STATIC_CACHE.share(SHARED_CACHE)
+                for slot in sorted(pending):
+                    if not self._stopping and self._restart_at.get(slot, 0) <= now:
+                        pending.discard(slot)
+                        self.spawn(slot)
+                if self._roll or self._rolling is not None:
+                    self._advance_reload()
+                time.sleep(self.poll_interval)
+            self.shutdown()
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            if self.listener is not None:
+                self.listener.close()
+
+    def shutdown(self):
+        """Forward SIGTERM and wait for the workers, killing stragglers"""
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_grace
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        if self.workers:
+            self.signal_workers(signal.SIGKILL)
+            while self.workers:
+                try:
+                    pid, _ = os.waitpid(-1, 0)
+                except ChildProcessError:
+                    break
+                self.workers.pop(pid, None)
+
+
+def share_caches(args, fresh=False):
+    """Publish the warmed caches to shared memory before forking --workers"""
+    if args.workers < 2 or not args.shared_cache_bytes:
+        return
+    if fresh or not SHARED_CACHE.enabled:
+        SHARED_CACHE.allocate(args.shared_cache_bytes)
+    if not SHARED_COUNTERS.enabled:
+        SHARED_COUNTERS.allocate(args.workers, lanes=args.pool_size)
+    RENDER_CACHE.share(SHARED_CACHE)
+    STATIC_CACHE.share(SHARED_CACHE)
+
+
+def configure_access_log(args):
+    if args.access_log == "off":
+        ACCESS_LOG.stream = None
+    elif args.access_log == "-":
+        ACCESS_LOG.configure(stream=sys.stdout)
+    else:
+        ACCESS_LOG.configure(stream=open(args.access_log, "a", encoding="utf-8", buffering=1))
+    ACCESS_LOG.configure(sample_rate=args.access_log_sample, queue_size=args.access_log_queue)
+
+
+def describe_mode(args):
+    if args.engine == "asyncio":
+        text = f"asyncio ({args.pool_size} handler threads)"
+    elif args.mode == "pool":
+        text = f"pool ({args.pool_size} workers, wachtrij {args.accept_queue})"
+    elif args.mode == "thread":
+        text = "thread-per-request"
+    else:
+        text = "single (één request tegelijk)"
+    if args.max_connections:
+        text += f", max {args.max_connections} verbindingen"
+    if args.workers > 1:
+        sharing = "SO_REUSEPORT" if args.reuse_port else "gedeelde socket"
+        text += f", {args.workers} processen ({sharing})"
+    return text
+
+
+def print_banner(args, PORT):
+    print(f"🚀 DHgate Monitor Local Development Server gestart!")
+    print(f"📍 URL: http://localhost:{PORT}")
+    print(f"⚙️  Modus: {describe_mode(args)}")
+    print(f"🏠  Hoofdpagina: http://localhost:{PORT}/")
+    print(f"📊  Dashboard: http://localhost:{PORT}/dashboard")
+    print(f"📰  Newsroom: http://localhost:{PORT}/newsroom")
+    print(f"🛠️  Service: http://localhost:{PORT}/service")
+    print(f"📞  Contact: http://localhost:{PORT}/contact")
+    print(f"🔒  Privacy: http://localhost:{PORT}/privacy")
+    print(f"📋  Terms: http://localhost:{PORT}/terms")
+    print(f"🗑️  Delete Data: http://localhost:{PORT}/delete-data")
+    print(f"🏪  Add Shop: http://localhost:{PORT}/add_shop")
+    print(f"⚙️  Settings: http://localhost:{PORT}/settings")
+    print(f"📧  Unsubscribe: http://localhost:{PORT}/unsubscribe")
+    print(f"⏹️  Stop de server met Ctrl+C")
+
 
-def main():
-    PORT = 3000
+def main(argv=None):
+    args = parse_args(argv)
+    PORT = args.port
+    STATIC_CACHE.configure(max_bytes=args.static_cache_bytes,
+                           check_interval=args.static_check_interval,
+                           stream_threshold=args.sendfile_threshold)
+    configure_access_log(args)
+    PROFILER.configure(args.profile_sample)
+    ADMISSION.configure(max_in_flight=args.max_in_flight, max_queued=args.max_queued,
+                        queue_timeout=args.queue_timeout, reserve=args.priority_reserve,
+                        client_rate=args.client_rate, client_burst=args.client_burst,
+                        max_clients=args.max_clients)
+    SIGNUP_STORE.configure(path=args.db, batch_size=args.db_commit_batch)
+    SIGNUP_STORE.initialize()
+    EVENT_BROADCASTER.configure(poll_interval=args.event_poll, max_buffer=args.event_buffer)
+    EVENT_BROADCASTER.initialize()
+    EVENT_STREAMS.heartbeat = args.event_heartbeat
+    PRICE_HISTORY.configure(directory=args.history_dir or None)
+    # Before forking, so the workers share these pages copy-on-write
+    STATIC_CACHE.warm(PRELOAD_FILES)
+    RENDER_CACHE.warm()
+    UNSUBSCRIBE_TEMPLATE.warm()
+    share_caches(args)
     
     # Check if port is available
     try:
-        with socketserver.TCPServer(("", PORT), DHgateMonitorHandler) as httpd:
-            print(f"🚀 DHgate Monitor Local Development Server gestart!")
-            print(f"📍 URL: http://localhost:{PORT}")
-            print(f"🏠  Hoofdpagina: http://localhost:{PORT}/")
-            print(f"📊  Dashboard: http://localhost:{PORT}/dashboard")
-            print(f"📰  Newsroom: http://localhost:{PORT}/newsroom")
-            print(f"🛠️  Service: http://localhost:{PORT}/service")
-            print(f"📞  Contact: http://localhost:{PORT}/contact")
-            print(f"🔒  Privacy: http://localhost:{PORT}/privacy")
-            print(f"📋  Terms: http://localhost:{PORT}/terms")
-            print(f"🗑️  Delete Data: http://localhost:{PORT}/delete-data")
-            print(f"🏪  Add Shop: http://localhost:{PORT}/add_shop")
-            print(f"⚙️  Settings: http://localhost:{PORT}/settings")
-            print(f"📧  Unsubscribe: http://localhost:{PORT}/unsubscribe")
-            print(f"⏹️  Stop de server met Ctrl+C")
+        if args.workers > 1:
+            supervisor = WorkerSupervisor(args)
+            PORT = supervisor.open_listener()
+            print_banner(args, PORT)
+            sys.stdout.flush()
+            supervisor.run()
+            print(f"\n⏹️ Server gestopt")
+            return
+        if args.engine == "asyncio":
+            run_asyncio_server(args, on_started=lambda address: print_banner(args, address[1]))
+            return
+        with build_server(args) as httpd:
+            print_banner(args, PORT)
             
             httpd.serve_forever()
     except OSError as e:
-        if e.errno == 48:  # Address already in use
+        if e.errno in (48, errno.EADDRINUSE):  # Address already in use
             print(f"❌ Poort {PORT} is al in gebruik. Probeer een andere poort of stop andere servers.")
         else:
             print(f"❌ Fout bij starten server: {e}")
     except KeyboardInterrupt:
         print(f"\n⏹️ Server gestopt door gebruiker")
+    finally:
+        SIGNUP_STORE.close()
+        ACCESS_LOG.close()
 
 if __name__ == "__main__":
     main()
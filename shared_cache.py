@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor gedeeld geheugen
+Eén kopie van gerenderde pagina's en tellers voor alle pre-fork workers
+"""
+
+import hashlib
+import mmap
+import struct
+import threading
+
+# Region header: magic, layout version, slot count, arena size, arena bytes used
+HEADER = struct.Struct('<4sIQQQ')
+MAGIC = b'DHSC'
+VERSION = 1
+# Index slot: sequence number, key hash, entry offset, data length
+SLOT = struct.Struct('<QQQQ')
+SEQ = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<H')
+ALIGN = 8
+READ_RETRIES = 100
+
+COUNTER_NAMES = ('requests', 'responses_1xx', 'responses_2xx', 'responses_3xx', 'responses_4xx',
+                 'responses_5xx', 'bytes_sent')
+
+
+def key_hash(key):
+    """Non-zero 64-bit hash; 0 marks an empty slot"""
+    value = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+    return value or 1
+
+
+class SharedResponseCache:
+    """Immutable encoded responses in one shared anonymous mmap.
+
+    The region is mapped before the workers are forked, so every worker
+    sees the same physical pages instead of a private copy of each body.
+    It holds an open-addressing hash table of seqlock-protected slots
+    followed by an append-only arena. Only one process (the supervisor)
+    publishes: it writes the entry into free arena space first and then
+    bumps the slot's sequence number to odd, fills the slot and bumps it
+    back to even. Readers take no lock; they retry while the sequence is
+    odd or changed under them. Arena bytes are never overwritten, so a
+    body handed out as a memoryview stays valid; new versions of a file
+    get a new key, and a full region makes publish() return None so the
+    caller keeps its private copy. A reload (SIGHUP) maps a fresh region.
+    """
+
+    def __init__(self):
+        self._map = None
+        self._view = None
+        self.slots = 0
+        self.arena_start = 0
+        self.arena_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self._map is not None
+
+    def allocate(self, size, slots=4096):
+        """Map a fresh region of `size` bytes (call before forking)"""
+        self.close()
+        self.slots = slots
+        self.arena_start = HEADER.size + slots * SLOT.size
+        self.arena_size = max(0, size - self.arena_start)
+        self._map = mmap.mmap(-1, self.arena_start + self.arena_size)
+        self._view = memoryview(self._map)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, slots, self.arena_size, 0)
+
+    @property
+    def used(self):
+        return HEADER.unpack_from(self._map)[4] if self._map is not None else 0
+
+    def _slot_offset(self, index):
+        return HEADER.size + index * SLOT.size
+
+    def _read_slot(self, offset):
+        """Consistent (hash, entry offset, length) of a slot, without locking"""
+        for _ in range(READ_RETRIES):
+            before = SEQ.unpack_from(self._map, offset)[0]
+            if before & 1:
+                continue
+            _, hashed, entry, length = SLOT.unpack_from(self._map, offset)
+            if SEQ.unpack_from(self._map, offset)[0] == before:
+                return hashed, entry, length
+        return None
+
+    def _find(self, key, hashed):
+        """(slot offset, entry view or None) for key; slot offset None when the table is full"""
+        for probe in range(self.slots):
+            offset = self._slot_offset((hashed + probe) % self.slots)
+            slot = self._read_slot(offset)
+            if slot is None:
+                return None, None  # a publish kept the slot busy; treat as a miss
+            slot_hash, entry, length = slot
+            if slot_hash == 0:
+                return offset, None
+            if slot_hash == hashed:
+                key_length = KEY_LENGTH.unpack_from(self._map, entry)[0]
+                start = entry + KEY_LENGTH.size
+                if self._view[start:start + key_length] == key:
+                    start += key_length
+                    return offset, self._view[start:start + length].toreadonly()
+        return None, None
+
+    def get(self, key):
+        """Read-only memoryview of the body published under key, or None"""
+        if self._map is None:
+            return None
+        key = key.encode('utf-8')
+        _, body = self._find(key, key_hash(key))
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def publish(self, key, data):
+        """Store data under key (single writer); returns its shared view or None"""
+        if self._map is None:
+            return None
+        key = key.encode('utf-8')
+        hashed = key_hash(key)
+        offset, body = self._find(key, hashed)
+        if body is not None and body == data:
+            return body
+        if offset is None:
+            return None
+        used = self.used
+        entry = self.arena_start + used
+        size = KEY_LENGTH.size + len(key) + len(data)
+        if used + size > self.arena_size:
+            return None
+        KEY_LENGTH.pack_into(self._map, entry, len(key))
+        start = entry + KEY_LENGTH.size
+        self._map[start:start + len(key)] = key
+        start += len(key)
+        self._map[start:start + len(data)] = data
+        used += -(-size // ALIGN) * ALIGN
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.slots, self.arena_size, used)
+        # Seqlock: odd while the slot is being rewritten
+        sequence = SEQ.unpack_from(self._map, offset)[0]
+        SEQ.pack_into(self._map, offset, sequence + 1)
+        SLOT.pack_into(self._map, offset, sequence + 1, hashed, entry, len(data))
+        SEQ.pack_into(self._map, offset, sequence + 2)
+        return self._view[start:start + len(data)].toreadonly()
+
+    def stats(self):
+        return {'bytes': self.used, 'capacity': self.arena_size, 'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self):
+        # Bodies handed out still reference the old mapping; it is unmapped
+        # once the last of them is gone
+        self._map = self._view = None
+
+
+class SharedCounters:
+    """Monotonic per-worker counters in one shared anonymous mmap.
+
+    Every worker owns a row, split into one lane of 64-bit cells per
+    handler thread plus an overflow lane. A thread claims a free lane (or
+    the lane of a thread that has exited) on its first response and from
+    then on is the only writer of its cells, so counting takes no lock;
+    only threads beyond `lanes` share the overflow lane behind a lock.
+    Aligned 8-byte cells are written in one store, so readers never see a
+    torn value; any worker can sum all lanes for /metrics. A restarted
+    worker takes over its slot's row and keeps counting.
+    """
+
+    def __init__(self, names=COUNTER_NAMES):
+        self.names = names
+        self.index = {name: position for position, name in enumerate(names)}
+        self.row_format = struct.Struct(f'<{len(names)}Q')
+        self._status_cells = {status // 100: self.index[f'responses_{status // 100}xx'] * SEQ.size
+                              for status in range(100, 600, 100)
+                              if f'responses_{status // 100}xx' in self.index}
+        self._map = None
+        self.rows = 0
+        self.lanes = 0
+        self.row = 0
+        self._owners = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._map is not None
+
+    def allocate(self, rows, lanes=16):
+        """Map zeroed counters for `rows` workers with `lanes` handler
+        threads each (call before forking)"""
+        self.rows = rows
+        self.lanes = lanes
+        self._map = mmap.mmap(-1, rows * (lanes + 1) * self.row_format.size)
+
+    def use_row(self, row):
+        self.row = row
+        self._owners = [None] * self.lanes
+        self._local = threading.local()
+
+    def _lane(self):
+        try:
+            return self._local.lane
+        except AttributeError:
+            pass
+        thread = threading.current_thread()
+        lane = self.lanes
+        with self._lock:
+            for index, owner in enumerate(self._owners):
+                if owner is None or not owner.is_alive():
+                    self._owners[index] = thread
+                    lane = index
+                    break
+        self._local.lane = lane
+        return lane
+
+    def _bump(self, cells):
+        """Add [(cell offset, amount)] to the calling thread's lane"""
+        lane = self._lane()
+        base = (self.row * (self.lanes + 1) + lane) * self.row_format.size
+        if lane < self.lanes:
+            for offset, amount in cells:
+                SEQ.pack_into(self._map, base + offset,
+                              SEQ.unpack_from(self._map, base + offset)[0] + amount)
+            return
+        with self._lock:
+            for offset, amount in cells:
+                SEQ.pack_into(self._map, base + offset,
+                              SEQ.unpack_from(self._map, base + offset)[0] + amount)
+
+    def add(self, values):
+        """Add {name: amount} to this worker's row"""
+        if self._map is None:
+            return
+        self._bump([(self.index[name] * SEQ.size, amount) for name, amount in values.items()])
+
+    def record_response(self, status, size):
+        if self._map is None:
+            return
+        cells = [(self.index['requests'] * SEQ.size, 1), (self.index['bytes_sent'] * SEQ.size, size)]
+        offset = self._status_cells.get(status // 100)
+        if offset is not None:
+            cells.append((offset, 1))
+        self._bump(cells)
+
+    def snapshot(self):
+        """[{name: value}] per worker row, summed over its lanes"""
+        if self._map is None:
+            return []
+        rows = []
+        size = self.row_format.size
+        for row in range(self.rows):
+            base = row * (self.lanes + 1) * size
+            totals = [0] * len(self.names)
+            for lane in range(self.lanes + 1):
+                for position, value in enumerate(self.row_format.unpack_from(self._map, base + lane * size)):
+                    totals[position] += value
+            rows.append(dict(zip(self.names, totals)))
+        return rows
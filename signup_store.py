@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+"""
+DHgate Monitor signup opslag
+SQLite (WAL) schrijfpad voor de subscriptions tabel van init.sql
+"""
+
+import concurrent.futures
+import json
+import os
+import time
+import queue
+import re
+import secrets
+import sqlite3
+import string
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+DEFAULT_DB_PATH = "dhgate-monitor.db"
+
+# Same limits as SecurityUtils in cloudflare_app.js
+MAX_EMAIL_LENGTH = 254
+MAX_URL_LENGTH = 2048
+MAX_WIDGET_STORES = 5
+MAX_WIDGET_TAGS = 10
+MAX_SHOPS = 50
+ALLOWED_DOMAINS = ('dhgate.com', 'dhgate.co.uk')
+STORE_PAGE_ID = re.compile(r'(\d+)(?:\.html)?')
+EMAIL_PATTERN = re.compile(r'^[^\s@]+@[^\s@]+\.[^\s@]+$')
+
+SUPPORTED_LANGS = ('en', 'nl')
+NOTIFICATION_LEVELS = ('all', 'important', 'none')
+MONITORING_TYPES = ('full', 'products', 'prices')
+
+TOKEN_ALPHABET = string.ascii_letters + string.digits
+TOKEN_PATTERN = re.compile(r'[A-Za-z0-9]+')
+UNSUBSCRIBE_TOKEN_LENGTH = 32
+DASHBOARD_TOKEN_LENGTH = 40
+
+# Tables of init.sql plus the local-only ones; IF NOT EXISTS keeps it idempotent
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  email TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  email TEXT NOT NULL,
+  stores TEXT,
+  tags TEXT,
+  lang TEXT DEFAULT 'nl',
+  unsubscribe_token TEXT,
+  dashboard_token TEXT,
+  dashboard_access BOOLEAN DEFAULT 1,
+  subscribed BOOLEAN DEFAULT 1,
+  email_marketing_consent BOOLEAN DEFAULT 1,
+  notifications TEXT DEFAULT 'all',
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_email ON subscriptions (email);
+
+-- Shops added through /add_shop; the store id is also listed in subscriptions.stores
+CREATE TABLE IF NOT EXISTS shops (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  subscription_id INTEGER NOT NULL REFERENCES subscriptions (id) ON DELETE CASCADE,
+  store TEXT NOT NULL,
+  shop_url TEXT NOT NULL,
+  shop_name TEXT,
+  monitoring_type TEXT DEFAULT 'full',
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  UNIQUE (subscription_id, store)
+);
+
+CREATE TABLE IF NOT EXISTS contact_messages (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  email TEXT NOT NULL,
+  message TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Fan-out index: one row per (active subscription, store/tag). The triggers
+-- keep it in sync with the JSON blobs in subscriptions.stores/tags, and
+-- unsubscribed rows are left out, so "who follows store X" is answered
+-- from the index alone without touching subscriptions.
+CREATE TABLE IF NOT EXISTS subscription_stores (
+  subscription_id INTEGER NOT NULL,
+  store TEXT NOT NULL,
+  PRIMARY KEY (subscription_id, store)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_subscription_stores_store ON subscription_stores (store, subscription_id);
+
+CREATE TABLE IF NOT EXISTS subscription_tags (
+  subscription_id INTEGER NOT NULL,
+  tag TEXT NOT NULL,
+  PRIMARY KEY (subscription_id, tag)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_subscription_tags_tag ON subscription_tags (tag, subscription_id);
+"""
+
+# Created after the migrations, so rewriting old blobs does not fire them row by row
+FANOUT_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_insert
+AFTER INSERT ON subscriptions WHEN NEW.subscribed
+BEGIN
+  INSERT OR IGNORE INTO subscription_stores (subscription_id, store)
+    SELECT NEW.id, value FROM json_each(CASE WHEN json_valid(NEW.stores) THEN NEW.stores ELSE '[]' END)
+    WHERE type = 'text';
+  INSERT OR IGNORE INTO subscription_tags (subscription_id, tag)
+    SELECT NEW.id, lower(value) FROM json_each(CASE WHEN json_valid(NEW.tags) THEN NEW.tags ELSE '[]' END)
+    WHERE type = 'text';
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_update
+AFTER UPDATE OF stores, tags, subscribed ON subscriptions
+BEGIN
+  DELETE FROM subscription_stores WHERE subscription_id = OLD.id;
+  DELETE FROM subscription_tags WHERE subscription_id = OLD.id;
+  INSERT OR IGNORE INTO subscription_stores (subscription_id, store)
+    SELECT NEW.id, value FROM json_each(CASE WHEN json_valid(NEW.stores) THEN NEW.stores ELSE '[]' END)
+    WHERE type = 'text' AND NEW.subscribed;
+  INSERT OR IGNORE INTO subscription_tags (subscription_id, tag)
+    SELECT NEW.id, lower(value) FROM json_each(CASE WHEN json_valid(NEW.tags) THEN NEW.tags ELSE '[]' END)
+    WHERE type = 'text' AND NEW.subscribed;
+END;
+
+CREATE TRIGGER IF NOT EXISTS subscriptions_fanout_delete
+AFTER DELETE ON subscriptions
+BEGIN
+  DELETE FROM subscription_stores WHERE subscription_id = OLD.id;
+  DELETE FROM subscription_tags WHERE subscription_id = OLD.id;
+END;
+"""
+
+# PRAGMA user_version of a fully migrated database
+SCHEMA_VERSION = 3
+
+# Columns added after the first release, for databases created before them
+MIGRATIONS = (
+    ('subscriptions', 'notifications', "ALTER TABLE subscriptions ADD COLUMN notifications TEXT DEFAULT 'all'"),
+)
+
+
+class ValidationError(ValueError):
+    """Rejected user input; the message is safe to show to the client"""
+
+
+def generate_token(length):
+    return ''.join(secrets.choice(TOKEN_ALPHABET) for _ in range(length))
+
+
+def is_token(token, length):
+    """Shape check done before any lookup: exact length, alphanumeric only"""
+    return (isinstance(token, str) and len(token) == length
+            and TOKEN_PATTERN.fullmatch(token) is not None)
+
+
+def normalize_email(email):
+    if not isinstance(email, str) or not email.strip():
+        raise ValidationError("Email is required")
+    email = email.strip().lower()
+    if len(email) > MAX_EMAIL_LENGTH:
+        raise ValidationError("Email too long")
+    if not EMAIL_PATTERN.match(email):
+        raise ValidationError("Invalid email address")
+    return email
+
+
+def normalize_list(values, limit, field):
+    """Strings (or widget store objects) trimmed, deduplicated and capped"""
+    if values is None:
+        return []
+    if isinstance(values, str):
+        values = values.split(',')
+    if not isinstance(values, list):
+        raise ValidationError(f"{field} must be a list")
+    result = []
+    for value in values:
+        if isinstance(value, dict):
+            value = value.get('id') or value.get('name') or ''
+        value = str(value).strip()
+        if value and value not in result:
+            result.append(value)
+    return result[:limit]
+
+
+def parse_blob(value):
+    """stores/tags column value as a list of strings.
+
+    Rows written by the Worker hold JSON arrays, widget signups may hold
+    store objects and older rows plain comma separated text.
+    """
+    if not value:
+        return []
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        parsed = value.split(',')
+    if isinstance(parsed, str):
+        parsed = [parsed]
+    if not isinstance(parsed, list):
+        return []
+    return normalize_list(parsed, None, 'values')
+
+
+def migrate_fanout_index(conn):
+    """Rewrite the stores/tags blobs as JSON string arrays and rebuild the junction tables"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for trigger in ('insert', 'update', 'delete'):
+            conn.execute(f"DROP TRIGGER IF EXISTS subscriptions_fanout_{trigger}")
+        updates = []
+        for subscription_id, stores, tags in conn.execute(
+                "SELECT id, stores, tags FROM subscriptions").fetchall():
+            new_stores = json.dumps(parse_blob(stores)) if stores is not None else None
+            new_tags = json.dumps(parse_blob(tags)) if tags is not None else None
+            if (new_stores, new_tags) != (stores, tags):
+                updates.append((new_stores, new_tags, subscription_id))
+        conn.executemany("UPDATE subscriptions SET stores = ?, tags = ? WHERE id = ?", updates)
+        conn.execute("DELETE FROM subscription_stores")
+        conn.execute("DELETE FROM subscription_tags")
+        conn.execute(
+            "INSERT OR IGNORE INTO subscription_stores (subscription_id, store) "
+            "SELECT s.id, j.value FROM subscriptions s, json_each(s.stores) j "
+            "WHERE s.subscribed AND json_valid(s.stores) AND j.type = 'text'")
+        conn.execute(
+            "INSERT OR IGNORE INTO subscription_tags (subscription_id, tag) "
+            "SELECT s.id, lower(j.value) FROM subscriptions s, json_each(s.tags) j "
+            "WHERE s.subscribed AND json_valid(s.tags) AND j.type = 'text'")
+        conn.execute("PRAGMA user_version = 2")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(updates)
+
+
+def migrate_unique_tokens(conn):
+    """Give duplicate tokens fresh values, then enforce uniqueness with indexes"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        renewed = 0
+        for column, length in (('unsubscribe_token', UNSUBSCRIBE_TOKEN_LENGTH),
+                               ('dashboard_token', DASHBOARD_TOKEN_LENGTH)):
+            conn.execute(f"UPDATE subscriptions SET {column} = NULL WHERE {column} = ''")
+            # The newest row keeps a shared token, older ones get a new one
+            duplicates = conn.execute(
+                f"SELECT id FROM subscriptions WHERE {column} IN "
+                f"(SELECT {column} FROM subscriptions GROUP BY {column} HAVING count(*) > 1) "
+                f"AND id NOT IN (SELECT max(id) FROM subscriptions WHERE {column} IS NOT NULL "
+                f"GROUP BY {column})").fetchall()
+            conn.executemany(f"UPDATE subscriptions SET {column} = ? WHERE id = ?",
+                             [(generate_token(length), row[0]) for row in duplicates])
+            renewed += len(duplicates)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_unsubscribe_token "
+                     "ON subscriptions (unsubscribe_token)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_dashboard_token "
+                     "ON subscriptions (dashboard_token)")
+        conn.execute("PRAGMA user_version = 3")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return renewed
+
+
+# (version reached, migration) in order; each one sets PRAGMA user_version itself
+VERSION_MIGRATIONS = (
+    (2, migrate_fanout_index),
+    (3, migrate_unique_tokens),
+)
+
+
+def normalize_choice(value, choices, field):
+    if value in choices:
+        return value
+    raise ValidationError(f"Invalid {field}")
+
+
+def store_id_for_url(url):
+    """DHgate store id from a shop URL, e.g. .../store/21168508 -> 21168508
+
+    Returns (store, url); the crawler builds its page URLs from the store id.
+    """
+    if not isinstance(url, str) or not url.strip():
+        raise ValidationError("URL is required")
+    url = url.strip()
+    if len(url) > MAX_URL_LENGTH:
+        raise ValidationError("URL too long")
+    parsed = urllib.parse.urlsplit(url)
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme not in ('http', 'https') or not any(
+            host == domain or host.endswith('.' + domain) for domain in ALLOWED_DOMAINS):
+        raise ValidationError("Only DHgate URLs are allowed")
+    parts = [part for part in parsed.path.split('/') if part]
+    if 'store' in parts and parts.index('store') + 1 < len(parts):
+        following = parts[parts.index('store') + 1:]
+        # Listing pages such as /store/products/20522858.html name the id last
+        for part in following:
+            match = STORE_PAGE_ID.fullmatch(part)
+            if match:
+                return match.group(1), url
+        return following[0], url
+    return host + '/' + '/'.join(parts), url
+
+
+def _signup(conn, email, stores, tags, lang):
+    row = conn.execute(
+        "SELECT id, unsubscribe_token, dashboard_token FROM subscriptions "
+        "WHERE email = ? ORDER BY id DESC LIMIT 1", (email,)).fetchone()
+    if row is not None:
+        conn.execute(
+            "UPDATE subscriptions SET stores = ?, tags = ?, lang = ?, subscribed = 1, "
+            "dashboard_access = 1, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+            (json.dumps(stores), json.dumps(tags), lang, row[0]))
+        return {'id': row[0], 'created': False,
+                'unsubscribe_token': row[1], 'dashboard_token': row[2]}
+    unsubscribe_token = generate_token(UNSUBSCRIBE_TOKEN_LENGTH)
+    dashboard_token = generate_token(DASHBOARD_TOKEN_LENGTH)
+    cursor = conn.execute(
+        "INSERT INTO subscriptions (email, stores, tags, lang, unsubscribe_token, dashboard_token) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (email, json.dumps(stores), json.dumps(tags), lang, unsubscribe_token, dashboard_token))
+    return {'id': cursor.lastrowid, 'created': True,
+            'unsubscribe_token': unsubscribe_token, 'dashboard_token': dashboard_token}
+
+
+def _subscription_for_token(conn, dashboard_token):
+    row = conn.execute(
+        "SELECT id, stores FROM subscriptions WHERE dashboard_token = ? AND dashboard_access = 1",
+        (dashboard_token,)).fetchone()
+    if row is None:
+        raise ValidationError("Invalid or expired dashboard key")
+    return row
+
+
+def _update_settings(conn, dashboard_token, lang, notifications):
+    subscription_id, _ = _subscription_for_token(conn, dashboard_token)
+    conn.execute(
+        "UPDATE subscriptions SET lang = ?, notifications = ?, last_updated = CURRENT_TIMESTAMP "
+        "WHERE id = ?", (lang, notifications, subscription_id))
+    return {'id': subscription_id}
+
+
+def _add_shop(conn, dashboard_token, store, shop_url, shop_name, monitoring_type):
+    subscription_id, stores = _subscription_for_token(conn, dashboard_token)
+    stores = parse_blob(stores)
+    if store not in stores:
+        if len(stores) >= MAX_SHOPS:
+            raise ValidationError(f"At most {MAX_SHOPS} shops can be monitored")
+        stores.append(store)
+    conn.execute(
+        "INSERT INTO shops (subscription_id, store, shop_url, shop_name, monitoring_type) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT (subscription_id, store) DO UPDATE SET "
+        "shop_url = excluded.shop_url, shop_name = excluded.shop_name, "
+        "monitoring_type = excluded.monitoring_type",
+        (subscription_id, store, shop_url, shop_name, monitoring_type))
+    conn.execute(
+        "UPDATE subscriptions SET stores = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+        (json.dumps(stores), subscription_id))
+    return {'id': subscription_id, 'store': store}
+
+
+def _unsubscribe(conn, unsubscribe_token):
+    rows = conn.execute(
+        "UPDATE subscriptions SET subscribed = 0, last_updated = CURRENT_TIMESTAMP "
+        "WHERE unsubscribe_token = ? RETURNING id, email, lang", (unsubscribe_token,)).fetchall()
+    if not rows:
+        return None
+    subscription_id, email, lang = rows[0]
+    return {'id': subscription_id, 'email': email, 'lang': lang}
+
+
+def _save_contact_message(conn, name, email, message):
+    cursor = conn.execute(
+        "INSERT INTO contact_messages (name, email, message) VALUES (?, ?, ?)",
+        (name, email, message))
+    return {'id': cursor.lastrowid}
+
+
+class TokenCache:
+    """Resolved dashboard tokens, bounded by entry count (LRU) and age (TTL).
+
+    Only valid tokens are cached, so guessing traffic cannot evict them.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[token]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, value):
+        with self._lock:
+            self._entries[token] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class SignupStore:
+    """SQLite signup store with one writer thread doing group commits.
+
+    Request threads never write themselves: every write is queued as a
+    small operation and the writer thread runs whatever has queued up in
+    a single transaction, so one fsync covers a whole burst of signups.
+    Each operation runs in its own savepoint, so a rejected signup does
+    not roll back the others in its batch. The database is in WAL mode,
+    so readers on their own per-thread connections are never blocked by
+    the writer. Threads and connections do not survive fork(); both are
+    created lazily in the process that uses them.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, batch_size=256, write_timeout=10.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.write_timeout = write_timeout
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.token_cache = TokenCache()
+        self.commits = 0
+        self.writes = 0
+
+    def configure(self, path=None, batch_size=None):
+        if path is not None:
+            self.path = path
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # FULL keeps every commit durable; group commit is what makes it cheap
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def initialize(self):
+        """Create or migrate the schema (call before forking workers)"""
+        conn = self.connect()
+        try:
+            conn.executescript(SCHEMA)
+            for table, column, statement in MIGRATIONS:
+                columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    conn.execute(statement)
+            for version, migration in VERSION_MIGRATIONS:
+                if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+                    migration(conn)
+            conn.executescript(FANOUT_TRIGGERS)
+        finally:
+            conn.close()
+
+    def reader(self):
+        """This thread's read connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self.connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    # Fan-out queries, answered from the junction table indexes alone
+
+    def subscribers_for_stores(self, stores):
+        """Ids of active subscriptions following any of `stores`"""
+        return self._fanout("SELECT DISTINCT subscription_id FROM subscription_stores "
+                            "WHERE store IN (SELECT value FROM json_each(?)) "
+                            "ORDER BY subscription_id", stores)
+
+    def subscribers_for_tags(self, tags):
+        """Ids of active subscriptions watching any of `tags` (case-insensitive)"""
+        return self._fanout("SELECT DISTINCT subscription_id FROM subscription_tags "
+                            "WHERE tag IN (SELECT value FROM json_each(?)) "
+                            "ORDER BY subscription_id", [tag.lower() for tag in tags])
+
+    def stores_for_subscription(self, subscription_id):
+        """Stores an active subscription follows (widget stores and added shops)"""
+        rows = self.reader().execute(
+            "SELECT store FROM subscription_stores WHERE subscription_id = ?", (subscription_id,))
+        return [row[0] for row in rows]
+
+    def _fanout(self, query, values):
+        # One JSON parameter instead of one placeholder per value, so any
+        # number of changed stores fits in a single statement
+        rows = self.reader().execute(query, (json.dumps(list(values)),))
+        return [row[0] for row in rows]
+
+    # Token resolution
+
+    def resolve_dashboard_token(self, token):
+        """{'id', 'email', 'lang'} of the subscription with this dashboard token, or None.
+
+        Malformed tokens are rejected by a fixed-length shape check before
+        any lookup; every well-formed miss costs the same single probe of
+        the unique token index, so rejection time does not depend on how
+        close a guess was.
+        """
+        if not is_token(token, DASHBOARD_TOKEN_LENGTH):
+            return None
+        subscription = self.token_cache.get(token)
+        if subscription is not None:
+            return subscription
+        row = self.reader().execute(
+            "SELECT id, email, lang FROM subscriptions "
+            "WHERE dashboard_token = ? AND dashboard_access = 1", (token,)).fetchone()
+        if row is None:
+            return None
+        subscription = {'id': row[0], 'email': row[1], 'lang': row[2]}
+        self.token_cache.put(token, subscription)
+        return subscription
+
+    def unsubscribe(self, token):
+        """Unsubscribe by unsubscribe token in one indexed UPDATE; None for unknown tokens"""
+        if not is_token(token, UNSUBSCRIBE_TOKEN_LENGTH):
+            return None
+        return self.submit(_unsubscribe, token)
+
+    # Public write API; each call blocks until its batch has committed
+
+    def signup(self, email, stores, tags, lang):
+        email = normalize_email(email)
+        stores = normalize_list(stores, MAX_WIDGET_STORES, 'stores')
+        tags = normalize_list(tags, MAX_WIDGET_TAGS, 'tags')
+        lang = lang if lang in SUPPORTED_LANGS else 'en'
+        return self.submit(_signup, email, stores, tags, lang)
+
+    def update_settings(self, dashboard_token, lang, notifications):
+        if not is_token(dashboard_token, DASHBOARD_TOKEN_LENGTH):
+            raise ValidationError("Invalid or expired dashboard key")
+        lang = normalize_choice(lang, SUPPORTED_LANGS, 'language')
+        notifications = normalize_choice(notifications, NOTIFICATION_LEVELS, 'notification setting')
+        return self.submit(_update_settings, dashboard_token, lang, notifications)
+
+    def add_shop(self, dashboard_token, shop_url, shop_name, monitoring_type):
+        if not is_token(dashboard_token, DASHBOARD_TOKEN_LENGTH):
+            raise ValidationError("Invalid or expired dashboard key")
+        store, shop_url = store_id_for_url(shop_url)
+        monitoring_type = normalize_choice(monitoring_type or 'full', MONITORING_TYPES,
+                                           'monitoring type')
+        shop_name = (shop_name or '').strip()[:200] or None
+        return self.submit(_add_shop, dashboard_token, store, shop_url, shop_name,
+                           monitoring_type)
+
+    def save_contact_message(self, name, email, message):
+        name = (name or '').strip()
+        message = (message or '').strip()
+        if not name or not message:
+            raise ValidationError("Name and message are required")
+        return self.submit(_save_contact_message, name[:200], normalize_email(email),
+                           message[:5000])
+
+    def submit(self, operation, *args):
+        """Queue operation(conn, *args) for the writer and wait for its result"""
+        return self.submit_async(operation, *args).result(timeout=self.write_timeout)
+
+    def submit_async(self, operation, *args):
+        """Queue operation(conn, *args) without waiting; returns its future"""
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put((operation, args, future))
+        return future
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name="dhgate-signup-writer",
+                                                daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        conn = self.connect()
+        while True:
+            batch = [self._queue.get()]
+            # Everything that queued up during the previous commit joins this one
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit(conn, batch)
+            if stop:
+                conn.close()
+                self._fail_queued()
+                return
+
+    def _fail_queued(self):
+        # Writes submitted after close() would otherwise wait out their timeout
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[2].set_exception(RuntimeError("signup store is closed"))
+
+    def _commit(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for operation, args, _ in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    results.append((True, operation(conn, *args)))
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    # One failing operation must not take the writer thread down
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((False, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            try:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.commits += 1
+        self.writes += len(batch)
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def close(self):
+        """Finish queued writes and stop the writer thread"""
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._pid = None
+
+    def stats(self):
+        return {'commits': self.commits, 'writes': self.writes, 'queued': self._queue.qsize()}
@@ -0,0 +1,193 @@
+"""
+DHgate Monitor testhulpmiddelen
+Nep SMTP- en DHgate-servers voor de Python tests
+"""
+
+import collections
+import gzip
+import hashlib
+import http.server
+import os
+import socketserver
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server on a free local port that keeps what it receives.
+
+    `messages` holds (recipient, data) with the dot-stuffing undone, the way
+    a real server stores mail. Recipients in `reject` get a 550; those in
+    `defer` get a 451 the first time they are seen.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pipelining=True, reject=(), defer=()):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.pipelining = pipelining
+        self.reject = set(reject)
+        self.defer = set(defer)
+        self.deferred = set()
+        self.messages = []
+        self.raw = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply(b'220 sink ESMTP')
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply(b'250-sink\r\n250-PIPELINING\r\n250 8BITMIME' if server.pipelining
+                           else b'250-sink\r\n250 8BITMIME')
+            elif verb == 'MAIL':
+                self.reply(b'250 ok')
+            elif verb == 'RCPT':
+                recipient = self.rcpt(command.split('<', 1)[1].rstrip('>'))
+            elif verb == 'DATA':
+                if recipient is None:
+                    self.reply(b'554 no valid recipients')
+                    continue
+                self.reply(b'354 go ahead')
+                raw = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    raw.append(line)
+                with server.lock:
+                    server.raw.append((recipient, b''.join(raw)))
+                    server.messages.append((recipient, b''.join(
+                        line[1:] if line.startswith(b'.') else line for line in raw)))
+                recipient = None
+                self.reply(b'250 queued')
+            elif verb in ('RSET', 'NOOP'):
+                recipient = None if verb == 'RSET' else recipient
+                self.reply(b'250 ok')
+            elif verb == 'QUIT':
+                self.reply(b'221 bye')
+                return
+            else:
+                self.reply(b'502 not implemented')
+
+    def rcpt(self, address):
+        server = self.server
+        if address in server.reject:
+            self.reply(b'550 no such user')
+            return None
+        with server.lock:
+            deferred = address in server.defer and address not in server.deferred
+            server.deferred.add(address)
+        if deferred:
+            self.reply(b'451 try again later')
+            return None
+        self.reply(b'250 ok')
+        return address
+
+    def reply(self, data):
+        self.wfile.write(data + b'\r\n')
+
+
+class FakeDHgate(http.server.ThreadingHTTPServer):
+    """DHgate stand-in serving store pages on a free local port.
+
+    Every page gets a stable body with an ETag, gzip-compressed when the
+    client asks for it, and answers If-None-Match with a 304. `responses`
+    overrides a path with a fixed (status, body, headers). Kept-alive
+    connections are closed after `idle_timeout` seconds without a request,
+    like a real front end does.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, idle_timeout=None):
+        super().__init__(('127.0.0.1', 0), FakeDHgateHandler)
+        self.idle_timeout = idle_timeout
+        self.responses = {}
+        self.hits = collections.Counter()
+        self.statuses = collections.Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeDHgateHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] += 1
+        if self.path in self.server.responses:
+            self.reply(*self.server.responses[self.path])
+            return
+        body = f'<html><body>{self.path}</body></html>'.encode('utf-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, b'', {'ETag': etag})
+            return
+        headers = {'ETag': etag, 'Content-Type': 'text/html'}
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.reply(200, body, headers)
+
+    def reply(self, status, body, headers=None):
+        with self.server.lock:
+            self.server.statuses[status] += 1
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,162 @@
+import threading
+import time
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import server
+
+
+def controller(**options):
+    admission = server.AdmissionController()
+    admission.configure(**dict(dict(max_in_flight=4, max_queued=4, queue_timeout=2.0,
+                                    reserve=0.0, client_rate=0.0), **options))
+    return admission
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+class Waiter(threading.Thread):
+    """admit() on its own thread, recording the result and the admission order"""
+
+    def __init__(self, admission, cheap, order, name):
+        super().__init__(daemon=True)
+        self.admission, self.cheap, self.order, self.name = admission, cheap, order, name
+        self.result = 'pending'
+
+    def run(self):
+        self.result = self.admission.admit('10.0.0.1', self.cheap)
+        if self.result is None:
+            self.order.append(self.name)
+
+
+class InFlightTests(unittest.TestCase):
+
+    def test_reserve_keeps_slots_for_cheap_routes(self):
+        admission = controller(max_in_flight=4, reserve=0.5, max_queued=0)
+        self.assertEqual(admission.dynamic_limit, 2)
+        self.assertIsNone(admission.admit('a', False))
+        self.assertIsNone(admission.admit('a', False))
+        self.assertEqual(admission.admit('a', False), (503, 2))
+        self.assertIsNone(admission.admit('a', True))
+        self.assertIsNone(admission.admit('a', True))
+        self.assertEqual(admission.admit('a', True), (503, 2))
+        self.assertEqual(admission.stats()['rejected_overload'], 2)
+
+    def test_waiting_cheap_requests_are_admitted_first(self):
+        admission = controller(max_in_flight=1)
+        order = []
+        self.assertIsNone(admission.admit('a', False))
+        dynamic = Waiter(admission, False, order, 'dynamic')
+        dynamic.start()
+        wait_until(lambda: admission.queued == 1)
+        cheap = Waiter(admission, True, order, 'cheap')
+        cheap.start()
+        wait_until(lambda: admission.cheap_waiting == 1)
+        admission.release()
+        cheap.join(5)
+        self.assertEqual(order, ['cheap'])
+        # While a cheap request waits the dynamic one stays behind it
+        self.assertEqual(dynamic.result, 'pending')
+        admission.release()
+        dynamic.join(5)
+        self.assertEqual(order, ['cheap', 'dynamic'])
+        self.assertEqual((admission.queued, admission.cheap_waiting, admission.in_flight), (0, 0, 1))
+
+    def test_queued_request_times_out_with_503(self):
+        admission = controller(max_in_flight=1, queue_timeout=0.2)
+        self.assertIsNone(admission.admit('a', False))
+        started = time.monotonic()
+        self.assertEqual(admission.admit('a', False), (503, 1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual((admission.queued, admission.in_flight), (0, 1))
+
+    def test_full_queue_is_refused_at_once(self):
+        admission = controller(max_in_flight=1, max_queued=1)
+        order = []
+        self.assertIsNone(admission.admit('a', False))
+        waiter = Waiter(admission, False, order, 'queued')
+        waiter.start()
+        wait_until(lambda: admission.queued == 1)
+        started = time.monotonic()
+        self.assertEqual(admission.admit('a', False), (503, 2))
+        self.assertLess(time.monotonic() - started, 0.5)
+        admission.release()
+        waiter.join(5)
+        self.assertEqual(order, ['queued'])
+
+    def test_without_waiting_the_queue_counts_as_in_flight(self):
+        # The asyncio engine queues on its handler thread pool instead
+        admission = controller(max_in_flight=2, max_queued=2)
+        started = time.monotonic()
+        results = [admission.admit('a', False, wait=False) for _ in range(5)]
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(results, [None, None, None, None, (503, 2)])
+        self.assertEqual((admission.in_flight, admission.queued), (4, 0))
+
+    def test_concurrent_requests_never_exceed_the_limits(self):
+        admission = controller(max_in_flight=3, max_queued=64, reserve=0.34)
+        lock = threading.Lock()
+        running = {'cheap': 0, 'dynamic': 0, 'total': 0}
+        peaks = {'dynamic': 0, 'total': 0}
+        refused = []
+
+        def request(cheap):
+            if admission.admit('a', cheap) is not None:
+                refused.append(cheap)
+                return
+            kind = 'cheap' if cheap else 'dynamic'
+            with lock:
+                running[kind] += 1
+                running['total'] += 1
+                peaks['dynamic'] = max(peaks['dynamic'], running['dynamic'])
+                peaks['total'] = max(peaks['total'], running['total'])
+            time.sleep(0.005)
+            with lock:
+                running[kind] -= 1
+                running['total'] -= 1
+            admission.release()
+
+        threads = [threading.Thread(target=request, args=(index % 3 == 0,)) for index in range(60)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(refused, [])
+        self.assertLessEqual(peaks['total'], 3)
+        self.assertLessEqual(peaks['dynamic'], admission.dynamic_limit)
+        self.assertEqual((admission.in_flight, admission.queued, admission.cheap_waiting), (0, 0, 0))
+
+
+class RateLimitTests(unittest.TestCase):
+
+    def test_empty_bucket_gets_429(self):
+        admission = controller(client_rate=0.5, client_burst=1)
+        self.assertIsNone(admission.admit('10.0.0.1', False))
+        admission.release()
+        self.assertEqual(admission.admit('10.0.0.1', False), (429, 2))
+        self.assertIsNone(admission.admit('10.0.0.2', False))
+        self.assertEqual(admission.stats()['rejected_rate'], 1)
+
+    def test_least_recently_seen_client_is_evicted(self):
+        admission = controller(client_rate=0.01, client_burst=1, max_clients=2, max_in_flight=0)
+        self.assertIsNone(admission.admit('a', False))
+        self.assertIsNone(admission.admit('b', False))
+        # Seeing 'a' again makes 'b' the least recent, even when 'a' is refused
+        self.assertEqual(admission.admit('a', False)[0], 429)
+        self.assertIsNone(admission.admit('c', False))
+        self.assertEqual(admission.stats()['clients'], 2)
+        self.assertEqual(admission.admit('a', False)[0], 429)
+        # 'b' was evicted, so it starts over with a full bucket
+        self.assertIsNone(admission.admit('b', False))
+        self.assertEqual(admission.stats()['clients'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import change_detection
+import signup_store
+
+
+def page(*products):
+    """Store page with one product card per (item code, price)"""
+    cards = ''.join(f'<a href="/product/item/{code}.html" title="Item {code}">x</a> US ${price}'
+                    for code, price in products)
+    return f'<html><body>{cards}</body></html>'.encode('utf-8')
+
+
+def ld_page(*products):
+    """Store page with a JSON-LD ItemList of (sku, price) products"""
+    items = [{'@type': 'Product', 'sku': sku, 'name': f'Item {sku}',
+              'url': f'https://www.dhgate.com/product/item/{sku}.html',
+              'offers': {'price': price, 'availability': 'https://schema.org/InStock'}}
+             for sku, price in products]
+    data = json.dumps({'@type': 'ItemList', 'itemListElement': items})
+    return f'<html><script type="application/ld+json">{data}</script></html>'.encode('utf-8')
+
+
+class ChangeDetectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = signup_store.SignupStore(os.path.join(self.directory, 'changes.db'))
+        self.store.initialize()
+        self.detector = change_detection.ChangeDetector(self.store)
+        self.detector.initialize()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_listing_page_reports_added_removed_and_changed(self):
+        url = 'https://www.dhgate.com/store/products/1001.html'
+        self.assertIsNone(self.detector.detect(url, '1001', page((1, '1.00'), (2, '2.00'))))
+        changes = self.detector.detect(url, '1001', page((1, '1.50'), (3, '3.00')))
+        self.assertEqual([product['product_id'] for product in changes['added']], ['3'])
+        self.assertEqual([product['product_id'] for product in changes['removed']], ['2'])
+        self.assertEqual([product['fields'] for product in changes['changed']], [['price']])
+
+    def test_alphanumeric_skus_keep_their_id_when_removed(self):
+        url = 'https://www.dhgate.com/store/products/1002.html'
+        self.detector.detect(url, '1002', ld_page(('SKU-A', 1.0)))
+        added = self.detector.detect(url, '1002', ld_page(('SKU-A', 1.0), ('SKU-B', 2.0)))
+        removed = self.detector.detect(url, '1002', ld_page(('SKU-A', 1.0)))
+        events = (change_detection.digest_events('1002', added)
+                  + change_detection.digest_events('1002', removed))
+        self.assertEqual([(event['kind'], event['product_id']) for event in events],
+                         [('new', 'SKU-B'), ('removed', 'SKU-B')])
+
+    def test_partial_page_only_reports_changes(self):
+        url = 'https://www.dhgate.com/store/top-selling/1001.html'
+        self.detector.detect(url, '1001', page((1, '1.00'), (2, '2.00')), partial=True)
+        # Product 2 rotated out of the selection, 3 rotated in: neither is news
+        self.assertIsNone(self.detector.detect(url, '1001', page((1, '1.00'), (3, '3.00')),
+                                               partial=True))
+        changes = self.detector.detect(url, '1001', page((1, '0.90'), (3, '3.00')), partial=True)
+        self.assertEqual((changes['added'], changes['removed']), ([], []))
+        self.assertEqual([product['product_id'] for product in changes['changed']], ['1'])
+
+
+class HistoryPointTests(unittest.TestCase):
+
+    def test_removals_are_recorded_from_listing_pages_only(self):
+        old, _ = change_detection.records_for([
+            {'product_id': '1', 'title': 'a', 'price': '1.00', 'stock': 1},
+            {'product_id': '2', 'title': 'b', 'price': '2.00', 'stock': 1}])
+        new, _ = change_detection.records_for([
+            {'product_id': '1', 'title': 'a', 'price': '1.00', 'stock': 1}])
+        self.assertEqual(change_detection.history_points(old, new, 100), [(2, 100, 200, 0)])
+        self.assertEqual(change_detection.history_points(old, new, 100, partial=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
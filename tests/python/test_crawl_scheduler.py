@@ -0,0 +1,145 @@
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+from support import FakeDHgate
+
+import crawl_scheduler
+import signup_store
+
+
+class CrawlSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = signup_store.SignupStore(os.path.join(self.directory, 'crawl.db'))
+        self.store.initialize()
+        self.store.signup('crawler@example.com', [], [], 'en')
+        self.token = self.store.reader().execute(
+            "SELECT dashboard_token FROM subscriptions").fetchone()[0]
+        self.dhgate = FakeDHgate(idle_timeout=0.3).__enter__()
+
+    def tearDown(self):
+        self.dhgate.__exit__(None, None, None)
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def follow(self, store_id, monitoring_type='products'):
+        self.store.add_shop(self.token, f'https://www.dhgate.com/store/{store_id}', 'Shop',
+                            monitoring_type)
+
+    def scheduler(self, pages=None, **options):
+        options = dict(dict(concurrency=4, rate=0, host_rate=0, backoff=0.1,
+                            base_url=self.dhgate.base_url), **options)
+        on_page = None if pages is None else lambda job, body: pages.append((job.url, body))
+        scheduler = crawl_scheduler.CrawlScheduler(self.store, on_page=on_page, **options)
+        scheduler.initialize()
+        return scheduler
+
+    def crawl_state(self, url):
+        return self.store.reader().execute(
+            "SELECT last_status, failures, etag FROM crawl_state WHERE url = ?", (url,)).fetchone()
+
+    def test_crawls_followed_pages_then_revalidates(self):
+        self.follow(1001, 'full')
+        self.follow(1002)
+        pages = []
+        scheduler = self.scheduler(pages)
+        asyncio.run(scheduler.run(once=True))
+        self.assertEqual(scheduler.counts['fetched'], 4)
+        self.assertEqual(len(pages), 4)
+        url = self.dhgate.base_url + '/store/products/1002.html'
+        self.assertIn((url, b'<html><body>/store/products/1002.html</body></html>'), pages)
+
+        # Make every page due again instead of waiting out the interval
+        self.store.submit(lambda conn: conn.execute("UPDATE crawl_state SET next_due = 0"))
+        again = self.scheduler([])
+        asyncio.run(again.run(once=True))
+        self.assertEqual(again.counts['not_modified'], 4)
+        self.assertEqual(self.crawl_state(url)[0], 304)
+
+    def test_jobs_are_synced_on_the_event_loop_thread(self):
+        self.follow(1006)
+        scheduler = self.scheduler(refresh_every=0.05)
+        readers, syncs = set(), set()
+        read_pages, sync = scheduler._read_pages, scheduler._sync
+
+        def recording_read():
+            readers.add(threading.get_ident())
+            return read_pages()
+
+        def recording_sync(wanted, saved):
+            syncs.add(threading.get_ident())
+            return sync(wanted, saved)
+
+        scheduler._read_pages, scheduler._sync = recording_read, recording_sync
+
+        async def crawl():
+            task = asyncio.create_task(scheduler.run())
+            while scheduler.counts['fetched'] < 1 or len(syncs) < 1:
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)  # a few refreshes
+            scheduler.stop()
+            await task
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(asyncio.wait_for(crawl(), 10))
+        self.assertEqual(syncs, {loop_thread})
+        self.assertNotIn(loop_thread, readers)
+
+    def test_idle_connection_closed_by_the_server_is_replaced(self):
+        self.follow(1003)
+        scheduler = self.scheduler()
+        scheduler.load()
+        job, = scheduler.jobs.values()
+        self.assertEqual(scheduler._fetch(job)[0], 200)
+        time.sleep(0.6)  # past the server's idle timeout
+        self.assertEqual(scheduler._fetch(job)[0], 200)
+        self.assertEqual(self.dhgate.connections, 2)
+
+    def test_corrupt_gzip_body_is_a_failure_not_a_lost_page(self):
+        self.follow(1004)
+        self.follow(1005)
+        body = gzip.compress(b'<html>' + b'x' * 1000 + b'</html>')
+        self.dhgate.responses['/store/products/1004.html'] = (
+            200, body[:len(body) // 2], {'Content-Encoding': 'gzip'})
+        self.dhgate.responses['/store/products/1005.html'] = (
+            200, b'not gzip at all', {'Content-Encoding': 'gzip'})
+        scheduler = self.scheduler(interval=60.0)
+
+        async def crawl():
+            task = asyncio.create_task(scheduler.run())
+            while scheduler.counts['errors'] < 2:
+                await asyncio.sleep(0.01)
+            scheduler.stop()
+            await task
+
+        asyncio.run(asyncio.wait_for(crawl(), 10))
+        self.assertEqual(scheduler.counts['errors'], 2)
+        for store_id in (1004, 1005):
+            url = f'{self.dhgate.base_url}/store/products/{store_id}.html'
+            self.assertEqual(self.crawl_state(url)[1], 1)
+        # Both jobs are back on the heap for their backoff retry
+        self.assertEqual(sorted(entry[3].url for entry in scheduler._heap),
+                         sorted(scheduler.jobs))
+
+    def test_server_errors_back_off_and_open_the_breaker(self):
+        self.follow(1006)
+        self.dhgate.responses['/store/products/1006.html'] = (503, b'busy', {'Retry-After': '120'})
+        breaker = crawl_scheduler.CircuitBreaker(threshold=1, cooldown=30.0)
+        scheduler = self.scheduler(breaker=breaker)
+        asyncio.run(scheduler.run(once=True))
+        job, = scheduler.jobs.values()
+        self.assertEqual(job.failures, 1)
+        self.assertGreaterEqual(job.next_due - time.time(), 110)
+        self.assertEqual(breaker.open_hosts(time.time()), [job.host])
+
+
+if __name__ == '__main__':
+    unittest.main()
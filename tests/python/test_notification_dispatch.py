@@ -0,0 +1,68 @@
+import email
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+from support import SMTPSink
+
+import notification_dispatch
+
+PRODUCTS = [{'title': '.dot title', 'price': 'US $12.99', 'url': 'https://www.dhgate.com/p/1'}]
+
+
+def dispatch(sink, recipients, **options):
+    pool = notification_dispatch.SMTPConnectionPool('127.0.0.1', sink.port, starttls=False, size=2)
+    dispatcher = notification_dispatch.NotificationDispatcher(None, pool, batch_size=3,
+                                                              backoff=0.01, **options)
+    templates = notification_dispatch.render_notification(PRODUCTS, dispatcher.sender)
+    rows = [(index, address, 'en', f'token{index}', None)
+            for index, address in enumerate(recipients)]
+    try:
+        return dispatcher.send(dispatcher.message(templates, row) for row in rows)
+    finally:
+        pool.close()
+
+
+class DeliveryTests:
+    pipelining = None
+
+    def test_body_arrives_unchanged(self):
+        with SMTPSink(self.pipelining) as sink:
+            stats = dispatch(sink, ['a@example.com', 'b@example.com'])
+        self.assertEqual(stats, {'sent': 2, 'failed': 0, 'retried': 0})
+        self.assertEqual(sorted(recipient for recipient, _ in sink.messages),
+                         ['a@example.com', 'b@example.com'])
+        for _, data in sink.messages:
+            message = email.message_from_bytes(data)
+            body = message.get_payload(decode=True).decode('utf-8')
+            self.assertIn('\n.header {', body)
+            self.assertNotIn('..', body)
+            self.assertIn('.dot title', body)
+            self.assertIn('US $12.99', body)
+
+    def test_lines_starting_with_a_dot_are_stuffed_once(self):
+        with SMTPSink(self.pipelining) as sink:
+            dispatch(sink, ['a@example.com'])
+        (_, raw), = sink.raw
+        self.assertIn(b'\r\n..header {', raw)
+        self.assertNotIn(b'\r\n...', raw)
+
+    def test_rejected_and_deferred_recipients(self):
+        with SMTPSink(self.pipelining, reject={'bad@example.com'},
+                      defer={'later@example.com'}) as sink:
+            stats = dispatch(sink, ['a@example.com', 'bad@example.com', 'later@example.com',
+                                    'c@example.com'])
+        self.assertEqual(stats, {'sent': 3, 'failed': 1, 'retried': 1})
+        self.assertEqual(sorted(recipient for recipient, _ in sink.messages),
+                         ['a@example.com', 'c@example.com', 'later@example.com'])
+
+
+class PipelinedDeliveryTests(DeliveryTests, unittest.TestCase):
+    pipelining = True
+
+
+class PlainDeliveryTests(DeliveryTests, unittest.TestCase):
+    pipelining = False
+
+
+if __name__ == '__main__':
+    unittest.main()
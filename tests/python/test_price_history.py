@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import price_history
+
+NUMPY = price_history.numpy  # None when NumPy is not installed
+HOUR = price_history.HOUR
+START = 19676 * price_history.DAY  # midnight UTC
+HOURS = 72
+END = START + HOURS * HOUR
+KEYS = (1, 2, -3)
+
+
+def observations(hours=range(HOURS)):
+    """Three points an hour per product; product -3 cycles in/unknown/out of stock"""
+    points = []
+    for hour in hours:
+        for minute, stock in ((0, 1), (20, -1), (40, 0)):
+            ts = START + hour * HOUR + minute * 60
+            points.append((1, ts, 1000 + (hour * 7 + minute) % 50, 1))
+            points.append((2, ts, 2500 - hour * 5, 1))
+            points.append((-3, ts, 300 + (hour % 4) * 10 + minute // 20, stock))
+    return points
+
+
+class HistoryTests:
+    """Runs against the pure-Python path or the NumPy path (numpy_module)"""
+    numpy_module = None
+
+    def setUp(self):
+        patcher = mock.patch.object(price_history, 'numpy', self.numpy_module)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.history = self.open()
+
+    def open(self, writable=True):
+        history = price_history.PriceHistory(self.directory, writable=writable, auto_rollup=False)
+        self.addCleanup(history.close)
+        return history
+
+    def test_raw_series_returns_every_point_in_time_order(self):
+        self.history.append(reversed(observations()))
+        points = self.history.series(2, START, END, tier='raw')['points']
+        self.assertEqual(len(points), HOURS * 3)
+        self.assertEqual([point[0] for point in points], sorted(point[0] for point in points))
+        self.assertEqual(points[0], [START, 25.0, 25.0, 25.0, 25.0])
+
+    def test_rollup_folds_complete_hours_and_days(self):
+        self.history.append(observations())
+        # Hour 71 is still in progress, so only 71 hours and 2 days are folded
+        written = self.history.rollup(END - 1)
+        self.assertEqual(written, 71 * len(KEYS) + 2 * len(KEYS))
+        hourly = self.history.series(1, START, END, tier='hourly')['points']
+        self.assertEqual(len(hourly), 71)
+        self.assertEqual(hourly[1], [START + HOUR, 10.07, 10.47, 10.27, 10.47])
+        daily = self.history.series(2, START, END, tier='daily')['points']
+        self.assertEqual(daily[0], [START, 23.85, 25.0, 24.425, 23.85])
+        self.assertEqual(self.history.rollup(END - 1), 0)
+
+    def test_unknown_stock_does_not_count_as_in_stock(self):
+        self.history.append(observations())
+        self.history.rollup(END)
+        for tier in ('raw', 'hourly', 'daily'):
+            summary = self.history.summaries([-3], START, END, tier=tier)[-3]
+            self.assertEqual(summary['in_stock'], round(1 / 3, 4), tier)
+            self.assertEqual(summary['points'], HOURS * 3, tier)
+
+    def test_tiers_agree_on_the_totals(self):
+        self.history.append(observations())
+        self.history.rollup(END)
+        tiers = {tier: self.history.summaries(None, START, END, tier=tier)
+                 for tier in ('raw', 'hourly', 'daily')}
+        for key in KEYS:
+            expected = {name: tiers['raw'][key][name]
+                        for name in ('points', 'min', 'max', 'mean', 'first', 'last', 'change_pct')}
+            for tier in ('hourly', 'daily'):
+                self.assertEqual({name: tiers[tier][key][name] for name in expected}, expected)
+
+    def test_interrupted_rollup_is_trimmed_and_redone(self):
+        self.history.append(observations(range(24)))
+        self.history.rollup(START + 24 * HOUR)
+        self.history.append(observations(range(24, 48)))
+        # A rollup that wrote its buckets but died before saving the watermark
+        tail = price_history.aggregate(
+            self.history._read('raw', START + 24 * HOUR, START + 48 * HOUR), HOUR)
+        self.history._write_tier('hourly', tail)
+        self.history.rollup(START + 48 * HOUR)
+        hourly = self.history.series(1, START, START + 48 * HOUR, tier='hourly')['points']
+        self.assertEqual([point[0] for point in hourly], [START + hour * HOUR for hour in range(48)])
+
+    def test_reader_sees_appends_that_grow_the_segment(self):
+        self.history.append(observations(range(1)))
+        reader = self.open(writable=False)
+        self.assertEqual(reader.summaries([1], START, END, tier='raw')[1]['points'], 3)
+        many = [(4, START + second, 100, 1) for second in range(price_history.GROW_RECORDS + 10)]
+        self.history.append(many)
+        self.assertEqual(reader.summaries([4], START, END, tier='raw')[4]['points'], len(many))
+
+    def test_new_segment_is_created_with_its_header(self):
+        replaced = []
+        real_replace = os.replace
+
+        def replace(source, target):
+            replaced.append((os.path.getsize(source), os.path.exists(target)))
+            real_replace(source, target)
+
+        with mock.patch.object(price_history.os, 'replace', replace):
+            self.history.append(observations(range(1)))
+        # Readers can never map the segment before its header is there
+        self.assertEqual(replaced[0], (price_history.HEADER.size, False))
+
+
+class PurePythonTests(HistoryTests, unittest.TestCase):
+    numpy_module = None
+
+
+@unittest.skipIf(NUMPY is None, "NumPy is not installed")
+class NumpyTests(HistoryTests, unittest.TestCase):
+    numpy_module = NUMPY
+
+
+@unittest.skipIf(NUMPY is None, "NumPy is not installed")
+class ParityTests(unittest.TestCase):
+
+    def results(self, numpy_module):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        with mock.patch.object(price_history, 'numpy', numpy_module):
+            history = price_history.PriceHistory(directory, auto_rollup=False)
+            try:
+                history.append(observations())
+                results = {'written': history.rollup(END - 1)}
+                for tier in ('raw', 'hourly', 'daily'):
+                    results[tier] = history.summaries(None, START, END, tier=tier)
+                    for key in KEYS:
+                        results[tier, key] = history.series(key, START, END, tier=tier)
+            finally:
+                history.close()
+        return results
+
+    def test_numpy_and_pure_python_paths_agree(self):
+        pure, vectorized = self.results(None), self.results(NUMPY)
+        self.assertEqual(pure.keys(), vectorized.keys())
+        for name, expected in pure.items():
+            actual = vectorized[name]
+            if name in ('raw', 'hourly', 'daily'):
+                self.assertEqual(actual.keys(), expected.keys(), name)
+                for key, summary in expected.items():
+                    for field, value in summary.items():
+                        self.assertAlmostEqual(actual[key][field], value, 3, (name, key, field))
+            else:
+                self.assertEqual(actual, expected, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
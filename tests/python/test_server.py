@@ -0,0 +1,440 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import server
+
+SMALL = b''.join(b'%04d' % number for number in range(250))  # 1000 bytes
+LARGE_SIZE = 256 * 1024
+HUGE_SIZE = 32 * 1024 * 1024
+SENDFILE_THRESHOLD = 64 * 1024
+SLOW_SECONDS = 0.5
+
+_directory = None
+_cwd = None
+
+
+def setUpModule():
+    # serve_file resolves paths against the working directory
+    global _directory, _cwd
+    _directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(_directory, 'assets'))
+    with open(os.path.join(_directory, 'assets', 'small.txt'), 'wb') as f:
+        f.write(SMALL)
+    with open(os.path.join(_directory, 'assets', 'large.bin'), 'wb') as f:
+        f.write(bytes(range(256)) * (LARGE_SIZE // 256))
+    with open(os.path.join(_directory, 'assets', 'huge.bin'), 'wb') as f:
+        f.truncate(HUGE_SIZE)
+    _cwd = os.getcwd()
+    os.chdir(_directory)
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+def server_args(*options):
+    args = server.parse_args(['--host', '127.0.0.1', '--port', '0', '--access-log', 'off',
+                              '--sendfile-threshold', str(SENDFILE_THRESHOLD), *options])
+    server.configure_access_log(args)
+    server.STATIC_CACHE.configure(stream_threshold=args.sendfile_threshold)
+    return args
+
+
+class TestRoutes:
+    """Extra routes for framing and draining, ahead of the regular dispatch"""
+    streamed = []
+
+    def do_GET(self):
+        if self.path == '/unframed':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.write_body(b'no length')
+        elif self.path == '/slow':
+            time.sleep(SLOW_SECONDS)
+            self.send_bytes(b'slow', 'text/plain', cache_control='no-store')
+        else:
+            super().do_GET()
+
+    def send_file_body(self, path, offset, count):
+        self.streamed.append((path, offset, count))
+        super().send_file_body(path, offset, count)
+
+
+class ThreadedTestHandler(TestRoutes, server.DHgateMonitorHandler):
+    pass
+
+
+class AsyncTestHandler(TestRoutes, server.AsyncRequestAdapter):
+    pass
+
+
+class ThreadedServer:
+    """build_server() on an ephemeral port, served from a thread"""
+
+    def __init__(self, *options):
+        self.httpd = server.build_server(server_args(*options), ThreadedTestHandler)
+        self.port = self.httpd.server_address[1]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join(5)
+
+
+class AsyncioServer:
+    """AsyncioDHgateServer on an ephemeral port, its loop running in a thread"""
+
+    def __init__(self, *options):
+        self.engine = server.AsyncioDHgateServer(server_args(*options), AsyncTestHandler)
+        self.started = threading.Event()
+        self.sent_files = []
+
+    def __enter__(self):
+        send_file = self.engine._send_file
+
+        async def recording_send_file(writer, path, offset, count):
+            self.sent_files.append((path, offset, count))
+            return await send_file(writer, path, offset, count)
+
+        self.engine._send_file = recording_send_file
+        self.thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self.thread.start()
+        self.started.wait(5)
+        self.port = self.engine.server_address[1]
+        return self
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        await self.engine.start()
+        self.started.set()
+        try:
+            await self.engine.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        await self.engine.drain()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.engine.close)
+
+    def __exit__(self, *exc):
+        if not self.engine.closing:
+            self.close()
+        self.thread.join(10)
+
+
+class Client:
+    """Raw HTTP/1.x over one socket, so framing and reuse can be checked"""
+
+    def __init__(self, port, receive_buffer=None):
+        self.sock = socket.socket()
+        if receive_buffer:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.sock.settimeout(5)
+        self.sock.connect(('127.0.0.1', port))
+        self.buffer = b''
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def request(self, path, method='GET', version='HTTP/1.1', headers=(), body=b''):
+        lines = [f'{method} {path} {version}', 'Host: localhost']
+        lines += [f'{name}: {value}' for name, value in headers]
+        self.send(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        self.buffer += data
+
+    def response(self, method='GET'):
+        """(status, {lower-case header: value}, body) of the next response"""
+        while b'\r\n\r\n' not in self.buffer:
+            self._fill()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        status_line, *lines = head.decode('latin-1').split('\r\n')
+        status = int(status_line.split()[1])
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if method == 'HEAD' or status in (204, 304):
+            return status, headers, b''
+        if 'content-length' in headers:
+            length = int(headers['content-length'])
+            while len(self.buffer) < length:
+                self._fill()
+            body, self.buffer = self.buffer[:length], self.buffer[length:]
+            return status, headers, body
+        while True:
+            try:
+                self._fill()
+            except EOFError:
+                body, self.buffer = self.buffer, b''
+                return status, headers, body
+
+    def closed(self):
+        """Whether the server has closed the connection (nothing else is pending)"""
+        try:
+            self._fill()
+        except (EOFError, ConnectionResetError):
+            return True
+        return False
+
+
+class EngineTests:
+    """Keep-alive, framing and Range behaviour every engine must share"""
+
+    def serve(self, *options):
+        raise NotImplementedError
+
+    def connect(self, httpd, **options):
+        client = Client(httpd.port, **options)
+        self.addCleanup(client.close)
+        return client
+
+    # Keep-alive and framing
+
+    def test_keepalive_connection_is_reused(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            for _ in range(3):
+                client.request('/assets/small.txt')
+                status, headers, body = client.response()
+                self.assertEqual((status, body), (200, SMALL))
+                self.assertNotIn('connection', headers)
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.send(b'GET /assets/small.txt HTTP/1.1\r\nHost: x\r\n\r\n'
+                        b'GET /assets/missing.txt HTTP/1.1\r\nHost: x\r\n\r\n'
+                        b'HEAD /assets/small.txt HTTP/1.1\r\nHost: x\r\n\r\n')
+            self.assertEqual(client.response()[2], SMALL)
+            self.assertEqual(client.response()[0], 404)
+            status, headers, _ = client.response('HEAD')
+            self.assertEqual((status, headers['content-length']), (200, str(len(SMALL))))
+            client.request('/assets/small.txt')
+            self.assertEqual(client.response()[0], 200)
+
+    def test_max_keepalive_requests_closes_the_last_response(self):
+        with self.serve('--max-keepalive-requests', '2') as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt')
+            self.assertNotIn('connection', client.response()[1])
+            client.request('/assets/small.txt')
+            self.assertEqual(client.response()[1].get('connection'), 'close')
+            self.assertTrue(client.closed())
+
+    def test_http10_keeps_the_connection_only_when_asked(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt', version='HTTP/1.0',
+                           headers=[('Connection', 'keep-alive')])
+            status, headers, body = client.response()
+            self.assertEqual((status, headers.get('connection'), body), (200, 'keep-alive', SMALL))
+            client.request('/assets/small.txt', version='HTTP/1.0')
+            status, headers, body = client.response()
+            self.assertEqual((status, body), (200, SMALL))
+            self.assertNotEqual(headers.get('connection'), 'keep-alive')
+            self.assertTrue(client.closed())
+
+    def test_oversized_header_gets_431(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt', headers=[('X-Padding', 'a' * 70000)])
+            self.assertEqual(client.response()[0], 431)
+            self.assertTrue(client.closed())
+
+    # Range requests
+
+    def range_request(self, httpd, value, path='/assets/small.txt', headers=()):
+        client = self.connect(httpd)
+        client.request(path, headers=[('Range', value), *headers])
+        return client.response()
+
+    def test_single_byte_range(self):
+        with self.serve() as httpd:
+            status, headers, body = self.range_request(httpd, 'bytes=0-0')
+            self.assertEqual((status, body), (206, SMALL[:1]))
+            self.assertEqual(headers['content-range'], f'bytes 0-0/{len(SMALL)}')
+
+    def test_suffix_range_longer_than_the_file_is_the_whole_file(self):
+        with self.serve() as httpd:
+            status, headers, body = self.range_request(httpd, f'bytes=-{len(SMALL) * 2}')
+            self.assertEqual((status, body), (206, SMALL))
+            self.assertEqual(headers['content-range'], f'bytes 0-{len(SMALL) - 1}/{len(SMALL)}')
+
+    def test_range_starting_at_the_end_is_not_satisfiable(self):
+        with self.serve() as httpd:
+            status, headers, body = self.range_request(httpd, f'bytes={len(SMALL)}-')
+            self.assertEqual((status, body), (416, b''))
+            self.assertEqual(headers['content-range'], f'bytes */{len(SMALL)}')
+
+    def test_reversed_and_multiple_ranges_get_the_full_file(self):
+        with self.serve() as httpd:
+            for value in ('bytes=5-2', 'bytes=0-1,5-6'):
+                status, headers, body = self.range_request(httpd, value)
+                self.assertEqual((status, body), (200, SMALL), value)
+                self.assertNotIn('content-range', headers)
+
+    def test_if_range_must_match_the_current_etag(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt')
+            etag = client.response()[1]['etag']
+            status, _, body = self.range_request(httpd, 'bytes=10-19', headers=[('If-Range', etag)])
+            self.assertEqual((status, body), (206, SMALL[10:20]))
+            status, _, body = self.range_request(httpd, 'bytes=10-19',
+                                                 headers=[('If-Range', '"stale"')])
+            self.assertEqual((status, body), (200, SMALL))
+
+    def test_files_above_the_sendfile_threshold_are_streamed(self):
+        with open('assets/large.bin', 'rb') as f:
+            large = f.read()
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/large.bin')
+            self.assertEqual(client.response()[2], large)
+            client.request('/assets/large.bin', headers=[('Range', 'bytes=100000-')])
+            status, _, body = client.response()
+            self.assertEqual((status, body), (206, large[100000:]))
+            client.request('/assets/small.txt')
+            self.assertEqual(client.response()[2], SMALL)
+        self.assertEqual(self.streamed_files(httpd),
+                         [('assets/large.bin', 0, LARGE_SIZE),
+                          ('assets/large.bin', 100000, LARGE_SIZE - 100000)])
+
+
+class ThreadedEngineTests(EngineTests, unittest.TestCase):
+
+    def setUp(self):
+        TestRoutes.streamed = []
+
+    def serve(self, *options):
+        return ThreadedServer(*options)
+
+    def streamed_files(self, httpd):
+        return TestRoutes.streamed
+
+    def test_unread_request_body_closes_the_connection(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt', headers=[('Content-Length', '5')], body=b'hello')
+            status, headers, body = client.response()
+            self.assertEqual((status, headers.get('connection'), body), (200, 'close', SMALL))
+            self.assertTrue(client.closed())
+
+    def test_unframed_response_body_closes_the_connection(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/unframed')
+            status, headers, body = client.response()
+            self.assertEqual((status, headers.get('connection'), body), (200, 'close', b'no length'))
+            self.assertTrue(client.closed())
+
+    def test_pool_mode_serves_keepalive_and_pipelined_requests(self):
+        with self.serve('--mode', 'pool', '--pool-size', '2') as httpd:
+            client = self.connect(httpd)
+            client.send(b'GET /assets/small.txt HTTP/1.1\r\nHost: x\r\n\r\n' * 3)
+            for _ in range(3):
+                self.assertEqual(client.response()[2], SMALL)
+
+
+class AsyncioEngineTests(EngineTests, unittest.TestCase):
+
+    def serve(self, *options):
+        return AsyncioServer(*options)
+
+    def streamed_files(self, httpd):
+        return httpd.sent_files
+
+    def assert_refused(self, httpd, status, headers):
+        client = self.connect(httpd)
+        client.request('/assets/small.txt', headers=headers)
+        answer, response_headers, _ = client.response()
+        self.assertEqual((answer, response_headers.get('connection')), (status, 'close'))
+        self.assertTrue(client.closed())
+
+    def test_malformed_framing_is_refused(self):
+        with self.serve() as httpd:
+            self.assert_refused(httpd, 400, [('Content-Length', 'abc')])
+            self.assert_refused(httpd, 400, [('Content-Length', '1'), ('Content-Length', '2')])
+            self.assert_refused(httpd, 411, [('Transfer-Encoding', 'chunked')])
+
+    def test_request_body_is_read_and_the_connection_kept(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/assets/small.txt', headers=[('Content-Length', '5')], body=b'hello')
+            status, headers, body = client.response()
+            self.assertEqual((status, headers.get('connection'), body), (200, None, SMALL))
+            client.request('/assets/small.txt')
+            self.assertEqual(client.response()[2], SMALL)
+
+    def test_unframed_response_gets_a_content_length_and_closes(self):
+        with self.serve() as httpd:
+            client = self.connect(httpd)
+            client.request('/unframed')
+            status, headers, body = client.response()
+            self.assertEqual((status, headers['content-length'], body), (200, '9', b'no length'))
+            self.assertEqual(headers.get('connection'), 'close')
+            self.assertTrue(client.closed())
+
+    def test_client_that_stops_reading_is_dropped_after_the_write_timeout(self):
+        with self.serve('--write-timeout', '0.3') as httpd:
+            client = self.connect(httpd, receive_buffer=4096)
+            client.request('/assets/huge.bin')
+            deadline = time.monotonic() + 5
+            while not httpd.sent_files and time.monotonic() < deadline:
+                time.sleep(0.01)
+            while httpd.engine.connections and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(httpd.engine.connections, 0)
+            received = 0
+            try:
+                while True:
+                    data = client.sock.recv(1024 * 1024)
+                    if not data:
+                        break
+                    received += len(data)
+            except ConnectionResetError:
+                pass
+            self.assertLess(received, HUGE_SIZE)
+
+    def test_close_drains_requests_in_progress(self):
+        with self.serve() as httpd:
+            idle = self.connect(httpd)
+            idle.request('/assets/small.txt')
+            idle.response()
+            busy = self.connect(httpd)
+            busy.request('/slow')
+            time.sleep(SLOW_SECONDS / 5)
+            httpd.close()
+            status, headers, body = busy.response()
+            self.assertEqual((status, body), (200, b'slow'))
+            self.assertTrue(busy.closed())
+            self.assertTrue(idle.closed())
+            with self.assertRaises(OSError):
+                Client(httpd.port).request('/assets/small.txt')
+
+
+if __name__ == '__main__':
+    unittest.main()
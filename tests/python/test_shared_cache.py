@@ -0,0 +1,55 @@
+import threading
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import shared_cache
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class SharedCountersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = shared_cache.SharedCounters()
+        self.counters.allocate(2, lanes=4)
+        self.counters.use_row(1)
+
+    def test_disabled_counters_ignore_responses(self):
+        counters = shared_cache.SharedCounters()
+        counters.record_response(200, 512)
+        self.assertFalse(counters.enabled)
+        self.assertEqual(counters.snapshot(), [])
+
+    def test_concurrent_threads_lose_no_counts(self):
+        def serve():
+            for _ in range(2000):
+                self.counters.record_response(200, 3)
+            self.counters.record_response(404, 0)
+
+        # More threads than lanes, so some of them share the overflow lane
+        run_threads(8, serve)
+        idle, row = self.counters.snapshot()
+        self.assertEqual(idle['requests'], 0)
+        self.assertEqual(row['requests'], 8 * 2001)
+        self.assertEqual(row['responses_2xx'], 8 * 2000)
+        self.assertEqual(row['responses_4xx'], 8)
+        self.assertEqual(row['bytes_sent'], 8 * 2000 * 3)
+
+    def test_lanes_of_exited_threads_are_reused(self):
+        run_threads(4, lambda: self.counters.record_response(200, 1))
+        run_threads(4, lambda: self.counters.record_response(500, 1))
+        overflow = (1 * 5 + 4) * self.counters.row_format.size
+        self.assertEqual(self.counters.row_format.unpack_from(self.counters._map, overflow)[0], 0)
+        row = self.counters.snapshot()[1]
+        self.assertEqual((row['requests'], row['responses_2xx'], row['responses_5xx']), (8, 4, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import support  # noqa: F401  (puts the repository on sys.path)
+
+import signup_store
+
+
+def count_signups(conn):
+    return conn.execute("SELECT count(*) FROM subscriptions").fetchone()[0]
+
+
+class WriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = signup_store.SignupStore(os.path.join(self.directory, 'signups.db'))
+        self.store.initialize()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_failing_operation_leaves_the_writer_running(self):
+        def broken(conn):
+            conn.execute("INSERT INTO users (email) VALUES ('rolled-back@example.com')")
+            return {}['missing']
+
+        with self.assertRaises(KeyError):
+            self.store.submit(broken)
+        with self.assertRaises(TypeError):
+            self.store.submit(count_signups, 'unexpected argument')
+        self.store.signup('after@example.com', [], [], 'en')
+        self.assertEqual(self.store.submit(count_signups), 1)
+        self.assertEqual(self.store.submit(
+            lambda conn: conn.execute("SELECT count(*) FROM users WHERE email LIKE 'rolled%'")
+            .fetchone()[0]), 0)
+
+    def test_stop_sentinel_inside_a_batch(self):
+        release = threading.Event()
+        blocker = self.store.submit_async(lambda conn: release.wait(5))
+        before = self.store.submit_async(count_signups)
+        self.store._queue.put(None)
+        after = self.store.submit_async(count_signups)
+        release.set()
+        self.assertTrue(blocker.result(5))
+        self.assertEqual(before.result(5), 0)
+        with self.assertRaises(RuntimeError):
+            after.result(5)
+        self.store._thread.join(5)
+        self.assertFalse(self.store._thread.is_alive())
+        # The next write starts a fresh writer thread
+        self.store._pid = None
+        self.assertEqual(self.store.submit(count_signups), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()